@@ -0,0 +1,385 @@
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import argparse
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import aio_pika  # type: ignore
+from dotenv import load_dotenv  # type: ignore
+
+from startup import (IMPORT_START, StartupTimer, warm_up_backends, report_when_warm, run_checks, print_checks)
+from label_handlers import get_handlers
+from label_pipeline import (read_label_text, LabelExtractor, handle_extracted_data, extraction_cache,
+                            gemini_guard)
+from rate_limiter import GeminiUnavailable
+from retry_queues import (LabelFailure, classify, next_destination, failure_headers, retry_topology,
+                          last_attempt)
+from label_splitter import should_split, extract_split_file, split_children
+from task_payload import task_file, blob_cache
+from results_sink import open_sink, RESULTS_BATCH_SIZE
+from model_tiering import tiering_stats
+from prompt_reducer import reduction_stats
+from barcode_stage import barcode_stats
+from metrics import (start_metrics_server, start_profiler, IN_FLIGHT, MESSAGES, QUEUE_DEPTH,
+                     QUEUE_DEPTH_INTERVAL, LABEL_SECONDS)
+from worker_pool import OCR_PROCESSES, ledger_lookup
+from fair_scheduler import (FairScheduler, FAIR_SCHEDULING, queue_arguments, prefetch_for, delivery_info,
+                            record_queue_latency)
+
+# asyncio variant of label_agent.py on aio-pika. Each label goes through
+# explicit stages joined by bounded queues:
+#   consume -> read -> extract (pypdf/OCR, process pool) -> LLM (thread pool) -> persist -> ack
+# The event loop itself never blocks, so AMQP heartbeats keep flowing however
+# long OCR or Gemini take, and the broker never redelivers work in progress.
+# Backpressure: per-queue prefetch caps deliveries, and a full stage queue
+# stops the stage before it from taking more work. Each queue feeds at most
+# its handler's concurrency into the stages at once, urgent tasks first and
+# tenants by weight (see fair_scheduler.py).
+# Labels without a result go to <queue>.retry.N or <queue>.dead (see
+# retry_queues.py); labels already in the results ledger are acked at once.
+#   python async_agent.py                 # all registered label types
+#   python async_agent.py shipping
+#   python async_agent.py --check         # dependency readiness report, no consuming
+
+# Load environment variables from .env file
+load_dotenv()
+
+# --- Config ---
+MESSAGE_QUEUE_HOST = os.getenv("MESSAGE_QUEUE_HOST", "localhost")
+EXCHANGE_NAME = "label_tasks"
+AMQP_HEARTBEAT = int(os.getenv("AMQP_HEARTBEAT", "30"))
+STAGE_QUEUE_SIZE = int(os.getenv("STAGE_QUEUE_SIZE", "16"))
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", str(max(1, OCR_PROCESSES))))
+LLM_WORKERS = int(os.getenv("LLM_WORKERS", "8"))
+
+# --- Logging Setup ---
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(),
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    stream=sys.stdout)
+logger = logging.getLogger(__name__)
+
+
+class _Job:
+    __slots__ = ("handler", "message", "file_path", "local_path", "file_hash", "text", "data", "started")
+
+    def __init__(self, handler, message):
+        self.handler = handler
+        self.message = message
+        self.file_path = None
+        self.local_path = None  # the PDF on this node, see task_payload.py
+        self.file_hash = None
+        self.text = None
+        self.data = None
+        self.started = time.perf_counter()
+
+
+# --- Pipeline ---
+class AsyncLabelPipeline:
+    def __init__(self, handlers, model=None):
+        self.handlers = handlers
+        # Without a model, each label type uses its configured model from the process-wide pool
+        self.model = model
+        self.extractors = {h.name: LabelExtractor(h, model) for h in handlers}
+        # Batches of at most the unacked deliveries of all channels: a fuller one could only wait for the flush timer
+        self.sink = open_sink(batch_size=min(RESULTS_BATCH_SIZE, sum(prefetch_for(h.concurrency) for h in handlers)))
+        self.cpu_pool = ProcessPoolExecutor(max_workers=EXTRACT_WORKERS) if OCR_PROCESSES > 0 else None
+        self.llm_pool = ThreadPoolExecutor(max_workers=LLM_WORKERS, thread_name_prefix="label-llm")
+        self.read_q = asyncio.Queue(maxsize=STAGE_QUEUE_SIZE)
+        self.extract_q = asyncio.Queue(maxsize=STAGE_QUEUE_SIZE)
+        self.llm_q = asyncio.Queue(maxsize=STAGE_QUEUE_SIZE)
+        self.persist_q = asyncio.Queue(maxsize=STAGE_QUEUE_SIZE)
+        self.stage_tasks = []
+        self.consumer_tasks = []
+        self.queues = {}  # queue name -> aio_pika queue, for the depth gauge
+        self.channels = {}  # label type -> channel, for publishing to the retry queues
+        self.schedulers = {}  # label type -> FairScheduler
+        self.unsettled = 0  # persisted or persisting, not yet acked
+        self.connection = None
+        self.loop = None
+
+    async def start(self, timer=None):
+        self.loop = asyncio.get_running_loop()
+        timer = timer or StartupTimer(time.perf_counter())
+        # Gemini, OCR and pypdf load in background threads while the broker connection opens (see startup.py)
+        warm_up = warm_up_backends(self.handlers, timer, gemini=self.model is None)
+        with timer.phase("rabbitmq"):
+            self.connection = await aio_pika.connect_robust(host=MESSAGE_QUEUE_HOST, heartbeat=AMQP_HEARTBEAT)
+        self.stage_tasks = [
+            asyncio.create_task(self._stage(self.read_q, self._read, 1)),
+            asyncio.create_task(self._stage(self.extract_q, self._extract, EXTRACT_WORKERS)),
+            asyncio.create_task(self._stage(self.llm_q, self._llm, LLM_WORKERS)),
+            asyncio.create_task(self._stage(self.persist_q, self._persist, 1)),
+            asyncio.create_task(self._watch_queues()),
+        ]
+        self.consumer_tasks = [asyncio.create_task(self._consume(h)) for h in self.handlers]
+        logger.info(f"🔄 [*] Async pipeline started (extract {EXTRACT_WORKERS}, LLM {LLM_WORKERS}, "
+                    f"stage queues {STAGE_QUEUE_SIZE}). Waiting for label tasks.")
+        report_when_warm(timer, warm_up, "Async pipeline")
+
+    async def _consume(self, handler):
+        # One channel per label type, so each queue's prefetch is its own limit
+        prefetch = prefetch_for(handler.concurrency)
+        channel = await self.connection.channel()
+        await channel.set_qos(prefetch_count=prefetch)
+        try:
+            queue = await channel.declare_queue(handler.queue, durable=True, arguments=queue_arguments())
+        except aio_pika.exceptions.ChannelPreconditionFailed:
+            # Declared earlier without x-max-priority: the broker closed the channel, use the queue as it is
+            logger.warning(f"'{handler.queue}' exists without x-max-priority; priorities are ignored by the "
+                           f"broker until it is drained and deleted.")
+            channel = await self.connection.channel()
+            await channel.set_qos(prefetch_count=prefetch)
+            queue = await channel.declare_queue(handler.queue, durable=True, passive=True)
+        exchange = await channel.declare_exchange(EXCHANGE_NAME, aio_pika.ExchangeType.DIRECT, durable=True)
+        await queue.bind(exchange, routing_key=handler.routing_key)
+        for name, arguments in retry_topology(handler.queue):
+            await channel.declare_queue(name, durable=True, arguments=arguments)
+        self.queues[handler.queue] = queue
+        self.channels[handler.name] = channel
+        scheduler = None
+        if FAIR_SCHEDULING:
+            # Runs on the loop: add() here, done() in _finish
+            scheduler = FairScheduler(handler.concurrency, lambda job: asyncio.ensure_future(self._admit(job)),
+                                      handler.name)
+            self.schedulers[handler.name] = scheduler
+        logger.info(f"🔄 Consuming '{handler.queue}' (routing key '{handler.routing_key}', "
+                    f"concurrency {handler.concurrency}, prefetch {prefetch})")
+        async with queue.iterator() as messages:
+            async for message in messages:
+                # While the Gemini circuit breaker is open, hold this delivery: with the
+                # prefetch limit reached the broker stops sending more
+                while gemini_guard.breaker.is_open():
+                    await asyncio.sleep(1)
+                if scheduler is None:
+                    await self._admit(_Job(handler, message))
+                else:
+                    tenant, priority, _ = delivery_info(message, message.body)
+                    # A job the scheduler could not start goes back to the broker
+                    for job in scheduler.add(tenant, priority, _Job(handler, message)):
+                        await job.message.nack(requeue=True)
+
+    async def _admit(self, job):
+        job.started = time.perf_counter()  # not the time spent waiting in the scheduler
+        IN_FLIGHT.labels(job.handler.name).inc()
+        await self.read_q.put(job)  # blocks while the pipeline is full
+
+    async def _watch_queues(self):
+        while True:
+            for name, queue in list(self.queues.items()):
+                try:
+                    result = await queue.declare()
+                    QUEUE_DEPTH.labels(name).set(result.message_count)
+                except Exception as e:
+                    logger.debug(f"Cannot read depth of {name}: {e}")
+            await asyncio.sleep(QUEUE_DEPTH_INTERVAL)
+
+    async def _stage(self, inbox, work, workers):
+        async def worker():
+            while True:
+                job = await inbox.get()
+                try:
+                    await work(job)
+                except Exception as e:
+                    failure = classify(e)
+                    if failure.reason == "error":
+                        logger.error(f"Unhandled error while processing {job.file_path}: {e}", exc_info=True)
+                    else:
+                        logger.warning(f"No result for {job.file_path}: {failure}")
+                    await self._fail(job, failure)
+                finally:
+                    inbox.task_done()
+        await asyncio.gather(*(worker() for _ in range(workers)))
+
+    # --- Stages ---
+    async def _read(self, job):
+        message = json.loads(job.message.body.decode())
+        job.file_path = message.get("file_path")
+        logger.info(f"📄 Received task for {job.handler.name} label: {job.file_path}")
+        record_queue_latency(job.handler.name, job.message, message)
+        job.file_path, job.local_path = await self.loop.run_in_executor(None, task_file, message)
+        stored, job.file_hash = await self.loop.run_in_executor(
+            None, ledger_lookup, self.sink, job.handler.name, job.message, job.local_path)
+        if stored is not None:
+            logger.info(f"♻️ {job.file_path} was already processed; acking with the stored result.")
+            handle_extracted_data(job.handler.name, job.file_path, stored)
+            await self._finish(job, "duplicate")
+            return
+        await self.extract_q.put(job)
+
+    async def _extract(self, job):
+        handler = job.handler
+        if await self.loop.run_in_executor(None, should_split, job.local_path, handler):
+            await self._extract_split(job)
+            return
+        # Barcodes first: when they answer the label, neither OCR nor Gemini runs
+        job.data = await self.loop.run_in_executor(None, self.extractors[handler.name].barcode_answer, job.local_path)
+        if job.data is not None:
+            handle_extracted_data(handler.name, job.file_path, job.data)
+            await self.persist_q.put(job)
+            return
+        read = functools.partial(read_label_text, job.local_path, ocr_fallback=handler.ocr_fallback,
+                                 stop_when=handler.ocr_stop_when)
+        job.text = await self.loop.run_in_executor(self.cpu_pool, read) or ""
+        await self.llm_q.put(job)
+
+    # Multi-label file: split and extracted in a default-executor thread, the
+    # labels' Gemini calls fan out over the LLM threads (see label_splitter.py)
+    async def _extract_split(self, job):
+        extractor = self.extractors[job.handler.name]
+        split = functools.partial(extract_split_file, job.local_path, job.handler, extractor.process,
+                                  job.message.message_id or job.file_hash or job.file_path,
+                                  submit=self.llm_pool.submit, final=last_attempt(job.message), source=job.file_path)
+        try:
+            job.data = await self.loop.run_in_executor(None, split)
+        except GeminiUnavailable as e:
+            logger.warning(f"Requeueing {job.file_path}: {e}")
+            await self._finish(job, "requeued", requeue=True)
+            return
+        handle_extracted_data(job.handler.name, job.file_path, job.data)
+        if not job.data:
+            raise LabelFailure("extraction_failed", retryable=True)
+        await self.persist_q.put(job)
+
+    async def _llm(self, job):
+        extractor = self.extractors[job.handler.name]
+        try:
+            job.data = await self.loop.run_in_executor(self.llm_pool, extractor.process, job.text, job.local_path)
+        except GeminiUnavailable as e:
+            logger.warning(f"Requeueing {job.file_path}: {e}")
+            await self._finish(job, "requeued", requeue=True)
+            return
+        handle_extracted_data(job.handler.name, job.file_path, job.data)
+        if not job.data and not job.text.strip():
+            # No text and no barcodes: nothing a retry could read
+            raise LabelFailure("unreadable", retryable=False, detail="no text after pypdf and OCR, no barcodes")
+        if not job.data:
+            raise LabelFailure("extraction_failed", retryable=True)
+        await self.persist_q.put(job)
+
+    async def _persist(self, job):
+        self.unsettled += 1
+        if self.sink is None:
+            await self._settle(job, True)
+            return
+        # The sink commits on its own thread; settle back on the loop once the batch is durable
+        def on_done(ok):
+            asyncio.run_coroutine_threadsafe(self._settle(job, ok), self.loop)
+        self.sink.submit(job.handler.name, job.file_path, job.data, on_done=on_done,
+                         message_id=job.message.message_id, file_hash=job.file_hash,
+                         children=split_children(job.file_path, job.data))
+
+    async def _settle(self, job, ok):
+        self.unsettled -= 1
+        if ok:
+            await self._finish(job, "processed")
+        else:
+            await self._finish(job, "requeued", requeue=True)
+        logger.debug(f"Settled {job.file_path} in {(time.perf_counter() - job.started) * 1000:.0f} ms")
+
+    # Publish to the next retry tier or the dead-letter queue, then ack the original
+    async def _fail(self, job, exc):
+        failure = classify(exc)
+        routing_key, outcome = next_destination(job.handler.queue, job.message, failure)
+        try:
+            await self.channels[job.handler.name].default_exchange.publish(aio_pika.Message(
+                job.message.body, headers=failure_headers(job.message, failure),
+                message_id=job.message.message_id, content_type=job.message.content_type or "application/json",
+                priority=job.message.priority, delivery_mode=aio_pika.DeliveryMode.PERSISTENT),
+                routing_key=routing_key)
+        except Exception as e:
+            logger.error(f"Cannot move {job.file_path} to {routing_key}: {e}; requeueing.")
+            await self._finish(job, "requeued", requeue=True)
+            return
+        logger.warning(f"{job.file_path} -> {routing_key} ({outcome}): {failure}")
+        await self._finish(job, outcome)
+
+    async def _finish(self, job, outcome, requeue=False):
+        if requeue:
+            await job.message.nack(requeue=True)
+        else:
+            await job.message.ack()
+        IN_FLIGHT.labels(job.handler.name).dec()
+        MESSAGES.labels(job.handler.name, outcome).inc()
+        LABEL_SECONDS.labels(job.handler.name).observe(time.perf_counter() - job.started)
+        if job.handler.name in self.schedulers:
+            for rejected in self.schedulers[job.handler.name].done():
+                await rejected.message.nack(requeue=True)
+
+    async def stop(self, timeout=30):
+        for task in self.consumer_tasks:
+            task.cancel()
+        await asyncio.gather(*self.consumer_tasks, return_exceptions=True)
+        # Deliveries still waiting for a slot go back to the broker
+        for scheduler in self.schedulers.values():
+            for job in scheduler.close():
+                await job.message.nack(requeue=True)
+        # Drain in-flight work stage by stage, then wait for the last acks
+        for inbox in (self.read_q, self.extract_q, self.llm_q, self.persist_q):
+            await inbox.join()
+        if self.sink:
+            await self.loop.run_in_executor(None, self.sink.close)
+        deadline = time.monotonic() + timeout
+        while self.unsettled and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for task in self.stage_tasks:
+            task.cancel()
+        for extractor in self.extractors.values():
+            extractor.shutdown()
+        self.llm_pool.shutdown(wait=True)
+        if self.cpu_pool:
+            self.cpu_pool.shutdown(wait=True)
+        if self.connection:
+            await self.connection.close()
+        logger.info(f"Extraction cache stats: {extraction_cache.stats()}")
+        logger.info(f"Model tiering stats: {tiering_stats()}")
+        logger.info(f"Prompt reduction stats: {reduction_stats()}")
+        logger.info(f"Barcode stats: {barcode_stats()}")
+        logger.info(f"Blob cache stats: {blob_cache.stats}")
+        logger.info(f"Scheduler stats: { {name: s.stats() for name, s in self.schedulers.items()} }")
+
+
+# --- Entry Point ---
+async def run(label_types):
+    timer = StartupTimer()
+    timer.mark("imports", IMPORT_START)
+    pipeline = AsyncLabelPipeline(get_handlers(label_types))
+    start_metrics_server()
+    profiler = start_profiler()
+    # SIGTERM (from supervisor.py) stops it like Ctrl+C: no new deliveries, in-flight labels are acked
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    try:
+        loop.add_signal_handler(signal.SIGTERM, stopping.set)
+    except NotImplementedError:  # Windows: CTRL_BREAK_EVENT arrives as SIGBREAK
+        signal.signal(signal.SIGBREAK, lambda signum, frame: loop.call_soon_threadsafe(stopping.set))
+    try:
+        await pipeline.start(timer)
+        await stopping.wait()
+    finally:
+        await pipeline.stop()
+        if profiler:
+            profiler.stop()
+        logger.info("Async pipeline stopped.")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Async (aio-pika) label processing pipeline")
+    parser.add_argument("label_types", nargs="*", help="label types to consume (default: all)")
+    parser.add_argument("--check", action="store_true",
+                        help="report each dependency's availability and exit without consuming")
+    parser.add_argument("--json", action="store_true", help="with --check: print the report as JSON")
+    args = parser.parse_args(argv)
+    if args.check:
+        sys.exit(print_checks(run_checks(get_handlers(args.label_types), MESSAGE_QUEUE_HOST), as_json=args.json))
+    try:
+        asyncio.run(run(args.label_types))
+    except KeyboardInterrupt:
+        logger.info("KeyboardInterrupt received. Exiting.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+import os
+import re
+import json
+import logging
+import threading
+from urllib.parse import urlparse, parse_qsl
+from dotenv import load_dotenv  # type: ignore
+
+from label_handlers import NOT_FOUND
+from metrics import stage_timer, BARCODE_CHECKS
+
+# Couriers print the tracking number as a Code128 barcode, often with a QR
+# code carrying the order as well. Decoding them is exact (the symbols have
+# checksums) and takes milliseconds, where OCR and Gemini read the same value
+# back from pixels. Steps:
+#   decode     symbols in the images embedded in the PDF (pypdf, no rendering):
+#              scans and raster barcodes; only the first BARCODE_MAX_PAGES
+#              pages, or the pages of one label of a split file. Vector
+#              barcodes need BARCODE_SOURCE=auto (render at BARCODE_DPI when
+#              nothing embedded decodes) or render, which costs a Poppler
+#              render per page even for labels pypdf reads on its own
+#   fields     plain values matching the handler's barcode_fields patterns,
+#              and structured payloads (JSON, key=value pairs, URL query)
+#              whose keys name a field (FIELD_ALIASES)
+#   reconcile  fills fields the extraction missed; a different extracted
+#              value is replaced by the barcode's (BARCODE_OVERRIDE) and logged
+#   skip       with BARCODE_SKIP_LLM, a label whose BARCODE_SKIP_LLM_FIELDS all
+#              decode is answered before text extraction, without OCR or
+#              Gemini, other fields "Not found"; a label without any text is
+#              answered with whatever its barcodes give
+# Decoders: zxing-cpp (pip install zxing-cpp) or pyzbar (needs the zbar
+# library). Without either the stage does nothing.
+
+load_dotenv()
+
+# --- Config ---
+BARCODE_ENABLED = os.getenv("BARCODE_ENABLED", "true").lower() in ("1", "true", "yes")
+BARCODE_DECODER = os.getenv("BARCODE_DECODER", "auto").lower()  # auto | zxingcpp | pyzbar
+BARCODE_SOURCE = os.getenv("BARCODE_SOURCE", "embedded").lower()  # embedded | auto | render
+BARCODE_DPI = int(os.getenv("BARCODE_DPI", "200"))
+BARCODE_MAX_PAGES = int(os.getenv("BARCODE_MAX_PAGES", "2"))
+BARCODE_MIN_IMAGE_PX = int(os.getenv("BARCODE_MIN_IMAGE_PX", "40"))  # smaller embedded images are logos/icons
+BARCODE_OVERRIDE = os.getenv("BARCODE_OVERRIDE", "true").lower() in ("1", "true", "yes")
+BARCODE_SKIP_LLM = os.getenv("BARCODE_SKIP_LLM", "false").lower() in ("1", "true", "yes")
+BARCODE_SKIP_LLM_FIELDS = [f.strip() for f in os.getenv("BARCODE_SKIP_LLM_FIELDS", "tracking_number").split(",")
+                           if f.strip()]
+
+logger = logging.getLogger(__name__)
+
+# Payload keys naming a field, compared without case, spaces or punctuation
+FIELD_ALIASES = {
+    "tracking_number": ("tracking_number", "tracking", "tracking_no", "tracking_id", "awb", "waybill",
+                        "waybill_no", "ma_van_don", "mvd"),
+    "order_id": ("order_id", "order", "order_no", "order_sn", "ordersn", "ma_don_hang"),
+    "return_id": ("return_id", "rma", "return_no"),
+}
+
+
+def _key(name):
+    return re.sub(r"[^a-z0-9]", "", name.lower())
+
+
+_ALIAS_FIELDS = {_key(alias): field for field, aliases in FIELD_ALIASES.items() for alias in aliases}
+
+
+# --- Decoders, loaded on first use ---
+_decoder_lock = threading.Lock()
+_decoder = []  # [decode function or None] once loaded
+
+
+def _zxingcpp_decoder():
+    import zxingcpp  # type: ignore
+
+    def decode(image):
+        return [(str(result.format), result.text) for result in zxingcpp.read_barcodes(image)]
+    return decode
+
+
+def _pyzbar_decoder():
+    from pyzbar import pyzbar  # type: ignore  # ImportError when the zbar library is missing
+
+    def decode(image):
+        return [(symbol.type, symbol.data.decode("utf-8", "replace")) for symbol in pyzbar.decode(image)]
+    return decode
+
+
+# image (PIL) -> [(format, text)], or None without a decoder
+def decoder():
+    if not _decoder:
+        with _decoder_lock:
+            if not _decoder:
+                loaders = {"zxingcpp": _zxingcpp_decoder, "pyzbar": _pyzbar_decoder}
+                names = [BARCODE_DECODER] if BARCODE_DECODER in loaders else list(loaders)
+                decode = None
+                for name in names:
+                    try:
+                        decode = loaders[name]()
+                        logger.info(f"Barcode decoder: {name}")
+                        break
+                    except ImportError as e:
+                        logger.debug(f"Barcode decoder {name} unavailable: {e}")
+                if decode is None:
+                    logger.warning("No barcode decoder installed (pip install zxing-cpp); barcode stage disabled.")
+                _decoder.append(decode)
+    return _decoder[0]
+
+
+# --- Decoding ---
+def _decode_all(decode, images, page_number):
+    symbols = []
+    for image in images:
+        try:
+            symbols.extend({"format": fmt, "text": text.strip(), "page": page_number}
+                           for fmt, text in decode(image) if text and text.strip())
+        except Exception as e:
+            logger.debug(f"Barcode decoding failed on page {page_number}: {e}")
+    return symbols
+
+
+def _embedded_images(reader, page_number):
+    for embedded in reader.pages[page_number - 1].images:
+        try:
+            image = embedded.image
+        except Exception as e:  # unsupported filters, broken streams
+            logger.debug(f"Cannot read an embedded image on page {page_number}: {e}")
+            continue
+        if image is not None and min(image.size) >= BARCODE_MIN_IMAGE_PX:
+            yield image
+
+
+def _rendered_page(pdf_path, page_number, dpi):
+    from ocr_stage import ocr_backend, POPPLER_PATH
+    convert_from_path, _, _ = ocr_backend()
+    return convert_from_path(pdf_path, dpi=dpi, first_page=page_number, last_page=page_number,
+                             grayscale=True, poppler_path=POPPLER_PATH or None)
+
+
+# Symbols on the given pages (default: the first BARCODE_MAX_PAGES) as
+# [{"format", "text", "page"}]; empty when nothing decodes or no decoder is installed
+def read_barcodes(pdf_path, pages=None, source=BARCODE_SOURCE, dpi=BARCODE_DPI):
+    decode = decoder() if BARCODE_ENABLED else None
+    if decode is None:
+        return []
+    from pypdf import PdfReader  # imported on first use, see startup.py
+    with stage_timer("barcode_decode"):
+        try:
+            reader = PdfReader(pdf_path)
+            total = len(reader.pages)
+        except Exception as e:
+            logger.warning(f"Cannot open {pdf_path} for barcode decoding: {e}")
+            return []
+        pages = [n for n in (pages or range(1, BARCODE_MAX_PAGES + 1)) if 1 <= n <= total]
+        symbols = []
+        if source in ("auto", "embedded"):
+            for n in pages:
+                symbols.extend(_decode_all(decode, _embedded_images(reader, n), n))
+        if not symbols and source in ("auto", "render"):
+            for n in pages:
+                try:
+                    symbols.extend(_decode_all(decode, _rendered_page(pdf_path, n, dpi), n))
+                except Exception as e:
+                    logger.warning(f"Cannot render page {n} of {pdf_path} for barcode decoding: {e}")
+                    break
+    return symbols
+
+
+# --- Fields ---
+# {key: value} of a structured payload naming at least one known field, else None
+def parse_payload(text):
+    pairs = None
+    if text.startswith("{"):
+        try:
+            loaded = json.loads(text)
+            pairs = loaded.items() if isinstance(loaded, dict) else None
+        except ValueError:
+            pairs = None
+    elif "://" in text:
+        pairs = parse_qsl(urlparse(text).query)
+    elif re.search(r"[=:]", text):
+        pairs = [re.split(r"\s*[=:]\s*", part, maxsplit=1) for part in re.split(r"[;|&\n]", text)]
+        pairs = [pair for pair in pairs if len(pair) == 2]
+    if not pairs:
+        return None
+    payload = {str(key): str(value).strip() for key, value in pairs if value is not None and str(value).strip()}
+    return payload if any(_key(key) in _ALIAS_FIELDS for key in payload) else None
+
+
+def _compact(value):
+    return re.sub(r"[\s.-]", "", str(value)).upper()
+
+
+# {field: value} from decoded symbols. patterns: the handler's barcode_fields
+# ({field: regex} for plain values). When several symbols give different
+# values for one field (several labels on a page), the one that also
+# appears in `text` wins; if none or several do, the field is left out.
+def barcode_fields(symbols, patterns, text=""):
+    candidates = {field: [] for field in patterns}
+    for symbol in symbols:
+        payload = parse_payload(symbol["text"])
+        if payload is not None:
+            found = [(_ALIAS_FIELDS.get(_key(key)), value) for key, value in payload.items()]
+        else:
+            value = _compact(symbol["text"])
+            found = [(next((f for f, p in patterns.items() if p.fullmatch(value)), None), value)]
+        for field, value in found:
+            if field in candidates and value not in candidates[field]:
+                candidates[field].append(value)
+
+    compact_text = _compact(text)
+    fields = {}
+    for field, values in candidates.items():
+        if len(values) > 1:
+            values = [value for value in values if _compact(value) in compact_text]
+        if len(values) == 1:
+            fields[field] = values[0]
+        elif values:
+            logger.debug(f"Ambiguous barcode values for {field}: {values}")
+    return fields
+
+
+# --- Cross-check ---
+_stats = {"labels": 0, "decoded": 0, "skipped_llm": 0, "filled": 0, "match": 0, "mismatch": 0}
+_stats_lock = threading.Lock()
+
+
+def _count(**counts):
+    with _stats_lock:
+        for name, amount in counts.items():
+            _stats[name] += amount
+
+
+def record_decode(barcodes):
+    _count(labels=1, decoded=1 if barcodes else 0)
+
+
+def can_skip_llm(barcodes, required=None):
+    required = BARCODE_SKIP_LLM_FIELDS if required is None else required
+    if BARCODE_SKIP_LLM and barcodes and all(field in barcodes for field in required):
+        _count(skipped_llm=1)
+        return True
+    return False
+
+
+# Copy of data with the barcode values filled in or, on disagreement and
+# with override, replacing the extracted value
+def reconcile(label_name, data, barcodes, override=BARCODE_OVERRIDE):
+    if not data or not barcodes:
+        return data
+    data = dict(data)
+    for field, value in barcodes.items():
+        current = data.get(field, NOT_FOUND)
+        if current == NOT_FOUND:
+            outcome = "filled"
+            data[field] = value
+        elif _compact(current) == _compact(value):
+            outcome = "match"
+        else:
+            outcome = "mismatch"
+            logger.warning(f"Barcode {field} '{value}' differs from the extracted '{current}'"
+                           f"{'; using the barcode' if override else ''}.")
+            if override:
+                data[field] = value
+        BARCODE_CHECKS.labels(label_name, field, outcome).inc()
+        _count(**{outcome: 1})
+    return data
+
+
+def barcode_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    checked = stats["match"] + stats["mismatch"]
+    stats["decode_rate"] = round(stats["decoded"] / stats["labels"], 3) if stats["labels"] else 0.0
+    stats["agreement"] = round(stats["match"] / checked, 3) if checked else None
+    return stats
@@ -0,0 +1,137 @@
+import os
+import json
+import time
+import random
+import tempfile
+import argparse
+import threading
+from types import SimpleNamespace
+
+from synthetic_labels import generate_corpus, load_manifest
+from benchmark_pipeline import percentile, run_isolated
+
+# Scheduling benchmark: a merchant's bulk dump lands in the shipping queue,
+# then a second merchant's labels and a trickle of same-day labels arrive
+# behind it. Reports each tenant's publish -> ack latency per configuration
+# (label_agent.LabelAgent on the in-process broker, fake Gemini):
+#   fifo       plain queue, deliveries started in arrival order
+#   priority   x-max-priority queue: same-day labels overtake the dump
+#   fair       + weighted fair scheduling across tenants (fair_scheduler.py)
+#   python benchmark_fairness.py --bulk 200 --others 20 --urgent 10 --concurrency 4
+#   python benchmark_fairness.py --set TENANT_WEIGHTS=merchant-b=3
+
+EXCHANGE_NAME = "label_tasks"
+CONFIGS = {
+    "fifo": {"PRIORITY_QUEUES": "false", "FAIR_SCHEDULING": "false"},
+    "priority": {"PRIORITY_QUEUES": "true", "FAIR_SCHEDULING": "false"},
+    "fair": {"PRIORITY_QUEUES": "true", "FAIR_SCHEDULING": "true"},
+}
+
+
+# --- One configuration (runs in its own process) ---
+def run_one(config):
+    from local_broker import LocalBroker
+    from fake_gemini import FakeGeminiModel
+    from label_handlers import SHIPPING_HANDLER
+    from label_agent import LabelAgent
+    from fair_scheduler import task_properties
+
+    manifest = load_manifest(config["corpus"])
+    model = FakeGeminiModel(latency_ms=config["latency_ms"], jitter_ms=config["jitter_ms"])
+    broker = LocalBroker()
+    connection = broker.connection()
+    latencies = {}
+
+    def on_settle(body, acked):
+        if acked:
+            message = json.loads(body)
+            latencies.setdefault(message["tenant"], []).append(time.perf_counter() - message["published_at"])
+    broker.on_settle = on_settle
+
+    SHIPPING_HANDLER.concurrency = config["concurrency"]
+    agent = LabelAgent([SHIPPING_HANDLER], connection, model=model)
+    agent.start()
+
+    count = [0]
+
+    def publish(tenant, priority):
+        entry = manifest[count[0] % len(manifest)]
+        count[0] += 1
+        message = {"file_path": entry["file_path"], "tenant": tenant, "priority": priority,
+                   "published_at": time.perf_counter()}
+        properties = SimpleNamespace(**task_properties(message))
+        broker.publish(EXCHANGE_NAME, SHIPPING_HANDLER.routing_key, json.dumps(message), properties)
+
+    # The dump first, then the others spread over the time the dump takes to drain
+    def producer():
+        for _ in range(config["bulk"]):
+            publish("bulk-merchant", "normal")
+        later = ["same-day"] * config["urgent"] + ["merchant-b"] * config["others"]
+        random.Random(1).shuffle(later)
+        for tenant in later:
+            time.sleep(config["spread_s"] / len(later))
+            publish(tenant, "urgent" if tenant == "same-day" else "normal")
+
+    total = config["bulk"] + config["others"] + config["urgent"]
+    start = time.perf_counter()
+    threading.Thread(target=producer, daemon=True).start()
+    while sum(len(v) for v in latencies.values()) < total:
+        connection.process_data_events(time_limit=0.01)
+    elapsed = time.perf_counter() - start
+    agent.stop()
+
+    return {
+        "config": config["config"], "labels": total, "labels_per_sec": round(total / elapsed, 2),
+        "tenants": {tenant: {"labels": len(values), "p50_ms": round(percentile(values, 50) * 1000),
+                             "p95_ms": round(percentile(values, 95) * 1000)}
+                    for tenant, values in sorted(latencies.items())},
+    }
+
+
+# --- Driver ---
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-tenant latency under a bulk dump")
+    parser.add_argument("--corpus", default="bench_corpus", help="directory with PDFs and manifest.json")
+    parser.add_argument("--generate", type=int, default=0, help="(re)generate a corpus of this many labels first")
+    parser.add_argument("--bulk", type=int, default=200, help="labels in the bulk merchant's dump")
+    parser.add_argument("--others", type=int, default=20, help="labels of a second merchant, after the dump")
+    parser.add_argument("--urgent", type=int, default=10, help="same-day labels (priority urgent), after the dump")
+    parser.add_argument("--spread", type=float, default=5, help="seconds over which the later labels arrive")
+    parser.add_argument("--concurrency", type=int, default=4, help="shipping labels in flight")
+    parser.add_argument("--latency-ms", type=float, default=200, help="fake Gemini base latency")
+    parser.add_argument("--jitter-ms", type=float, default=50, help="fake Gemini extra latency, 0..jitter")
+    parser.add_argument("--configs", nargs="+", default=list(CONFIGS), help=f"any of {', '.join(CONFIGS)}")
+    parser.add_argument("--set", nargs="*", default=[], metavar="KEY=VALUE", help="extra settings for every config")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--run-one", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_one:
+        print(json.dumps(run_one(json.loads(args.run_one))))
+        return
+
+    if args.generate:
+        generate_corpus(args.corpus, args.generate)
+    corpus = os.path.abspath(args.corpus)
+    overrides = dict(item.split("=", 1) for item in args.set)
+
+    results = []
+    print(f"{'config':>10} {'labels/s':>9}  {'tenant':<14} {'labels':>6} {'p50 ms':>8} {'p95 ms':>8}")
+    for name in args.configs:
+        with tempfile.TemporaryDirectory(prefix="bench_") as workdir:
+            config = {"config": name, "corpus": corpus, "bulk": args.bulk, "others": args.others,
+                      "urgent": args.urgent, "spread_s": args.spread, "concurrency": args.concurrency,
+                      "latency_ms": args.latency_ms, "jitter_ms": args.jitter_ms, "cache": False,
+                      "results_db": os.path.join(workdir, "results.sqlite3")}
+            r = run_isolated(config, workdir, script=__file__, overrides={**CONFIGS.get(name, {}), **overrides})
+        results.append(r)
+        for i, (tenant, t) in enumerate(r["tenants"].items()):
+            head = f"{r['config']:>10} {r['labels_per_sec']:>9.2f}" if i == 0 else " " * 20
+            print(f"{head}  {tenant:<14} {t['labels']:>6} {t['p50_ms']:>8} {t['p95_ms']:>8}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
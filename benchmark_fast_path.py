@@ -0,0 +1,83 @@
+import sys
+import time
+import random
+import argparse
+import logging
+
+import fast_path
+
+# Latency/cost benchmark for the rule-based fast path.
+# Runs a mixed set of synthetic label texts through "fast path, then stubbed
+# Gemini" and through "stubbed Gemini only", and compares the two:
+#   python benchmark_fast_path.py --labels 500 --spx-share 0.7
+
+logging.basicConfig(level=logging.WARNING, stream=sys.stdout)
+
+SPX_LABEL = """Shopee Xpress
+Mã vận đơn: SPXVM{tracking:09d}
+Từ: Nguyen Van A
+0901234567
+12 Le Loi, Q1, TP HCM
+Đến: Tran Thi B
+0912345678
+34 Tran Hung Dao, Ha Noi
+Mã đơn hàng: {order}PMADJ01
+Khối lượng: 500g"""
+
+# Partial layout: no order id, so the fast path must hand it to Gemini
+OTHER_LABEL = """Giao hang nhanh
+Ma: {tracking:09d}
+Nguoi gui Nguyen Van C, 0987654321, 56 Hai Ba Trung, Da Nang
+Nguoi nhan Le Van D, 0934567890, 78 Nguyen Hue, Hue"""
+
+
+def make_corpus(labels, spx_share, seed=42):
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(labels):
+        template = SPX_LABEL if rng.random() < spx_share else OTHER_LABEL
+        corpus.append(template.format(tracking=rng.randrange(10**9), order=rng.randrange(10**6)))
+    return corpus
+
+
+def fake_gemini(text, llm_seconds):
+    time.sleep(llm_seconds)
+    return {"tracking_number": "Not found", "order_id": "Not found",
+            "sender_address": "Not found", "recipient_address": "Not found"}
+
+
+def run(corpus, use_fast_path, llm_seconds):
+    latencies, llm_calls = [], 0
+    for text in corpus:
+        start = time.perf_counter()
+        data = None
+        if use_fast_path:
+            data, _ = fast_path.extract_fast(text)
+        if data is None:
+            fake_gemini(text, llm_seconds)
+            llm_calls += 1
+        latencies.append(time.perf_counter() - start)
+    return latencies, llm_calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fast-path latency/cost benchmark")
+    parser.add_argument("--labels", type=int, default=200)
+    parser.add_argument("--spx-share", type=float, default=0.7, help="share of labels in a known layout")
+    parser.add_argument("--llm-seconds", type=float, default=0.05, help="stubbed Gemini latency")
+    parser.add_argument("--cost-per-call", type=float, default=0.0002, help="USD per Gemini call")
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.labels, args.spx_share)
+    print(f"{'mode':>12} {'mean ms':>10} {'p95 ms':>10} {'llm calls':>10} {'cost USD':>10}")
+    for mode, use_fast_path in (("llm only", False), ("fast path", True)):
+        latencies, llm_calls = run(corpus, use_fast_path, args.llm_seconds)
+        latencies.sort()
+        mean_ms = 1000 * sum(latencies) / len(latencies)
+        p95_ms = 1000 * latencies[int(0.95 * (len(latencies) - 1))]
+        print(f"{mode:>12} {mean_ms:>10.2f} {p95_ms:>10.2f} {llm_calls:>10} {llm_calls * args.cost_per_call:>10.4f}")
+    print(f"Template stats: {fast_path.template_stats()}")
+
+
+if __name__ == "__main__":
+    main()
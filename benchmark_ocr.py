@@ -0,0 +1,122 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import unicodedata
+
+from synthetic_labels import generate_corpus, load_manifest
+from benchmark_pipeline import percentile
+
+# OCR benchmark: time per page and field accuracy of the OCR stage on the
+# image-only PDFs of a synthetic corpus, one configuration per process
+# (the OCR settings are read at import time):
+#   raw          rendered page straight to pytesseract, Tesseract's default PSM/OEM
+#   preprocess   + ocr_preprocess.py (deskew, crop, barcode mask, binarize)
+#   tuned        + OCR_PSM/OCR_OEM defaults (4, LSTM only)
+#   tesserocr    + persistent Tesseract instances instead of a subprocess per page
+#   python benchmark_ocr.py --generate 40 --scan-noise 0.01
+#   python benchmark_ocr.py --configs raw tuned --set OCR_RENDER_DPI=300
+# A field counts as found when every comma-separated part of the value printed
+# on the label appears in the OCR text (case, spaces and accents ignored).
+
+CONFIGS = {
+    "raw": {"OCR_PREPROCESS": "false", "OCR_ENGINE": "pytesseract", "OCR_PSM": "3", "OCR_OEM": "3"},
+    "preprocess": {"OCR_PREPROCESS": "true", "OCR_ENGINE": "pytesseract", "OCR_PSM": "3", "OCR_OEM": "3"},
+    "tuned": {"OCR_PREPROCESS": "true", "OCR_ENGINE": "pytesseract"},
+    "tesserocr": {"OCR_PREPROCESS": "true", "OCR_ENGINE": "tesserocr"},
+}
+
+
+def normalize(text):
+    text = unicodedata.normalize("NFKD", text.replace("đ", "d").replace("Đ", "D"))
+    return "".join(c for c in text if c.isalnum() and not unicodedata.combining(c)).lower()
+
+
+def field_found(value, text):
+    return all(normalize(part) in text for part in value.split(",") if normalize(part))
+
+
+# --- One configuration (runs in its own process) ---
+def run_one(config):
+    from ocr_stage import ocr_pages, ocr_backend
+    ocr_backend()  # imports and Tesseract setup are not part of the page times
+
+    manifest = [m for m in load_manifest(config["corpus"]) if m["kind"] == "image"][:config["labels"]]
+    page_ms, found, tracking = [], 0, 0
+    fields = 0
+    for entry in manifest:
+        pages = range(1, min(entry["pages"], config["max_pages"]) + 1)
+        timings = {}
+        texts = ocr_pages(entry["file_path"], pages, threads=config["threads"], timings=timings)
+        page_ms.extend(timings.values())
+        text = normalize("\n".join(texts[n] for n in sorted(texts)))
+        for name, value in entry["fields"].items():
+            fields += 1
+            if field_found(value, text):
+                found += 1
+                tracking += name == "tracking_number"
+    return {
+        "config": config["config"], "labels": len(manifest), "pages": len(page_ms),
+        "p50_ms": round(percentile(page_ms, 50)), "p95_ms": round(percentile(page_ms, 95)),
+        "mean_ms": round(sum(page_ms) / len(page_ms)) if page_ms else None,
+        "field_accuracy": round(found / fields, 3) if fields else None,
+        "tracking_accuracy": round(tracking / len(manifest), 3) if manifest else None,
+    }
+
+
+# --- Driver ---
+def run_isolated(config, overrides):
+    env = dict(os.environ)
+    env.update(CONFIGS.get(config["config"], {}))
+    env.update(overrides)
+    env.update({"METRICS_PORT": "0", "LOG_LEVEL": env.get("LOG_LEVEL", "WARNING")})
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), "--run-one", json.dumps(config)],
+                            env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"{config['config']} failed:\n{result.stderr[-2000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="OCR time per page and field accuracy")
+    parser.add_argument("--corpus", default="ocr_corpus", help="directory with PDFs and manifest.json")
+    parser.add_argument("--generate", type=int, default=0, help="(re)generate an image-only corpus of this many labels")
+    parser.add_argument("--scan-noise", type=float, default=0.01, help="with --generate: share of speckled pixels")
+    parser.add_argument("--labels", type=int, default=40, help="image-only labels to OCR")
+    parser.add_argument("--max-pages", type=int, default=2, help="pages OCR'd per label")
+    parser.add_argument("--threads", type=int, default=1, help="OCR threads (1: clean per-page times)")
+    parser.add_argument("--configs", nargs="+", default=list(CONFIGS), help=f"any of {', '.join(CONFIGS)}")
+    parser.add_argument("--set", nargs="*", default=[], metavar="KEY=VALUE", help="extra settings for every config")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--run-one", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_one:
+        print(json.dumps(run_one(json.loads(args.run_one))))
+        return
+
+    if args.generate:
+        generate_corpus(args.corpus, args.generate, image_share=1.0, max_pages=3, scan_noise=args.scan_noise)
+    corpus = os.path.abspath(args.corpus)
+    overrides = dict(item.split("=", 1) for item in args.set)
+
+    results = []
+    print(f"{'config':>12} {'pages':>6} {'p50 ms':>8} {'p95 ms':>8} {'mean ms':>8} {'fields':>7} {'tracking':>9}")
+    for name in args.configs:
+        config = {"config": name, "corpus": corpus, "labels": args.labels, "max_pages": args.max_pages,
+                  "threads": args.threads}
+        start = time.perf_counter()
+        r = run_isolated(config, overrides)
+        r["seconds"] = round(time.perf_counter() - start, 2)
+        results.append(r)
+        print(f"{r['config']:>12} {r['pages']:>6} {r['p50_ms']:>8} {r['p95_ms']:>8} {r['mean_ms'] or '-':>8} "
+              f"{r['field_accuracy'] or '-':>7} {r['tracking_accuracy'] or '-':>9}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import tempfile
+import argparse
+import threading
+import subprocess
+
+from synthetic_labels import generate_corpus, load_manifest
+
+# Offline replay benchmark for the whole label pipeline: real pypdf/OCR on a
+# synthetic PDF corpus, the in-process broker stand-in and a deterministic
+# fake Gemini, so it needs neither RabbitMQ nor an API key.
+# Each configuration runs in a fresh process (clean caches, own peak RSS):
+#   callback   shipping_processorr.callback, one label at a time
+#   agent:N    label_agent.LabelAgent with N concurrent shipping labels
+#   python benchmark_pipeline.py --generate 40 --labels 200 --configs callback agent:4 agent:16
+#   python benchmark_pipeline.py --rate 5 --latency-ms 1200 --json results.json
+#   python benchmark_pipeline.py --payload ref   # PDFs through a blob store instead of paths
+# Latency is publish -> ack. With --rate 0 everything is published up front,
+# so it includes queueing; --rate N publishes N labels/s instead.
+
+EXCHANGE_NAME = "label_tasks"
+
+
+def percentile(values, q):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(q / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        try:
+            import psutil  # type: ignore
+            return psutil.Process().memory_info().peak_wset / 2**20, None
+        except (ImportError, AttributeError):
+            return None, None
+    scale = 1 if sys.platform == "darwin" else 1024  # ru_maxrss: bytes on macOS, KiB elsewhere
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2**20
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale / 2**20
+    return own, children
+
+
+# --- One configuration (runs in its own process) ---
+def run_one(config):
+    from local_broker import LocalBroker
+    from fake_gemini import FakeGeminiModel
+    from label_handlers import SHIPPING_HANDLER
+
+    manifest = load_manifest(config["corpus"])
+    labels = config["labels"]
+    model = FakeGeminiModel(latency_ms=config["latency_ms"], jitter_ms=config["jitter_ms"],
+                            error_rate=config["error_rate"])
+    broker = LocalBroker()
+    connection = broker.connection()
+    latencies = []
+    requeued = [0]
+
+    def on_settle(body, acked):
+        if acked:
+            latencies.append(time.perf_counter() - json.loads(body)["published_at"])
+        else:
+            requeued[0] += 1
+    broker.on_settle = on_settle
+
+    mode, _, concurrency = config["config"].partition(":")
+    agent = None
+    if mode == "callback":
+        import shipping_processorr
+        from label_pipeline import LabelExtractor
+        from results_sink import open_sink
+        shipping_processorr.shipping_extractor = LabelExtractor(SHIPPING_HANDLER, model)
+        shipping_processorr.results_sink = open_sink(batch_size=1)  # as main() opens it for prefetch 1
+        channel = connection.channel()
+        channel.queue_declare(queue=SHIPPING_HANDLER.queue, durable=True)
+        channel.basic_qos(prefetch_count=1)
+        channel.basic_consume(queue=SHIPPING_HANDLER.queue, on_message_callback=shipping_processorr.callback)
+        exchange, routing_key = "", SHIPPING_HANDLER.queue
+    elif mode == "agent":
+        from label_agent import LabelAgent
+        SHIPPING_HANDLER.concurrency = int(concurrency or SHIPPING_HANDLER.concurrency)
+        agent = LabelAgent([SHIPPING_HANDLER], connection, model=model)
+        agent.start()
+        exchange, routing_key = EXCHANGE_NAME, SHIPPING_HANDLER.routing_key
+    else:
+        raise ValueError(f"Unknown configuration: {config['config']}")
+
+    payloads = {}
+    if config["payload"] != "path":
+        # Built once per file, as a producer would; consumers resolve them through the blob cache
+        from task_payload import build_payload, open_store
+        store = open_store()
+        for entry in manifest[:labels]:
+            payloads[entry["file_path"]] = build_payload(entry["file_path"], config["payload"], store)
+
+    def publish():
+        interval = 1 / config["rate"] if config["rate"] else 0
+        for i in range(labels):
+            entry = manifest[i % len(manifest)]
+            message = {"file_path": entry["file_path"], "published_at": time.perf_counter()}
+            if payloads.get(entry["file_path"]):
+                message["payload"] = payloads[entry["file_path"]]
+            body = json.dumps(message)
+            broker.publish(exchange, routing_key, body)
+            if interval:
+                time.sleep(interval)
+
+    start = time.perf_counter()
+    publisher = threading.Thread(target=publish, daemon=True)
+    publisher.start()
+    while len(latencies) < labels:
+        connection.process_data_events(time_limit=0.01)
+    elapsed = time.perf_counter() - start
+    if agent:
+        agent.stop()
+    else:
+        if shipping_processorr.results_sink:
+            shipping_processorr.results_sink.close()
+        shipping_processorr.shipping_extractor.shutdown()
+
+    own_rss, children_rss = peak_rss_mb()
+    return {
+        "config": config["config"], "labels": labels, "seconds": round(elapsed, 2),
+        "labels_per_sec": round(labels / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000), "p95_ms": round(percentile(latencies, 95) * 1000),
+        "p99_ms": round(percentile(latencies, 99) * 1000), "requeued": requeued[0],
+        "peak_rss_mb": round(own_rss, 1) if own_rss else None,
+        "peak_child_rss_mb": round(children_rss, 1) if children_rss else None,
+        "tracking_accuracy": tracking_accuracy(manifest, config["results_db"]),
+    }
+
+
+# Share of stored results whose tracking number matches the one printed on the label
+def tracking_accuracy(manifest, results_db):
+    if not os.path.exists(results_db):
+        return None
+    expected = {m["file_path"]: m["fields"]["tracking_number"] for m in manifest}
+    conn = sqlite3.connect(results_db)
+    rows = conn.execute("SELECT file_path, tracking_number FROM label_results").fetchall()
+    conn.close()
+    if not rows:
+        return None
+    return round(sum(1 for path, tracking in rows if expected.get(path) == tracking) / len(rows), 3)
+
+
+# --- Driver ---
+# Runs config in `script --run-one` (this file by default); overrides: extra environment
+def run_isolated(config, workdir, script=__file__, overrides=None):
+    env = dict(os.environ)
+    # Fresh caches and stores per run; no limiter or metrics server in the way
+    env.update({
+        "CACHE_ENABLED": "true" if config["cache"] else "false",
+        "CACHE_PATH": os.path.join(workdir, "cache.sqlite3"),
+        # The corpus is replayed in cycles; the ledger would ack repeats without processing them
+        "IDEMPOTENCY_ENABLED": "true" if config["cache"] else "false",
+        "RESULTS_DB_PATH": config["results_db"],
+        "LIMITER_DB_PATH": os.path.join(workdir, "limiter.sqlite3"),
+        "GEMINI_RPM": env.get("GEMINI_RPM", "1000000"),
+        "GEMINI_TPM": env.get("GEMINI_TPM", "1000000000"),
+        "METRICS_PORT": "0",
+        "BLOB_STORE_URL": os.path.join(workdir, "blobs"),
+        "BLOB_CACHE_DIR": os.path.join(workdir, "blob_cache"),
+        "LOG_LEVEL": env.get("LOG_LEVEL", "WARNING"),
+    })
+    env.update(overrides or {})
+    result = subprocess.run([sys.executable, os.path.abspath(script), "--run-one", json.dumps(config)],
+                            env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"{config['config']} failed:\n{result.stderr[-2000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline replay benchmark for the label pipeline")
+    parser.add_argument("--corpus", default="bench_corpus", help="directory with PDFs and manifest.json")
+    parser.add_argument("--generate", type=int, default=0, help="(re)generate a corpus of this many labels first")
+    parser.add_argument("--labels", type=int, default=100, help="messages to replay (cycles through the corpus)")
+    parser.add_argument("--configs", nargs="+", default=["callback", "agent:4", "agent:16"])
+    parser.add_argument("--rate", type=float, default=0, help="publish rate in labels/s (0: all at once)")
+    parser.add_argument("--latency-ms", type=float, default=800, help="fake Gemini base latency")
+    parser.add_argument("--jitter-ms", type=float, default=200, help="fake Gemini extra latency, 0..jitter")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of first attempts answered with 429")
+    parser.add_argument("--cache", action="store_true", help="keep the extraction cache and idempotency ledger on")
+    parser.add_argument("--payload", default="path", choices=["path", "inline", "ref", "auto"],
+                        help="how messages carry the PDF (see task_payload.py)")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--run-one", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_one:
+        print(json.dumps(run_one(json.loads(args.run_one))))
+        return
+
+    if args.generate:
+        generate_corpus(args.corpus, args.generate)
+    corpus = os.path.abspath(args.corpus)
+
+    results = []
+    print(f"{'config':>12} {'labels/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'RSS MB':>8} "
+          f"{'child MB':>9} {'accuracy':>9}")
+    for name in args.configs:
+        with tempfile.TemporaryDirectory(prefix="bench_") as workdir:
+            config = {"config": name, "corpus": corpus, "labels": args.labels, "rate": args.rate,
+                      "latency_ms": args.latency_ms, "jitter_ms": args.jitter_ms, "error_rate": args.error_rate,
+                      "cache": args.cache, "payload": args.payload, "results_db": os.path.join(workdir, "results.sqlite3")}
+            r = run_isolated(config, workdir)
+        results.append(r)
+        print(f"{r['config']:>12} {r['labels_per_sec']:>9.2f} {r['p50_ms']:>8} {r['p95_ms']:>8} {r['p99_ms']:>8} "
+              f"{r['peak_rss_mb'] or '-':>8} {r['peak_child_rss_mb'] or '-':>9} {r['tracking_accuracy'] or '-':>9}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import os
+import sys
+import json
+import time
+import tempfile
+import argparse
+import functools
+import logging
+
+from local_broker import LocalBroker
+from worker_pool import LabelWorkerPool
+
+# Throughput benchmark for the worker-pool consumer.
+# Uses the in-process broker stand-in and a stubbed extractor/model, so it
+# needs neither RabbitMQ nor a Gemini API key:
+#   python benchmark_worker_pool.py --labels 200 --concurrency 1 4 8 16
+
+logging.basicConfig(level=logging.WARNING, stream=sys.stdout)
+
+CPU_SECONDS = 0.02
+LLM_SECONDS = 0.5
+
+
+# --- Stubs (module-level so the process pool can pickle them) ---
+def fake_extract(file_path, cpu_seconds=CPU_SECONDS):
+    # Busy loop standing in for pypdf/Tesseract work
+    deadline = time.perf_counter() + cpu_seconds
+    while time.perf_counter() < deadline:
+        pass
+    return f"Mã vận đơn: SPXVM{abs(hash(file_path)) % 10**9:09d}"
+
+
+def fake_llm(text, file_path=None, llm_seconds=LLM_SECONDS):
+    # Sleep standing in for the Gemini round trip
+    time.sleep(llm_seconds)
+    return {"tracking_number": text.split(": ")[-1], "order_id": "Not found",
+            "sender_address": "Not found", "recipient_address": "Not found"}
+
+
+# --- Benchmark run ---
+def run(labels, concurrency, ocr_processes, cpu_seconds, llm_seconds):
+    broker = LocalBroker(stop_when_idle=True)
+    connection = broker.connection()
+    channel = connection.channel()
+    channel.queue_declare(queue='shipping_queue', durable=True)
+    # Placeholder files: the pool checks that each task's file exists (fake_extract never reads them)
+    workdir = tempfile.TemporaryDirectory(prefix="bench_")
+    for i in range(labels):
+        file_path = os.path.join(workdir.name, f"label_{i}.pdf")
+        with open(file_path, "wb") as f:
+            f.write(f"%PDF-1.4 label {i}".encode())
+        broker.publish("", "shipping_queue", json.dumps({"file_path": file_path}))
+
+    processed = []  # list.append is atomic: results arrive from the worker threads
+
+    def collect_result(file_path, data):
+        if data:
+            processed.append(file_path)
+
+    pool = LabelWorkerPool(functools.partial(fake_extract, cpu_seconds=cpu_seconds),
+                           functools.partial(fake_llm, llm_seconds=llm_seconds), collect_result,
+                           concurrency=concurrency, ocr_processes=ocr_processes, llm_threads=concurrency)
+    channel.basic_qos(prefetch_count=concurrency)
+    channel.basic_consume(queue='shipping_queue', on_message_callback=pool.on_message)
+
+    start = time.perf_counter()
+    channel.start_consuming()
+    elapsed = time.perf_counter() - start
+    pool.shutdown()
+    workdir.cleanup()
+    # Dead-lettered labels are acked too: count the labels that got a result
+    assert len(processed) == labels, f"expected {labels} processed labels, got {len(processed)}"
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Worker-pool throughput benchmark")
+    parser.add_argument("--labels", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8, 16])
+    parser.add_argument("--ocr-processes", type=int, default=2)
+    parser.add_argument("--cpu-seconds", type=float, default=CPU_SECONDS)
+    parser.add_argument("--llm-seconds", type=float, default=LLM_SECONDS)
+    args = parser.parse_args()
+
+    print(f"{'concurrency':>12} {'seconds':>10} {'labels/sec':>12}")
+    for concurrency in args.concurrency:
+        elapsed = run(args.labels, concurrency, args.ocr_processes, args.cpu_seconds, args.llm_seconds)
+        print(f"{concurrency:>12} {elapsed:>10.2f} {args.labels / elapsed:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
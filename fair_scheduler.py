@@ -0,0 +1,234 @@
+import os
+import json
+import time
+import heapq
+import logging
+import itertools
+import threading
+from dotenv import load_dotenv  # type: ignore
+
+from metrics import QUEUE_LATENCY, SCHEDULER_PENDING
+
+# Priorities and per-tenant fairness for label tasks. With plain FIFO queues
+# a bulk dump of 10k return labels from one merchant delays the same-day
+# shipping labels published after it for as long as the dump takes.
+#   priority   a task message may carry "priority" (0-QUEUE_MAX_PRIORITY, or a
+#              name from PRIORITY_NAMES); producers copy it to the AMQP
+#              priority and the work queues are declared with x-max-priority,
+#              so RabbitMQ hands out urgent tasks first
+#   tenant     the merchant or courier a task belongs to: the first of
+#              TENANT_KEYS found in the message, copied to the "tenant" header
+#   fairness   each consumer takes FAIR_BUFFER deliveries beyond its
+#              concurrency and starts them in weighted fair order: highest
+#              priority first, then the tenant that has had the least service
+#              for its weight (TENANT_WEIGHTS), so one large batch gets its
+#              share of the workers and no more
+#   latency    the time from publishing to the start of processing, per label
+#              type and tenant (label_queue_latency_seconds)
+# Queues declared earlier without x-max-priority cannot be changed in place:
+# the consumers keep using them as they are (priorities ignored by the broker,
+# fairness still applies) until they are drained and deleted.
+
+load_dotenv()
+
+# --- Config ---
+PRIORITY_QUEUES = os.getenv("PRIORITY_QUEUES", "true").lower() in ("1", "true", "yes")
+QUEUE_MAX_PRIORITY = int(os.getenv("QUEUE_MAX_PRIORITY", "10"))
+DEFAULT_PRIORITY = int(os.getenv("DEFAULT_PRIORITY", "5"))
+FAIR_SCHEDULING = os.getenv("FAIR_SCHEDULING", "true").lower() in ("1", "true", "yes")
+FAIR_BUFFER = int(os.getenv("FAIR_BUFFER", "32"))  # deliveries held per queue beyond its concurrency
+TENANT_KEYS = [k.strip() for k in os.getenv("TENANT_KEYS", "tenant,merchant_id,merchant,courier").split(",")
+               if k.strip()]
+DEFAULT_TENANT = os.getenv("DEFAULT_TENANT", "default")
+# tenant=weight pairs, e.g. "shopee=4,bulk-merchant=1"; unlisted tenants weigh 1
+TENANT_WEIGHTS = {name.strip(): float(weight) for name, weight in
+                  (pair.split("=", 1) for pair in os.getenv("TENANT_WEIGHTS", "").split(",") if "=" in pair)}
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_NAMES = {"bulk": 1, "low": 3, "normal": DEFAULT_PRIORITY, "high": 8, "urgent": 9, "same_day": 9}
+
+# Headers set by the producers, so consumers need not parse the body to schedule a task
+TENANT_HEADER = "tenant"
+ENQUEUED_AT_HEADER = "enqueued_at"
+
+
+# --- Task fields ---
+def task_priority(message):
+    value = message.get("priority", DEFAULT_PRIORITY)
+    if isinstance(value, str) and not value.strip().isdigit():
+        value = PRIORITY_NAMES.get(value.strip().lower(), DEFAULT_PRIORITY)
+    try:
+        return max(0, min(QUEUE_MAX_PRIORITY, int(value)))
+    except (TypeError, ValueError):
+        return DEFAULT_PRIORITY
+
+
+def task_tenant(message):
+    for key in TENANT_KEYS:
+        if message.get(key):
+            return str(message[key])
+    return DEFAULT_TENANT
+
+
+# Producer side: fills in priority and enqueued_at (in place) and returns the
+# keyword arguments for pika.BasicProperties
+def task_properties(message, **properties):
+    message["priority"] = task_priority(message)
+    message.setdefault("enqueued_at", time.time())
+    headers = dict(properties.pop("headers", None) or {})
+    headers.update({TENANT_HEADER: task_tenant(message), ENQUEUED_AT_HEADER: message["enqueued_at"]})
+    return {"priority": message["priority"], "headers": headers, **properties}
+
+
+# Consumer side: (tenant, priority, enqueued_at) of a delivery, from the AMQP
+# properties when the producer set them, else from the body
+def delivery_info(properties, body):
+    headers = getattr(properties, "headers", None) or {}
+    priority = getattr(properties, "priority", None)
+    if TENANT_HEADER in headers and priority is not None:
+        return str(headers[TENANT_HEADER]), priority, headers.get(ENQUEUED_AT_HEADER)
+    try:
+        message = json.loads(body)
+    except (ValueError, TypeError):  # dead-lettered by the worker; schedule it like any other
+        return DEFAULT_TENANT, priority or 0, None
+    if not isinstance(message, dict):
+        return DEFAULT_TENANT, priority or 0, None
+    return task_tenant(message), task_priority(message), message.get("enqueued_at")
+
+
+# Time from publishing to the start of processing. Retried deliveries are left
+# out: their wait includes the retry delay.
+def record_queue_latency(label_name, properties, message):
+    headers = getattr(properties, "headers", None) or {}
+    if headers.get("retry_attempt"):
+        return
+    enqueued_at = headers.get(ENQUEUED_AT_HEADER) or message.get("enqueued_at")
+    if not enqueued_at:
+        return
+    try:
+        QUEUE_LATENCY.labels(label_name, task_tenant(message)).observe(max(0.0, time.time() - float(enqueued_at)))
+    except (TypeError, ValueError):
+        pass
+
+
+# --- Queues ---
+def queue_arguments():
+    return {"x-max-priority": QUEUE_MAX_PRIORITY} if PRIORITY_QUEUES else None
+
+
+# Prefetch for a consumer running `concurrency` labels at once
+def prefetch_for(concurrency):
+    return concurrency + FAIR_BUFFER if FAIR_SCHEDULING else concurrency
+
+
+# Declares a work queue as a priority queue (pika). A queue that already exists
+# without x-max-priority makes the broker close the channel; it is then used
+# as it is, on a new channel. Returns the channel to use.
+def declare_work_queue(connection, channel, queue):
+    arguments = queue_arguments()
+    if not arguments:
+        channel.queue_declare(queue=queue, durable=True)
+        return channel
+    import pika  # type: ignore
+    try:
+        channel.queue_declare(queue=queue, durable=True, arguments=arguments)
+    except pika.exceptions.ChannelClosedByBroker as e:
+        if e.reply_code != 406:  # PRECONDITION_FAILED: declared earlier with other arguments
+            raise
+        logger.warning(f"'{queue}' exists without x-max-priority; priorities are ignored by the broker until "
+                       f"it is drained and deleted.")
+        channel = connection.channel()
+        channel.queue_declare(queue=queue, durable=True, passive=True)
+    return channel
+
+
+# --- Weighted fair scheduling ---
+# Starts up to `slots` tasks at once through submit(item). Tasks wait per
+# tenant; the next one is the highest priority waiting, and among tenants
+# with a task of that priority the one with the lowest virtual time. Starting
+# a task advances its tenant's virtual time by 1/weight, so over time each
+# busy tenant gets slots in proportion to its weight. A tenant that was idle
+# starts at the current virtual time: idling earns no credit for a later burst.
+# add() and done() may be called from any thread; submit runs outside the lock.
+# When submit raises (e.g. its executor is shut down) the slot is freed and
+# add()/done() return the items that could not start, for the caller to
+# requeue or nack; they return [] otherwise.
+class FairScheduler:
+    def __init__(self, slots, submit, label_name="label", weights=None):
+        self.slots = max(1, slots)
+        self.submit = submit
+        self.label_name = label_name
+        self.weights = TENANT_WEIGHTS if weights is None else weights
+        self.running = 0
+        self.started = {}  # tenant -> tasks started
+        self._waiting = {}  # tenant -> heap of (-priority, seq, item); tenants with waiting tasks only
+        self._vtime = {}    # tenant -> virtual time
+        self._now = 0.0     # virtual time of the last task started
+        self._seq = itertools.count()
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def add(self, tenant, priority, item):
+        with self._lock:
+            if tenant not in self._waiting:
+                self._waiting[tenant] = []
+                self._vtime[tenant] = max(self._vtime.get(tenant, 0.0), self._now)
+            heapq.heappush(self._waiting[tenant], (-priority, next(self._seq), item))
+        SCHEDULER_PENDING.labels(self.label_name, tenant).inc()
+        return self._dispatch()
+
+    # Called when a started task has finished
+    def done(self):
+        with self._lock:
+            self.running -= 1
+        return self._dispatch()
+
+    def _next(self):
+        top = min(heap[0][0] for heap in self._waiting.values())
+        tenant = min((t for t, heap in self._waiting.items() if heap[0][0] == top),
+                     key=lambda t: (self._vtime[t], t))
+        _, _, item = heapq.heappop(self._waiting[tenant])
+        if not self._waiting[tenant]:
+            del self._waiting[tenant]
+        self._now = self._vtime[tenant]
+        self._vtime[tenant] += 1.0 / max(self.weights.get(tenant, 1.0), 0.001)
+        self.started[tenant] = self.started.get(tenant, 0) + 1
+        return tenant, item
+
+    def _dispatch(self):
+        rejected = []
+        while True:
+            with self._lock:
+                if self._closed or self.running >= self.slots or not self._waiting:
+                    return rejected
+                self.running += 1
+                tenant, item = self._next()
+            SCHEDULER_PENDING.labels(self.label_name, tenant).dec()
+            try:
+                self.submit(item)
+            except Exception as e:
+                logger.error(f"Cannot start a {self.label_name} task: {e}")
+                with self._lock:
+                    self.running -= 1
+                    self.started[tenant] -= 1
+                rejected.append(item)
+
+    def pending(self):
+        with self._lock:
+            return sum(len(heap) for heap in self._waiting.values())
+
+    # Stops starting tasks and returns the items still waiting, for the caller to requeue
+    def close(self):
+        with self._lock:
+            self._closed = True
+            waiting = [(tenant, entry[2]) for tenant, heap in self._waiting.items() for entry in sorted(heap)]
+            self._waiting.clear()
+        for tenant, _ in waiting:
+            SCHEDULER_PENDING.labels(self.label_name, tenant).dec()
+        return [item for _, item in waiting]
+
+    def stats(self):
+        with self._lock:
+            return {"running": self.running, "waiting": {t: len(h) for t, h in self._waiting.items()},
+                    "started": dict(self.started)}
@@ -0,0 +1,76 @@
+import re
+import json
+import time
+import hashlib
+from types import SimpleNamespace
+
+# Deterministic stand-in for genai.GenerativeModel, used by the benchmarks.
+# Answers come from regexes over the label text, so the same text always
+# gets the same JSON. Latency is base + a jitter derived from the text hash
+# + a per-token cost, so runs are repeatable too. Batched prompts
+# (<label id="...">) get a JSON array, like the real model is asked for.
+# Without JSON mode (generation_config) the answer comes in a ```json fence.
+
+TRACKING = re.compile(r"\b([A-Z]{2,6}\d{8,14})\b")
+ORDER = re.compile(r"(?:Mã đ[oơ]n hàng|Order ID)\s*[:：]?\s*([A-Z0-9]{6,20})", re.IGNORECASE)
+SENDER = re.compile(r"(?:\bFROM|\bT[uừ]|Sender)\s*[:：]\s*(.+?)(?=\n\s*(?:TO|Đ[eế]n|Den|Receiver)\b|$)", re.DOTALL)
+RECIPIENT = re.compile(r"(?:\bTO|Đ[eế]n|\bDen|Receiver)\s*[:：]\s*(.+?)(?=\n\s*(?:Mã|Ma|Order|Weight|Kh[oố]i)|$)",
+                       re.DOTALL)
+LABEL_BLOCK = re.compile(r'<label id="([^"]+)">\n(.*?)\n</label>', re.DOTALL)
+NOT_FOUND = "Not found"
+
+
+# The exception name matches google.api_core's, so rate_limiter treats it as retryable
+class ResourceExhausted(Exception):
+    code = 429
+
+
+def _fraction(text, salt):
+    digest = hashlib.sha256((salt + text).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") / 2 ** 64
+
+
+def extract_fields(text):
+    def first(pattern):
+        match = pattern.search(text)
+        return ", ".join(line.strip() for line in match.group(1).splitlines() if line.strip()) if match else NOT_FOUND
+    return {"tracking_number": first(TRACKING), "order_id": first(ORDER),
+            "sender_address": first(SENDER), "recipient_address": first(RECIPIENT)}
+
+
+class FakeGeminiModel:
+    def __init__(self, latency_ms=800, jitter_ms=200, ms_per_1k_tokens=20, error_rate=0.0,
+                 model_name="fake-gemini"):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.ms_per_1k_tokens = ms_per_1k_tokens
+        self.error_rate = error_rate
+        self.model_name = model_name
+        self._attempts = {}  # text hash -> calls so far, so a "failing" label succeeds on retry
+
+    def count_tokens(self, contents):
+        return SimpleNamespace(total_tokens=len(str(contents)) // 4 + 1)
+
+    def generate_content(self, parts, generation_config=None):
+        prompt, text = str(parts[0]), str(parts[-1])
+        tokens = (len(prompt) + len(text)) // 4 + 1
+        key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        attempt = self._attempts.get(key, 0)
+        self._attempts[key] = attempt + 1
+        delay_ms = self.latency_ms + self.jitter_ms * _fraction(text, "latency") + self.ms_per_1k_tokens * tokens / 1000
+        time.sleep(delay_ms / 1000)
+        if attempt == 0 and _fraction(text, "error") < self.error_rate:
+            raise ResourceExhausted("429 Resource has been exhausted. Please retry in 0.5s")
+
+        blocks = LABEL_BLOCK.findall(text)
+        if blocks:
+            answer = [dict(extract_fields(body), label_id=label_id) for label_id, body in blocks]
+        else:
+            answer = extract_fields(text)
+        body = json.dumps(answer, ensure_ascii=False)
+        if (generation_config or {}).get("response_mime_type") != "application/json":
+            body = "```json\n" + body + "\n```"
+        return SimpleNamespace(
+            parts=[SimpleNamespace(text=body)], text=body, prompt_feedback=None,
+            usage_metadata=SimpleNamespace(total_token_count=tokens + len(body) // 4),
+            resolve=lambda: None)
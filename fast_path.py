@@ -0,0 +1,129 @@
+import os
+import re
+import logging
+import threading
+from dotenv import load_dotenv  # type: ignore
+
+load_dotenv()
+
+# --- Config ---
+FAST_PATH_ENABLED = os.getenv("FAST_PATH_ENABLED", "true").lower() in ("1", "true", "yes")
+# Fields that must all be found for the fast path to replace the Gemini call
+FAST_PATH_REQUIRED_FIELDS = [f.strip() for f in os.getenv(
+    "FAST_PATH_REQUIRED_FIELDS", "tracking_number,order_id,sender_address,recipient_address").split(",") if f.strip()]
+
+logger = logging.getLogger(__name__)
+
+NOT_FOUND = "Not found"
+SHIPPING_FIELDS = ("tracking_number", "order_id", "sender_address", "recipient_address")
+
+# Anchors shared by most Vietnamese courier layouts
+SENDER_ANCHOR = r"(?:(?-i:FROM)|Từ|Người gửi|Sender)"
+RECIPIENT_ANCHOR = r"(?:(?-i:TO)|Đến|Người nhận|Receiver)"
+END_ANCHOR = r"(?:Mã vận đơn|Mã đơn hàng|Order ID|Tracking(?: No\.?| ID)?|Ngày (?:đặt|giao)|Khối lượng|Weight|COD|Tiền thu)"
+
+
+# --- Template ---
+# A template recognises one courier layout (`detect`) and pulls each field
+# with a regex whose first group is the value.
+class LabelTemplate:
+    def __init__(self, name, detect, fields):
+        self.name = name
+        self.detect = re.compile(detect, re.IGNORECASE)
+        self.fields = {field: re.compile(pattern, re.IGNORECASE | re.DOTALL) for field, pattern in fields.items()}
+
+    def matches(self, text):
+        return bool(self.detect.search(text))
+
+    def extract(self, text):
+        data = {}
+        for field in SHIPPING_FIELDS:
+            pattern = self.fields.get(field)
+            match = pattern.search(text) if pattern else None
+            data[field] = _clean(match.group(1)) if match else NOT_FOUND
+        return data
+
+
+def _clean(value):
+    # Addresses span several lines on the label; Gemini returns them comma-joined
+    lines = [line.strip(" :：-\t") for line in value.splitlines()]
+    value = ", ".join(line for line in lines if line)
+    return re.sub(r"\s+", " ", value).strip() or NOT_FOUND
+
+
+# --- Registry ---
+TEMPLATES = []
+
+
+def register_template(template):
+    TEMPLATES.append(template)
+    return template
+
+
+register_template(LabelTemplate(
+    name="spx",
+    detect=r"\bSPX|Shopee\s*Xpress|Shopee\s*Express",
+    fields={
+        "tracking_number": r"\b(SPX[A-Z]{2}\d{9,12})\b",
+        "order_id": r"(?:Mã đơn hàng|Order ID)\s*[:：]?\s*([A-Z0-9]{8,20})\b",
+        "sender_address": rf"\b{SENDER_ANCHOR}\s*[:：]?\s*(.+?)(?=\b{RECIPIENT_ANCHOR}\b|$)",
+        "recipient_address": rf"\b{RECIPIENT_ANCHOR}\s*[:：]?\s*(.+?)(?=\b{END_ANCHOR}|$)",
+    },
+))
+
+# Any layout that spells out its fields with the usual Vietnamese/English keywords
+register_template(LabelTemplate(
+    name="anchored",
+    detect=r"Mã vận đơn|Tracking\s*(?:No\.?|ID)",
+    fields={
+        "tracking_number": r"(?:Mã vận đơn|Tracking\s*(?:No\.?|ID))\s*[:：]?\s*([A-Z0-9]{8,20})\b",
+        "order_id": r"(?:Mã đơn hàng|Order ID)\s*[:：]?\s*([A-Z0-9]{8,20})\b",
+        "sender_address": rf"\b{SENDER_ANCHOR}\s*[:：]?\s*(.+?)(?=\b{RECIPIENT_ANCHOR}\b|$)",
+        "recipient_address": rf"\b{RECIPIENT_ANCHOR}\s*[:：]?\s*(.+?)(?=\b{END_ANCHOR}|$)",
+    },
+))
+
+
+# --- Hit-rate counters per template ---
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _count(name, outcome):
+    with _stats_lock:
+        entry = _stats.setdefault(name, {"matched": 0, "hits": 0, "partial": 0})
+        entry["matched"] += 1
+        entry[outcome] += 1
+
+
+def template_stats():
+    with _stats_lock:
+        stats = {name: dict(entry) for name, entry in _stats.items()}
+    for entry in stats.values():
+        entry["hit_rate"] = round(entry["hits"] / entry["matched"], 3) if entry["matched"] else 0.0
+    return stats
+
+
+def missing_fields(data, required=None):
+    required = FAST_PATH_REQUIRED_FIELDS if required is None else required
+    return [f for f in required if not data or data.get(f, NOT_FOUND) == NOT_FOUND]
+
+
+# --- Fast path entry point ---
+# Returns (data, template_name) when a template fills every required field,
+# otherwise (None, template_name or None) and the caller goes to Gemini.
+def extract_fast(text, required=None):
+    if not FAST_PATH_ENABLED or not text:
+        return None, None
+    for template in TEMPLATES:
+        if not template.matches(text):
+            continue
+        data = template.extract(text)
+        missing = missing_fields(data, required)
+        if not missing:
+            _count(template.name, "hits")
+            return data, template.name
+        _count(template.name, "partial")
+        logger.debug(f"Fast path template '{template.name}' missing fields: {missing}")
+        return None, template.name
+    return None, None
@@ -0,0 +1,172 @@
+import os
+import time
+import queue
+import logging
+import itertools
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dotenv import load_dotenv  # type: ignore
+
+from rate_limiter import GeminiUnavailable
+from metrics import EMPTY_RESPONSES
+from response_parser import parse_response, generate_structured, ResponseParseError
+
+load_dotenv()
+
+# --- Config ---
+# GEMINI_BATCH_SIZE=1 disables batching (one generate_content per label).
+GEMINI_BATCH_SIZE = int(os.getenv("GEMINI_BATCH_SIZE", "1"))
+GEMINI_BATCH_WINDOW_MS = int(os.getenv("GEMINI_BATCH_WINDOW_MS", "200"))
+GEMINI_BATCH_TOKEN_BUDGET = int(os.getenv("GEMINI_BATCH_TOKEN_BUDGET", "30000"))
+GEMINI_BATCH_PARALLEL = int(os.getenv("GEMINI_BATCH_PARALLEL", "2"))  # batches in flight at once
+
+logger = logging.getLogger(__name__)
+
+# Appended to the per-label prompt; the prompt itself is sent once per batch
+BATCH_INSTRUCTIONS = """
+You will receive several labels at once. Each label is wrapped in <label id="..."> and </label>.
+Apply the instructions above to every label independently.
+Return strictly a JSON array with one object per label and add a "label_id" field to each object
+holding the id of the label it was extracted from. Do not include any explanations or additional text.
+"""
+
+# Marker telling the waiting caller to make its own single-label call
+FALLBACK = object()
+
+
+def _generate(model, parts, generation_config=None):
+    kwargs = {"generation_config": generation_config} if generation_config else {}
+    response = model.generate_content(parts, **kwargs)
+    response.resolve()
+    return response
+
+
+def estimate_tokens(text):
+    # Rough Gemini estimate (~4 characters per token); avoids a count_tokens round trip
+    return len(text) // 4 + 1
+
+
+class _Pending:
+    __slots__ = ("label_id", "text", "tokens", "future")
+
+    def __init__(self, label_id, text):
+        self.label_id = label_id
+        self.text = text
+        self.tokens = estimate_tokens(text)
+        self.future = Future()
+
+
+# --- Batcher ---
+# Callers (worker-pool threads) block in submit(); a collector thread groups
+# up to batch_size labels arriving within window_seconds, bounded by
+# token_budget, sends them as one request and fans the results back out.
+# Labels missing from, or malformed in, the batched answer fall back to
+# single_fn(text) in the caller's own thread, as do labels submitted after
+# shutdown().
+class GeminiBatcher:
+    def __init__(self, model, prompt, single_fn, batch_size=GEMINI_BATCH_SIZE,
+                 window_seconds=GEMINI_BATCH_WINDOW_MS / 1000, token_budget=GEMINI_BATCH_TOKEN_BUDGET,
+                 parallel=GEMINI_BATCH_PARALLEL, generate=_generate, generation_config=None):
+        self.model = model
+        self.generate = generate  # (model, parts, generation_config=None) -> resolved response, e.g. GeminiGuard.generate
+        self.generation_config = generation_config  # JSON mode / array schema, see response_parser.py
+        self.prompt = prompt + BATCH_INSTRUCTIONS
+        self.single_fn = single_fn
+        self.batch_size = max(1, batch_size)
+        self.window_seconds = window_seconds
+        self.token_budget = token_budget
+        self.stats = {"batches": 0, "batched_labels": 0, "fallbacks": 0}
+        self._stats_lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._queue = queue.Queue()
+        self._closed = False
+        self._close_lock = threading.Lock()  # no label is queued behind the collector's stop marker
+        self._senders = ThreadPoolExecutor(max_workers=max(1, parallel), thread_name_prefix="gemini-batch")
+        self._collector = threading.Thread(target=self._collect, name="gemini-batcher", daemon=True)
+        self._collector.start()
+
+    def submit(self, text):
+        item = _Pending(f"L{next(self._ids)}", text)
+        with self._close_lock:
+            closed = self._closed
+            if not closed:
+                self._queue.put(item)
+        if closed:
+            return self.single_fn(text)
+        result = item.future.result()
+        if result is FALLBACK:
+            return self.single_fn(text)
+        return result
+
+    def _collect(self):
+        carry = None
+        while True:
+            first = carry or self._queue.get()
+            carry = None
+            if first is None:
+                return
+            batch, tokens = [first], first.tokens
+            deadline = time.monotonic() + self.window_seconds
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                if tokens + item.tokens > self.token_budget:
+                    carry = item
+                    break
+                batch.append(item)
+                tokens += item.tokens
+            if len(batch) == 1:
+                batch[0].future.set_result(FALLBACK)  # nothing to share the prompt with
+            else:
+                self._senders.submit(self._send, batch)
+
+    def _send(self, batch):
+        results = {}
+        try:
+            body = "\n".join(f'<label id="{item.label_id}">\n{item.text}\n</label>' for item in batch)
+            logger.info(f"Sending batch of {len(batch)} labels to Gemini.")
+            response = generate_structured(self.generate, self.model, [self.prompt, body], self.generation_config)
+            if response.parts:
+                for obj in parse_response(response.parts[0].text, array=True):
+                    if isinstance(obj, dict) and "label_id" in obj:
+                        results[str(obj.pop("label_id"))] = obj
+            else:
+                EMPTY_RESPONSES.inc()
+                logger.warning("No content (parts) received from Gemini for batch; falling back per label.")
+        except ResponseParseError as e:
+            logger.warning(f"Batched Gemini response is not a usable JSON array ({e}); falling back per label.")
+        except GeminiUnavailable as e:
+            logger.warning(f"Gemini unavailable for batch ({e}); falling back per label.")
+        except Exception as e:
+            logger.error(f"Error during batched Gemini extraction: {e}", exc_info=True)
+
+        fallbacks = 0
+        for item in batch:
+            data = results.get(item.label_id)
+            if data is None:
+                fallbacks += 1
+                item.future.set_result(FALLBACK)
+            else:
+                item.future.set_result(data)
+        with self._stats_lock:
+            self.stats["batches"] += 1
+            self.stats["batched_labels"] += len(batch) - fallbacks
+            self.stats["fallbacks"] += fallbacks
+
+    def shutdown(self):
+        with self._close_lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._collector.join(timeout=self.window_seconds + 1)
+        self._senders.shutdown(wait=True)
+        logger.info(f"Gemini batcher stats: {self.stats}")
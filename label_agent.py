@@ -0,0 +1,182 @@
+import os
+import sys
+import time
+import signal
+import argparse
+import functools
+import logging
+import pika  # type: ignore
+from dotenv import load_dotenv  # type: ignore
+
+from startup import (IMPORT_START, StartupTimer, warm_up_backends, report_when_warm, run_checks, print_checks)
+from label_handlers import get_handlers
+from label_pipeline import (read_label_text, LabelExtractor, handle_extracted_data, extraction_cache,
+                            gemini_guard)
+from fast_path import template_stats
+from model_tiering import tiering_stats
+from prompt_reducer import reduction_stats
+from barcode_stage import barcode_stats
+from task_payload import blob_cache
+from worker_pool import LabelWorkerPool, ConsumerGate, OCR_PROCESSES
+from results_sink import open_sink, RESULTS_BATCH_SIZE
+from retry_queues import declare_retry_queues
+from fair_scheduler import declare_work_queue, prefetch_for
+from metrics import start_metrics_server, start_profiler, report_queue_depth, QUEUE_DEPTH_INTERVAL
+
+# One agent process for every label type: a single broker connection with
+# one channel per queue, one shared Gemini client, cache and worker pools.
+# Each queue runs at most its handler's concurrency at once, so a flood of
+# return labels can never take the slots reserved for shipping labels; within
+# a queue, urgent tasks go first and tenants share the slots by weight (see
+# fair_scheduler.py).
+#   python label_agent.py                 # all registered label types
+#   python label_agent.py shipping        # only some of them
+#   python label_agent.py --check         # dependency readiness report, no consuming
+# SIGTERM (CTRL_BREAK on Windows) stops it like Ctrl+C: no new deliveries,
+# labels in flight are finished and acked (how supervisor.py scales down).
+
+# Load environment variables from .env file
+load_dotenv()
+
+# --- Config ---
+MESSAGE_QUEUE_HOST = os.getenv("MESSAGE_QUEUE_HOST", "localhost")
+EXCHANGE_NAME = "label_tasks"
+
+# --- Logging Setup ---
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(),
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    stream=sys.stdout)
+logger = logging.getLogger(__name__)
+
+
+# --- Agent ---
+class LabelAgent:
+    def __init__(self, handlers, connection, model=None):
+        self.handlers = handlers
+        self.connection = connection
+        # Without a model, each label type uses its configured model from the process-wide pool
+        self.model = model
+        self.extractors = {h.name: LabelExtractor(h, model) for h in handlers}
+        total = sum(h.concurrency for h in handlers)
+        # Results are stored in batches; a message is acked only after its batch is committed. A batch
+        # never holds more results than the channels have unacked deliveries, else it waits RESULTS_FLUSH_MS
+        self.sink = open_sink(batch_size=min(RESULTS_BATCH_SIZE, sum(prefetch_for(h.concurrency) for h in handlers)))
+        # Worker and LLM threads cover every queue's slots at once
+        self.pool = LabelWorkerPool(concurrency=total, ocr_processes=OCR_PROCESSES, llm_threads=total,
+                                    sink=self.sink)
+        # Consumers are cancelled while the Gemini circuit breaker is open
+        self.gate = ConsumerGate(gemini_guard.breaker)
+        self.channels = []
+
+    # Gemini, OCR and pypdf are loaded in the background by main() (see startup.py)
+    def start(self):
+        for handler in self.handlers:
+            channel = self.connection.channel()
+            channel.exchange_declare(exchange=EXCHANGE_NAME, exchange_type='direct', durable=True)
+            # Priority queue (x-max-priority); an existing plain queue is used as it is, on a new channel
+            channel = declare_work_queue(self.connection, channel, handler.queue)
+            channel.queue_bind(exchange=EXCHANGE_NAME, queue=handler.queue, routing_key=handler.routing_key)
+            # Failed labels wait in <queue>.retry.N before coming back, or end up in <queue>.dead
+            declare_retry_queues(channel, handler.queue)
+            # Deliveries beyond the concurrency wait in the consumer's fair scheduler
+            channel.basic_qos(prefetch_count=prefetch_for(handler.concurrency))
+            self.gate.consume(channel, handler.queue, self.pool.consumer(
+                functools.partial(read_label_text, ocr_fallback=handler.ocr_fallback, stop_when=handler.ocr_stop_when),
+                self.extractors[handler.name].process,
+                functools.partial(handle_extracted_data, handler.name),
+                handler.name, handler.queue, split_handler=handler, slots=handler.concurrency,
+                barcode_fn=self.extractors[handler.name].barcode_answer))
+            self.channels.append(channel)
+            logger.info(f"🔄 Consuming '{handler.queue}' (routing key '{handler.routing_key}', "
+                        f"concurrency {handler.concurrency})")
+
+    def run_forever(self):
+        logger.info("🔄 [*] Waiting for label tasks. To exit press CTRL+C")
+        next_depth_check = 0.0
+        while True:
+            self.connection.process_data_events(time_limit=1)
+            self.gate.check()
+            if time.monotonic() >= next_depth_check:
+                for handler, channel in zip(self.handlers, self.channels):
+                    report_queue_depth(channel, handler.queue)
+                next_depth_check = time.monotonic() + QUEUE_DEPTH_INTERVAL
+
+    def stop(self):
+        for channel in self.channels:
+            if channel.is_open:
+                channel.stop_consuming()
+        # Let in-flight labels finish, store their results, then flush the pending acks before closing
+        self.pool.shutdown(wait=True)
+        if self.sink:
+            self.sink.close()
+        if self.connection.is_open:
+            self.connection.process_data_events(time_limit=1)
+        for extractor in self.extractors.values():
+            extractor.shutdown()
+        logger.info(f"Extraction cache stats: {extraction_cache.stats()}")
+        logger.info(f"Fast path template stats: {template_stats()}")
+        logger.info(f"Model tiering stats: {tiering_stats()}")
+        logger.info(f"Prompt reduction stats: {reduction_stats()}")
+        logger.info(f"Barcode stats: {barcode_stats()}")
+        logger.info(f"Blob cache stats: {blob_cache.stats}")
+        logger.info(f"Scheduler stats: {self.pool.scheduler_stats()}")
+
+
+# --- Entry Point ---
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Multi-queue label processing agent")
+    parser.add_argument("label_types", nargs="*", help="label types to consume (default: all)")
+    parser.add_argument("--check", action="store_true",
+                        help="report each dependency's availability and exit without consuming")
+    parser.add_argument("--json", action="store_true", help="with --check: print the report as JSON")
+    args = parser.parse_args(argv)
+
+    if args.check:
+        handlers = get_handlers(args.label_types)
+        sys.exit(print_checks(run_checks(handlers, MESSAGE_QUEUE_HOST), as_json=args.json))
+
+    signal.signal(signal.SIGTERM, _interrupt)
+    if hasattr(signal, "SIGBREAK"):  # Windows: CTRL_BREAK_EVENT
+        signal.signal(signal.SIGBREAK, _interrupt)
+
+    connection = None
+    agent = None
+    profiler = None
+    timer = StartupTimer()
+    timer.mark("imports", IMPORT_START)
+    try:
+        handlers = get_handlers(args.label_types)
+        # Gemini, OCR and pypdf load in background threads while the broker connection opens
+        warm_up = warm_up_backends(handlers, timer)
+        start_metrics_server()
+        profiler = start_profiler()
+        with timer.phase("rabbitmq"):
+            connection = pika.BlockingConnection(pika.ConnectionParameters(host=MESSAGE_QUEUE_HOST))
+        with timer.phase("consumers"):
+            agent = LabelAgent(handlers, connection)
+            agent.start()
+        report_when_warm(timer, warm_up)
+        agent.run_forever()
+    except pika.exceptions.AMQPConnectionError as e:
+        logger.critical(f"Failed to connect to RabbitMQ: {e}", exc_info=True)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        logger.info("Interrupted. Stopping agent...")
+    except Exception as e:
+        logger.critical(f"Unhandled exception in agent: {e}", exc_info=True)
+    finally:
+        if agent:
+            agent.stop()
+        if profiler:
+            profiler.stop()
+        if connection and connection.is_open:
+            connection.close()
+            logger.info("RabbitMQ connection closed. Exiting.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from dotenv import load_dotenv  # type: ignore
+
+load_dotenv()
+
+# --- Config ---
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+CACHE_PATH = os.getenv("CACHE_PATH", "label_cache.sqlite3")
+CACHE_TTL_SECONDS = int(os.getenv("CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+CACHE_EVICT_EVERY = int(os.getenv("CACHE_EVICT_EVERY", "100"))  # puts between eviction passes
+
+logger = logging.getLogger(__name__)
+
+# Kinds of entries kept in the cache
+KIND_PDF_TEXT = "pdf_text"    # pypdf text, keyed by file hash
+KIND_OCR_TEXT = "ocr_text"    # OCR text, keyed by file hash + OCR settings + stop_when
+KIND_PAGE_TEXT = "page_text"  # per-page routed pypdf/OCR text, keyed like ocr_text + ocr_fallback
+KIND_RESULT = "result"        # final JSON, keyed by text hash + model + prompt version
+KIND_BARCODES = "barcodes"    # decoded barcode symbols, keyed by file hash + pages
+
+
+# --- Hashing helpers ---
+def file_digest(path, chunk_size=1024 * 1024):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def text_digest(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+# --- SQLite-backed content-addressed cache ---
+# One connection per process (the worker pool forks OCR processes), shared
+# by that process's threads behind a lock. Hit/miss counters live in the
+# database so they add up across processes.
+class ExtractionCache:
+    def __init__(self, path=CACHE_PATH, ttl_seconds=CACHE_TTL_SECONDS, max_bytes=CACHE_MAX_BYTES):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._puts = 0
+
+    def _connection(self):
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS entries (
+                kind TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,
+                size INTEGER NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL,
+                PRIMARY KEY (kind, key))""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed_at)")
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS stats (
+                kind TEXT PRIMARY KEY, hits INTEGER NOT NULL DEFAULT 0, misses INTEGER NOT NULL DEFAULT 0)""")
+            self._conn.commit()
+            self._pid = os.getpid()
+        return self._conn
+
+    def _count(self, conn, kind, hit):
+        column = "hits" if hit else "misses"
+        conn.execute("INSERT OR IGNORE INTO stats (kind) VALUES (?)", (kind,))
+        conn.execute(f"UPDATE stats SET {column} = {column} + 1 WHERE kind = ?", (kind,))
+
+    def get(self, kind, key):
+        if key is None:
+            return None
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._connection()
+                row = conn.execute("SELECT value, created_at FROM entries WHERE kind = ? AND key = ?",
+                                   (kind, key)).fetchone()
+                if row and now - row[1] > self.ttl_seconds:
+                    conn.execute("DELETE FROM entries WHERE kind = ? AND key = ?", (kind, key))
+                    row = None
+                if row:
+                    conn.execute("UPDATE entries SET accessed_at = ? WHERE kind = ? AND key = ?", (now, kind, key))
+                self._count(conn, kind, row is not None)
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"Cache read failed ({kind}): {e}")
+            return None
+        if row is None:
+            return None
+        logger.debug(f"Cache hit: {kind} {key[:12]}")
+        return json.loads(row[0])
+
+    def put(self, kind, key, value):
+        if key is None:
+            return
+        payload = json.dumps(value, ensure_ascii=False)
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._connection()
+                conn.execute("INSERT OR REPLACE INTO entries (kind, key, value, size, created_at, accessed_at) "
+                             "VALUES (?, ?, ?, ?, ?, ?)", (kind, key, payload, len(payload), now, now))
+                conn.commit()
+                self._puts += 1
+                if self._puts % CACHE_EVICT_EVERY == 0:
+                    self._evict(conn, now)
+        except sqlite3.Error as e:
+            logger.warning(f"Cache write failed ({kind}): {e}")
+
+    # Drop expired entries, then least recently used ones until under max_bytes
+    def _evict(self, conn, now):
+        conn.execute("DELETE FROM entries WHERE created_at < ?", (now - self.ttl_seconds,))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total > self.max_bytes:
+            excess = total - self.max_bytes
+            cursor = conn.execute("SELECT kind, key, size FROM entries ORDER BY accessed_at")
+            doomed = []
+            for kind, key, size in cursor:
+                doomed.append((kind, key))
+                excess -= size
+                if excess <= 0:
+                    break
+            conn.executemany("DELETE FROM entries WHERE kind = ? AND key = ?", doomed)
+            logger.info(f"Cache evicted {len(doomed)} entries to stay under {self.max_bytes} bytes")
+        conn.commit()
+
+    def stats(self):
+        with self._lock:
+            rows = self._connection().execute("SELECT kind, hits, misses FROM stats").fetchall()
+        return {kind: {"hits": hits, "misses": misses} for kind, hits, misses in rows}
+
+
+# --- No-op cache when CACHE_ENABLED is off ---
+class NullCache:
+    def get(self, kind, key):
+        return None
+
+    def put(self, kind, key, value):
+        pass
+
+    def stats(self):
+        return {}
+
+
+def open_cache():
+    return ExtractionCache() if CACHE_ENABLED else NullCache()
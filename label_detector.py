@@ -0,0 +1,390 @@
+import os
+import re
+import sys
+import json
+import time
+import queue
+import logging
+import datetime
+import threading
+import uuid
+import pika  # type: ignore
+from dotenv import load_dotenv  # type: ignore
+
+try:
+    from watchdog.observers import Observer  # type: ignore
+    from watchdog.events import FileSystemEventHandler  # type: ignore
+except ImportError:  # polling fallback below
+    Observer = None
+    FileSystemEventHandler = object
+
+from task_payload import attach_payload, open_store
+from fair_scheduler import task_properties
+
+# Load environment variables from .env file
+load_dotenv()
+
+# --- Config ---
+MESSAGE_QUEUE_HOST = os.getenv("MESSAGE_QUEUE_HOST", "localhost")
+DAILY_FOLDER_BASE = os.getenv("DAILY_FOLDER_BASE", r"D:\Desktop\A2A và MCP\Build the Label Detection Agent (A2A)\daily")
+EXCHANGE_NAME = "label_tasks"
+WATCH_MODE = os.getenv("WATCH_MODE", "auto")  # auto | events | poll
+POLL_INTERVAL_SECONDS = float(os.getenv("POLL_INTERVAL_SECONDS", "2"))
+DEBOUNCE_SECONDS = float(os.getenv("DEBOUNCE_SECONDS", "1.5"))  # file must be unchanged this long
+PUBLISH_BATCH_SIZE = int(os.getenv("PUBLISH_BATCH_SIZE", "500"))
+PUBLISH_FLUSH_MS = int(os.getenv("PUBLISH_FLUSH_MS", "50"))
+LEDGER_NAME = ".published.log"  # per daily folder, so restarts don't republish
+# Merchant or courier of every file in this folder, for fair scheduling (see fair_scheduler.py)
+LABEL_TENANT = os.getenv("LABEL_TENANT", "")
+
+# Filename patterns per routing key; checked in order, first match wins
+LABEL_PATTERNS = {
+    "return": [r"return", r"hoan[_\- ]?hang", r"tra[_\- ]?hang", r"\bRMA\b"],
+    "shipping": [r"ship", r"van[_\- ]?don", r"\bSPX", r"awb", r"label"],
+}
+# Filenames of labels that jump the queue (priority "urgent"); others are "normal"
+URGENT_PATTERNS = [r"same[_\- ]?day", r"hoa[_\- ]?toc", r"urgent"]
+# Keywords used when the filename says nothing (first page text via pypdf)
+CONTENT_PATTERNS = {
+    "return": [r"return", r"hoàn hàng", r"trả hàng", r"Return ID"],
+    "shipping": [r"Mã vận đơn", r"Tracking", r"SPX", r"Người nhận"],
+}
+
+# --- Logging Setup ---
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(),
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    stream=sys.stdout)
+logger = logging.getLogger(__name__)
+
+
+# --- Classification ---
+def classify_by_filename(file_name):
+    for label_type, patterns in LABEL_PATTERNS.items():
+        if any(re.search(p, file_name, re.IGNORECASE) for p in patterns):
+            return label_type
+    return None
+
+
+def classify_by_content(file_path):
+    try:
+        from pypdf import PdfReader  # only needed for ambiguous filenames
+        reader = PdfReader(file_path)
+        text = reader.pages[0].extract_text() or "" if reader.pages else ""
+    except Exception as e:
+        logger.warning(f"Cannot read {file_path} for classification: {e}")
+        return None
+    for label_type, patterns in CONTENT_PATTERNS.items():
+        if any(re.search(p, text, re.IGNORECASE) for p in patterns):
+            return label_type
+    return None
+
+
+def classify_label(file_path):
+    return classify_by_filename(os.path.basename(file_path)) or classify_by_content(file_path)
+
+
+def classify_priority(file_path):
+    name = os.path.basename(file_path)
+    return "urgent" if any(re.search(p, name, re.IGNORECASE) for p in URGENT_PATTERNS) else "normal"
+
+
+# --- Debouncing: only hand over files that have stopped changing ---
+class PendingFiles:
+    def __init__(self, debounce_seconds=DEBOUNCE_SECONDS):
+        self.debounce_seconds = debounce_seconds
+        self._files = {}  # path -> (size, mtime, last_change)
+        self._lock = threading.Lock()
+
+    def note(self, path):
+        if path.lower().endswith(".pdf"):
+            with self._lock:
+                self._files.setdefault(path, (-1, -1, time.monotonic()))
+
+    def ready(self):
+        now = time.monotonic()
+        done = []
+        with self._lock:
+            for path, (size, mtime, changed) in list(self._files.items()):
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    del self._files[path]
+                    continue
+                if (st.st_size, st.st_mtime) != (size, mtime):
+                    self._files[path] = (st.st_size, st.st_mtime, now)
+                elif now - changed >= self.debounce_seconds and st.st_size > 0 and _looks_complete(path):
+                    done.append(path)
+                    del self._files[path]
+        return done
+
+
+def _looks_complete(path):
+    # A fully written PDF ends with %%EOF (possibly followed by whitespace)
+    try:
+        with open(path, "rb") as f:
+            f.seek(max(0, os.path.getsize(path) - 1024))
+            return b"%%EOF" in f.read()
+    except OSError:
+        return False
+
+
+# --- Watching ---
+class _EventHandler(FileSystemEventHandler):
+    def __init__(self, pending):
+        self.pending = pending
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.pending.note(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.pending.note(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self.pending.note(event.dest_path)
+
+
+def scan_folder(folder, pending, seen):
+    try:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.path not in seen:
+                    pending.note(entry.path)
+    except FileNotFoundError:
+        pass
+
+
+# --- Publisher: one long-lived connection with asynchronous publisher confirms ---
+# Runs pika's SelectConnection in its own thread. Messages are published in
+# batches every PUBLISH_FLUSH_MS; the broker confirms them (often many at a
+# time with multiple=True) and nacked or unconfirmed messages are re-sent.
+class BatchPublisher:
+    def __init__(self, host=MESSAGE_QUEUE_HOST, exchange=EXCHANGE_NAME,
+                 batch_size=PUBLISH_BATCH_SIZE, flush_seconds=PUBLISH_FLUSH_MS / 1000, on_confirmed=None):
+        self.host = host
+        self.exchange = exchange
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.on_confirmed = on_confirmed  # called with the message dict once the broker acks it
+        self._outbox = queue.Queue()
+        self._unconfirmed = {}  # delivery tag -> message
+        self._next_tag = 0
+        self._connection = None
+        self._channel = None
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="publisher", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def publish(self, message):
+        # Stable across re-sends, so consumers can tell a redelivery from a new task
+        message.setdefault("message_id", uuid.uuid4().hex)
+        self._outbox.put(message)
+
+    def backlog(self):
+        return self._outbox.qsize() + len(self._unconfirmed)
+
+    def _run(self):
+        while not self._stopping:
+            params = pika.ConnectionParameters(host=self.host, heartbeat=60)
+            self._connection = pika.SelectConnection(params, on_open_callback=self._on_open,
+                                                     on_open_error_callback=self._on_open_error,
+                                                     on_close_callback=self._on_closed)
+            self._connection.ioloop.start()
+            if not self._stopping:
+                time.sleep(5)
+
+    def _on_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_open_error(self, connection, error):
+        logger.error(f"Publisher failed to connect to RabbitMQ: {error}")
+        connection.ioloop.stop()
+
+    def _on_closed(self, connection, reason):
+        self._channel = None
+        # Anything not yet confirmed goes back to the outbox for the next connection
+        for tag in sorted(self._unconfirmed):
+            self._outbox.put(self._unconfirmed.pop(tag))
+        if not self._stopping:
+            logger.warning(f"Publisher connection closed ({reason}); reconnecting.")
+        connection.ioloop.stop()
+
+    def _on_channel_open(self, channel):
+        self._channel = channel
+        self._next_tag = 0
+        channel.exchange_declare(exchange=self.exchange, exchange_type='direct', durable=True,
+                                 callback=lambda _frame: channel.confirm_delivery(self._on_confirm,
+                                                                                 callback=self._on_confirm_ok))
+
+    def _on_confirm_ok(self, _frame):
+        logger.info("Publisher ready (confirms enabled).")
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._connection and self._connection.is_open:
+            self._connection.ioloop.call_later(self.flush_seconds, self._flush)
+
+    def _flush(self):
+        if self._channel is None or not self._channel.is_open:
+            return
+        sent = 0
+        while sent < self.batch_size:
+            try:
+                message = self._outbox.get_nowait()
+            except queue.Empty:
+                break
+            # AMQP priority and tenant header; enqueued_at is kept across re-sends
+            properties = task_properties(message, delivery_mode=2, content_type="application/json",
+                                         message_id=message["message_id"])
+            self._channel.basic_publish(
+                exchange=self.exchange,
+                routing_key=message["label_type"],
+                body=json.dumps(message, ensure_ascii=False),
+                properties=pika.BasicProperties(**properties))
+            self._next_tag += 1
+            self._unconfirmed[self._next_tag] = message
+            sent += 1
+        if sent:
+            logger.debug(f"Published batch of {sent} tasks ({len(self._unconfirmed)} awaiting confirm).")
+        if self._stopping and not self.backlog():
+            self._connection.close()
+            return
+        self._schedule_flush()
+
+    def _on_confirm(self, frame):
+        method = frame.method
+        tags = [t for t in self._unconfirmed if t <= method.delivery_tag] if method.multiple else [method.delivery_tag]
+        acked = method.NAME == "Basic.Ack"
+        for tag in tags:
+            message = self._unconfirmed.pop(tag, None)
+            if message is None:
+                continue
+            if acked:
+                if self.on_confirmed:
+                    self.on_confirmed(message)
+            else:
+                logger.warning(f"Broker nacked task for {message['file_path']}; re-sending.")
+                self._outbox.put(message)
+
+    def close(self, timeout=30):
+        self._stopping = True
+        deadline = time.monotonic() + timeout
+        while self._thread.is_alive() and time.monotonic() < deadline:
+            time.sleep(0.1)
+        if self.backlog():
+            logger.warning(f"Publisher stopped with {self.backlog()} tasks not confirmed.")
+
+
+# --- Detector ---
+class LabelDetector:
+    def __init__(self, base_folder=DAILY_FOLDER_BASE, watch_mode=WATCH_MODE):
+        self.base_folder = base_folder
+        self.watch_mode = watch_mode
+        self.pending = PendingFiles()
+        self.publisher = BatchPublisher(on_confirmed=self._record_published)
+        # PDFs travel inline or through the blob store, so consumers need no shared mount (see task_payload.py)
+        self.store = open_store()
+        self.folder = None
+        self.seen = set()
+        self._ledger = None
+        self._ledger_lock = threading.Lock()
+        self._observer = None
+
+    def _open_day(self):
+        folder = os.path.join(self.base_folder, datetime.date.today().strftime("%Y-%m-%d"))
+        if folder == self.folder:
+            return
+        self._stop_observer()
+        os.makedirs(folder, exist_ok=True)
+        ledger_path = os.path.join(folder, LEDGER_NAME)
+        with self._ledger_lock:
+            if self._ledger:
+                self._ledger.close()
+            self.seen = set()
+            if os.path.exists(ledger_path):
+                with open(ledger_path, encoding="utf-8") as f:
+                    self.seen = {line.rstrip("\n") for line in f if line.strip()}
+            self._ledger = open(ledger_path, "a", encoding="utf-8")
+        self.folder = folder
+        logger.info(f"👀 Watching daily folder: {folder} ({len(self.seen)} files already published)")
+        scan_folder(folder, self.pending, self.seen)  # files dropped while we were down
+        self._start_observer()
+
+    def _start_observer(self):
+        use_events = self.watch_mode in ("auto", "events") and Observer is not None
+        if self.watch_mode == "events" and Observer is None:
+            logger.warning("watchdog is not installed; falling back to polling.")
+        if use_events:
+            self._observer = Observer()
+            self._observer.schedule(_EventHandler(self.pending), self.folder, recursive=False)
+            self._observer.start()
+
+    def _stop_observer(self):
+        if self._observer:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
+
+    def _record_published(self, message):
+        with self._ledger_lock:
+            if self._ledger:
+                self._ledger.write(message["file_path"] + "\n")
+                self._ledger.flush()
+
+    def run(self):
+        self.publisher.start()
+        last_scan = 0.0
+        while True:
+            self._open_day()
+            if self._observer is None and time.monotonic() - last_scan >= POLL_INTERVAL_SECONDS:
+                scan_folder(self.folder, self.pending, self.seen)
+                last_scan = time.monotonic()
+            for path in self.pending.ready():
+                if path in self.seen:
+                    continue
+                self.seen.add(path)
+                label_type = classify_label(path)
+                if label_type is None:
+                    logger.warning(f"Could not classify {path}; skipping.")
+                    continue
+                logger.info(f"📄 Detected {label_type} label: {path}")
+                try:
+                    message = {"file_path": path, "label_type": label_type, "priority": classify_priority(path)}
+                    if LABEL_TENANT:
+                        message["tenant"] = LABEL_TENANT
+                    message = attach_payload(message, store=self.store)
+                except OSError as e:
+                    # Gone or unreadable since it settled, or the blob store is down: tried again on the next scan
+                    logger.error(f"Cannot attach {path} to its task: {e}")
+                    self.seen.discard(path)
+                    continue
+                self.publisher.publish(message)
+            time.sleep(0.2)
+
+    def close(self):
+        self._stop_observer()
+        self.publisher.close()
+        with self._ledger_lock:
+            if self._ledger:
+                self._ledger.close()
+                self._ledger = None
+
+
+# --- Entry Point ---
+def main():
+    detector = LabelDetector()
+    try:
+        detector.run()
+    except KeyboardInterrupt:
+        logger.info("KeyboardInterrupt received. Stopping detector...")
+    finally:
+        detector.close()
+        logger.info("Label detector stopped.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+import os
+import re
+import hashlib
+from dotenv import load_dotenv  # type: ignore
+
+from model_tiering import parse_escalation
+
+load_dotenv()
+
+NOT_FOUND = "Not found"
+# Ways models say "missing" besides the requested "Not found"
+MISSING_VALUES = {"", "not found", "n/a", "na", "none", "null", "unknown", "-", "không có", "không tìm thấy"}
+
+
+# --- Handler ---
+# Everything that differs between label types: where the tasks come from,
+# what Gemini is asked, which fields the answer must have, and how many
+# labels of this type may be in flight at once.
+class LabelHandler:
+    def __init__(self, name, routing_key, queue, prompt, fields, concurrency=1,
+                 ocr_fallback=True, fast_path=False, ocr_stop_when=None, validate=None, escalation=(),
+                 normalizers=None, anchors=None, split_key=None, barcode_fields=None):
+        self.name = name
+        self.routing_key = routing_key
+        self.queue = queue
+        self.prompt = prompt
+        self.fields = tuple(fields)
+        self.concurrency = max(1, concurrency)
+        self.ocr_fallback = ocr_fallback
+        self.fast_path = fast_path          # try fast_path.extract_fast before Gemini
+        self.ocr_stop_when = ocr_stop_when  # text -> bool, lets OCR stop before the last page
+        self.validate = validate            # data -> [failed checks], used by model tiering
+        self.escalation = tuple(escalation)  # model_tiering steps for answers that fail validation
+        self.normalizers = dict(normalizers or {})  # field -> (str -> str), applied to Gemini's values
+        self.anchors = anchors              # regex of lines the prompt reducer must keep (and may crop around)
+        self.split_key = split_key          # line -> key | None; a new key starts a new label (label_splitter.py)
+        self.barcode_fields = barcode_fields  # field -> regex of plain barcode values (barcode_stage.py)
+        # Cached results are only reused for the same prompt text
+        self.prompt_version = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:12]
+
+    # Fill in fields Gemini left out and bring values to one format, so every
+    # stored result has the same shape
+    def normalize(self, data):
+        if not isinstance(data, dict):
+            return None
+        for field in self.fields:
+            value = _as_text(data.get(field))
+            if value is None or value.strip().lower() in MISSING_VALUES:
+                data[field] = NOT_FOUND
+            elif field in self.normalizers:
+                data[field] = self.normalizers[field](value.strip())
+            else:
+                data[field] = value.strip()
+        return data
+
+    # Checks a normalized answer must pass to skip escalation; empty when it is good enough
+    def problems(self, data):
+        if not isinstance(data, dict):
+            return ["no result"]
+        return self.validate(data) if self.validate else []
+
+
+# Lists and nested objects (e.g. {"name": ..., "phone": ...}) become one comma-joined string
+def _as_text(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        parts = [_as_text(item) for item in value]
+        return ", ".join(part.strip() for part in parts if part and part.strip())
+    return str(value)
+
+
+# --- Registry ---
+HANDLERS = {}
+
+
+def register_handler(handler):
+    HANDLERS[handler.name] = handler
+    return handler
+
+
+def get_handlers(names=None):
+    if not names:
+        return list(HANDLERS.values())
+    unknown = [n for n in names if n not in HANDLERS]
+    if unknown:
+        raise ValueError(f"Unknown label type(s): {', '.join(unknown)}. Known: {', '.join(HANDLERS)}")
+    return [HANDLERS[n] for n in names]
+
+
+# --- Shipping labels ---
+SHIPPING_PROMPT = """
+You are an AI agent specialized in analyzing shipping labels from various courier services.
+Your task is to extract key shipment details from the attached shipping label (provided as a PDF document).
+Labels may be in different languages (including Vietnamese and English), contain both printed and handwritten text,
+and come in a variety of formats. Please extract the following fields clearly and return them in a clean JSON object:
+1. tracking_number  The shipment tracking number (e.g., SPXVM056647973), often labeled as "Tracking No.", "Tracking ID", or "Mã vận đơn". If multiple tracking numbers are present, prioritize the primary one or the longest one.
+2. order_id  The customer order ID (e.g., "258319PMADJ01"), often labeled as "Order ID" or "Mã đơn hàng".
+3. sender_address  Full sender's name, phone number, and address, typically after keywords like "FROM", "Từ", or "Sender".
+4. recipient_address  Full receiver's name, phone number, and address, typically after keywords like "TO", "Đến", or "Receiver".
+If any field is missing, ambiguous, or not found, return its value as "Not found".
+Return your output strictly as a valid JSON object. Do not include any explanations or additional text.
+Example output format: {"tracking_number": "...", "order_id": "...", "sender_address": "...", "recipient_address": "...", "delivery_date": "..."}
+"""
+
+# Fields OCR must have seen before it may stop early
+TRACKING_NUMBER_PATTERN = re.compile(r"\b[A-Z]{2,6}\d{8,14}\b")
+SENDER_ANCHOR_PATTERN = re.compile(r"\b(FROM|Từ|Sender)\b", re.IGNORECASE)
+RECIPIENT_ANCHOR_PATTERN = re.compile(r"\b(TO|Đến|Receiver)\b", re.IGNORECASE)
+
+
+# Lines around these carry the fields; see prompt_reducer.py
+SHIPPING_ANCHOR_PATTERN = re.compile(
+    r"\b(FROM|Từ|Sender|TO|Đến|Receiver|Tracking|Mã vận đơn|Order|Mã đơn hàng)\b", re.IGNORECASE)
+
+
+def shipping_fields_found(text):
+    return bool(TRACKING_NUMBER_PATTERN.search(text)
+                and SENDER_ANCHOR_PATTERN.search(text)
+                and RECIPIENT_ANCHOR_PATTERN.search(text))
+
+
+# One tracking number per label: a new one on a page of a multi-label PDF starts the next label
+def shipping_split_key(line):
+    match = TRACKING_NUMBER_PATTERN.search(line)
+    return match.group(0) if match else None
+
+
+# Order ids as couriers encode them in barcodes: 258319PMADJ01
+ORDER_ID_PATTERN = re.compile(r"\d{6}[A-Z]{2,}[A-Z0-9]{1,10}")
+
+
+# Vietnamese phone numbers, including the partly masked ones couriers print (e.g. 84*****123)
+PHONE_PATTERN = re.compile(r"(?:\+?84|\b0)[\d\s.*()-]{6,14}\d")
+
+
+# A full phone number, possibly spaced or dotted: 0912 345 678, +84 912.345.678
+PHONE_CANDIDATE_PATTERN = re.compile(r"(?<![\w*+])(?:\+84|84|0)(?:[\s.()-]?\d){9}(?![\d*])")
+
+
+def normalize_tracking_number(value):
+    compact = re.sub(r"[\s.-]", "", value).upper()
+    return compact if TRACKING_NUMBER_PATTERN.fullmatch(compact) else value
+
+
+# Phone numbers inside an address are written as 10 digits starting with 0
+def normalize_phones(value):
+    def compact(match):
+        digits = re.sub(r"\D", "", match.group(0))
+        if digits.startswith("84") and len(digits) == 11:
+            digits = "0" + digits[2:]
+        return digits if len(digits) == 10 else match.group(0)
+    return PHONE_CANDIDATE_PATTERN.sub(compact, value)
+
+
+def validate_shipping(data):
+    problems = []
+    if not TRACKING_NUMBER_PATTERN.fullmatch(str(data.get("tracking_number", "")).strip()):
+        problems.append("tracking_number")
+    for field in ("sender_address", "recipient_address"):
+        if data.get(field, NOT_FOUND) == NOT_FOUND:
+            problems.append(field)
+    if not PHONE_PATTERN.search(str(data.get("recipient_address", ""))):
+        problems.append("recipient_phone")
+    return problems
+
+
+SHIPPING_HANDLER = register_handler(LabelHandler(
+    name="shipping",
+    routing_key="shipping",
+    queue="shipping_queue",
+    prompt=SHIPPING_PROMPT,
+    fields=("tracking_number", "order_id", "sender_address", "recipient_address"),
+    concurrency=int(os.getenv("SHIPPING_CONCURRENCY", "4")),
+    fast_path=True,
+    ocr_stop_when=shipping_fields_found,
+    validate=validate_shipping,
+    escalation=parse_escalation(os.getenv("SHIPPING_ESCALATION", "ocr,model")),
+    normalizers={"tracking_number": normalize_tracking_number,
+                 "sender_address": normalize_phones, "recipient_address": normalize_phones},
+    anchors=SHIPPING_ANCHOR_PATTERN,
+    split_key=shipping_split_key,
+    barcode_fields={"tracking_number": TRACKING_NUMBER_PATTERN, "order_id": ORDER_ID_PATTERN},
+))
+
+
+# --- Return labels ---
+RETURN_PROMPT = """
+You are an AI agent specialized in analyzing return labels from e-commerce platforms and courier services.
+Your task is to extract key return details from the attached return label (provided as a PDF document).
+Labels may be in Vietnamese or English. Please extract the following fields and return them in a clean JSON object:
+1. return_id  The return / RMA number, often labeled as "Return ID", "RMA" or "Mã hoàn hàng".
+2. order_id  The original customer order ID, often labeled as "Order ID" or "Mã đơn hàng".
+3. return_reason  The reason for the return, often labeled as "Reason" or "Lý do".
+4. return_date  The date of the return request or drop-off.
+If any field is missing, ambiguous, or not found, return its value as "Not found".
+Return your output strictly as a valid JSON object. Do not include any explanations or additional text.
+Example output format: {"return_id": "...", "order_id": "...", "return_reason": "...", "return_date": "..."}
+"""
+
+RETURN_ANCHOR_PATTERN = re.compile(
+    r"\b(Return|RMA|Mã hoàn hàng|Order|Mã đơn hàng|Reason|Lý do|Date|Ngày)\b", re.IGNORECASE)
+
+
+RETURN_ID_PATTERN = re.compile(r"(?:Return ID|RMA|Mã hoàn hàng)\s*(?:No\.?|#)?\s*[:#]?\s*([A-Z0-9][A-Z0-9-]{4,})",
+                               re.IGNORECASE)
+
+
+def return_split_key(line):
+    match = RETURN_ID_PATTERN.search(line)
+    return match.group(1).upper() if match else None
+
+
+def validate_return(data):
+    return [field for field in ("return_id", "order_id") if data.get(field, NOT_FOUND) == NOT_FOUND]
+
+
+RETURN_HANDLER = register_handler(LabelHandler(
+    name="return",
+    routing_key="return",
+    queue="return_queue",
+    prompt=RETURN_PROMPT,
+    fields=("return_id", "order_id", "return_reason", "return_date"),
+    concurrency=int(os.getenv("RETURN_CONCURRENCY", "2")),
+    validate=validate_return,
+    escalation=parse_escalation(os.getenv("RETURN_ESCALATION", "model")),
+    anchors=RETURN_ANCHOR_PATTERN,
+    split_key=return_split_key,
+))
@@ -0,0 +1,313 @@
+import json
+import logging
+from dotenv import load_dotenv  # type: ignore
+
+from label_cache import (open_cache, file_digest, text_digest, KIND_PDF_TEXT, KIND_OCR_TEXT, KIND_PAGE_TEXT,
+                         KIND_RESULT, KIND_BARCODES)
+from ocr_stage import stream_ocr, ocr_pages, POPPLER_PATH, OCR_SETTINGS, OCR_EARLY_STOP
+from page_router import extract_routed_text, PAGE_ROUTING_ENABLED
+from gemini_batcher import GeminiBatcher, GEMINI_BATCH_SIZE, estimate_tokens
+from fast_path import extract_fast
+from rate_limiter import GeminiGuard, GeminiUnavailable
+from model_pool import model_pool, GEMINI_MODEL_NAME
+from metrics import stage_timer, OCR_FALLBACKS, EMPTY_RESPONSES
+from response_parser import parse_response, generation_config, generate_structured, ResponseParseError
+from model_tiering import Escalator, TIERING_ENABLED, GEMINI_STRONG_MODEL, ESCALATION_OCR_DPI
+from prompt_reducer import PromptReducer, token_counter, PROMPT_SYSTEM_INSTRUCTION
+from barcode_stage import (read_barcodes, barcode_fields, record_decode, can_skip_llm, reconcile, decoder,
+                           BARCODE_ENABLED, BARCODE_SKIP_LLM)
+
+# Steps shared by every label type: text extraction (pypdf, OCR fallback),
+# the extraction cache, and the Gemini call. Used by label_agent.py and the
+# single-queue processors.
+
+# Load environment variables from .env file
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# TESSERACT_CMD_PATH, GHOSTSCRIPT_PATH and POPPLER_PATH are applied by
+# ocr_stage.ocr_backend() when OCR is first needed; pypdf, pytesseract and
+# google.generativeai are imported on first use too (see startup.py).
+
+# --- Gemini models: one client per model name per process (see model_pool.py) ---
+def get_gemini_model(model_name=GEMINI_MODEL_NAME):
+    return model_pool.get(model_name)
+
+
+# --- Extraction cache (pypdf text, OCR text and Gemini JSON, content-addressed) ---
+extraction_cache = open_cache()
+
+# --- Gemini rate limits, retries and circuit breaker (shared with other processes via SQLite) ---
+gemini_guard = GeminiGuard()
+
+
+# --- Extract PDF text via pypdf ---
+def extract_text_from_pdf(pdf_path):
+    text = ""
+    try:
+        with stage_timer("extract_text_from_pdf"):
+            from pypdf import PdfReader  # imported on first use, see startup.py
+            reader = PdfReader(pdf_path)
+            for page in reader.pages:
+                extracted = page.extract_text()
+                if extracted:
+                    text += extracted + "\n"
+    except FileNotFoundError:
+        logger.error(f"File not found: {pdf_path}")
+        return ""
+    except Exception as e:
+        logger.error(f"Error reading PDF {pdf_path} with pypdf: {e}", exc_info=True)
+        return ""
+    return text.strip()
+
+
+# --- Fallback OCR for image-based PDFs ---
+def extract_text_with_ocr(pdf_path, stop_when=None):
+    logger.info(f"🔁 Falling back to OCR for: {pdf_path}")
+    OCR_FALLBACKS.labels("document").inc()
+    try:
+        # Path to the directory containing pdftoppm.exe
+        if not POPPLER_PATH:
+            logger.warning("POPPLER_PATH not configured. OCR might fail or be slow.")
+        # Pages are rendered one window at a time and OCR'd in parallel (see ocr_stage.py)
+        return stream_ocr(pdf_path, stop_when=stop_when)
+    except Exception as e:
+        logger.error(f"OCR failed for {pdf_path}: {e}", exc_info=True)
+        return ""
+
+
+# --- Per-page routing: pypdf where the text layer is usable, OCR only where it isn't ---
+def extract_text_per_page(file_path, ocr_fallback=True, stop_when=None):
+    try:
+        text, report = extract_routed_text(file_path, ocr_fallback=ocr_fallback, stop_when=stop_when)
+    except FileNotFoundError:
+        logger.error(f"File not found: {file_path}")
+        return ""
+    except Exception as e:
+        logger.error(f"Per-page extraction failed for {file_path}: {e}", exc_info=True)
+        return ""
+    routes = [entry["route"] for entry in report]
+    text_ms = sum(entry["text_ms"] for entry in report)
+    ocr_ms = sum(entry["ocr_ms"] for entry in report)
+    logger.info(f"Page routing for {file_path}: {routes.count('text')} text, {routes.count('ocr')} OCR, "
+                f"{routes.count('skipped')} skipped ({text_ms:.0f} ms pypdf, {ocr_ms:.0f} ms OCR)")
+    return text
+
+
+# --- Cache key of page/OCR text ---
+# The same file read with other OCR settings, without OCR, or stopped early
+# by another stop_when gives other text, so each is its own entry. A
+# stop_when without a stable name (lambda, partial) is not cached (None).
+def text_cache_key(file_hash, ocr_fallback=True, stop_when=None):
+    if not file_hash:
+        return None
+    stop = ""
+    if stop_when is not None and OCR_EARLY_STOP:
+        stop = f"{getattr(stop_when, '__module__', None)}.{getattr(stop_when, '__qualname__', '<unnamed>')}"
+        if "<" in stop:
+            return None
+    return text_digest(file_hash, f"ocr_fallback={bool(ocr_fallback)}", OCR_SETTINGS, stop)
+
+
+# --- Read label text: pypdf first, OCR fallback ---
+def read_label_text(file_path, ocr_fallback=True, stop_when=None):
+    try:
+        file_hash = file_digest(file_path)
+    except OSError as e:
+        logger.error(f"Cannot hash {file_path} for the extraction cache: {e}")
+        file_hash = None
+
+    if PAGE_ROUTING_ENABLED:
+        key = text_cache_key(file_hash, ocr_fallback, stop_when)
+        pdf_text = extraction_cache.get(KIND_PAGE_TEXT, key)
+        if pdf_text is None:
+            pdf_text = extract_text_per_page(file_path, ocr_fallback=ocr_fallback, stop_when=stop_when)
+            if pdf_text:
+                extraction_cache.put(KIND_PAGE_TEXT, key, pdf_text)
+        logger.debug(f"🔍 PDF Text Preview (per page) for {file_path}:\n{pdf_text[:300] if pdf_text else '[Empty]'}")
+        return pdf_text
+
+    # Whole-document mode (PAGE_ROUTING_ENABLED=false)
+    # Step 1: Try extract with pypdf
+    pdf_text = extraction_cache.get(KIND_PDF_TEXT, file_hash)
+    if pdf_text is None:
+        pdf_text = extract_text_from_pdf(file_path)
+        if file_hash:
+            extraction_cache.put(KIND_PDF_TEXT, file_hash, pdf_text)
+    logger.debug(f"🔍 PDF Text Preview (pypdf) for {file_path}:\n{pdf_text[:300] if pdf_text else '[Empty]'}")
+
+    # Step 2: Fallback to OCR if needed
+    if not pdf_text.strip() and ocr_fallback:
+        key = text_cache_key(file_hash, True, stop_when)
+        pdf_text = extraction_cache.get(KIND_OCR_TEXT, key)
+        if pdf_text is None:
+            pdf_text = extract_text_with_ocr(file_path, stop_when=stop_when)
+            if pdf_text:
+                extraction_cache.put(KIND_OCR_TEXT, key, pdf_text)
+        logger.debug(f"🔍 PDF Text Preview (OCR) for {file_path}:\n{pdf_text[:300] if pdf_text else '[Empty]'}")
+    return pdf_text
+
+
+# --- Single Gemini call for one label ---
+# prompt=None when the model already carries it as its system instruction
+def request_label(model, prompt, pdf_content, label_name="label", fields=(), config=None):
+    try:
+        logger.info(f"Sending content (length: {len(pdf_content)}) to Gemini for {label_name} label processing.")
+        parts = [pdf_content] if prompt is None else [prompt, pdf_content]
+        response = generate_structured(gemini_guard.generate, model, parts, config)
+
+        if response.parts:
+            result = response.parts[0].text
+            logger.debug(f"=== Gemini Raw Response ({label_name}) ===\n{result}")
+            # JSON mode answers parse directly; fenced, chatty or truncated ones are recovered where possible
+            try:
+                return parse_response(result, fields=fields)
+            except ResponseParseError as e:
+                logger.error(f"JSON decode error for {label_name} label: {e}. Raw response: '{result}'")
+                return None
+        else:
+            EMPTY_RESPONSES.inc()
+            logger.warning(f"No content (parts) received from Gemini for {label_name} label. Prompt feedback: {getattr(response, 'prompt_feedback', 'N/A')}")
+            return None
+
+    except GeminiUnavailable:
+        raise  # the message goes back to the queue; see worker_pool.py
+    except Exception as e:
+        logger.error(f"Error during Gemini extraction for {label_name} label: {e}", exc_info=True)
+        if 'response' in locals() and hasattr(response, 'prompt_feedback'): # Log feedback if available
+            logger.error(f"Gemini Prompt Feedback: {response.prompt_feedback}")
+        return None
+
+
+# --- Per-handler extraction: barcodes, fast path, cache, (batched) Gemini ---
+class LabelExtractor:
+    def __init__(self, handler, model=None, model_name=GEMINI_MODEL_NAME):
+        self.handler = handler
+        # Without an explicit model, the label type's model follows MODEL_CONFIG_PATH and
+        # the static prompt is set once as its system instruction instead of sent per request
+        self.system_instruction = handler.prompt if model is None and PROMPT_SYSTEM_INSTRUCTION else None
+        self.prompt = None if self.system_instruction else handler.prompt
+        self.model = model or model_pool.handle(handler.name, self.system_instruction)
+        self.model_name = model_name
+        # Normalize, dedupe and filter the label text before it is sent (see prompt_reducer.py)
+        self.reducer = PromptReducer(handler.name, handler.anchors, token_counter(self.model))
+        # JSON mode with a response schema built from the handler's fields (see response_parser.py)
+        self.generation_config = generation_config(handler.fields)
+        # Batching layer: several labels share one request (only useful with the worker pool)
+        self.batcher = GeminiBatcher(self.model, self.prompt or "", self.request, generate=gemini_guard.generate,
+                                     generation_config=generation_config(handler.fields, array=True)
+                                     ) if GEMINI_BATCH_SIZE > 1 else None
+        # Model tiering: answers failing handler.validate are escalated (OCR re-run, stronger model)
+        self.escalator = None
+        if TIERING_ENABLED and handler.validate and handler.escalation:
+            self.escalator = Escalator(handler, self.first_tier, self.strong_tier, self.rerun_ocr,
+                                       token_fn=lambda text: estimate_tokens(handler.prompt + text))
+
+    def request(self, pdf_content):
+        return request_label(self.model, self.prompt, pdf_content, self.handler.name,
+                             self.handler.fields, self.generation_config)
+
+    def first_tier(self, pdf_content):
+        if self.batcher:
+            return self.handler.normalize(self.batcher.submit(pdf_content))
+        return self.handler.normalize(self.request(pdf_content))
+
+    def strong_tier(self, pdf_content):
+        model = model_pool.get(GEMINI_STRONG_MODEL, self.system_instruction)
+        return self.handler.normalize(request_label(model, self.prompt, pdf_content, self.handler.name,
+                                                    self.handler.fields, self.generation_config))
+
+    # pages: only the pages of one label of a multi-label file (see label_splitter.py)
+    def rerun_ocr(self, file_path, pages=None):
+        logger.info(f"🔁 Re-running OCR at {ESCALATION_OCR_DPI} DPI for: {file_path} {pages or ''}")
+        try:
+            if pages:
+                texts = ocr_pages(file_path, pages, dpi=ESCALATION_OCR_DPI)
+                return self.reducer.reduce("\n".join(texts[n] for n in sorted(texts)).strip(), extra=True)
+            return self.reducer.reduce(stream_ocr(file_path, dpi=ESCALATION_OCR_DPI), extra=True)
+        except Exception as e:
+            logger.error(f"OCR re-run failed for {file_path}: {e}", exc_info=True)
+            return ""
+
+    # Fields decoded from the label's barcodes (see barcode_stage.py); symbols are cached per file and pages
+    def read_barcodes(self, file_path, pages=None, text="", record=True):
+        if not BARCODE_ENABLED or not self.handler.barcode_fields or not file_path:
+            return {}
+        try:
+            key = text_digest(file_digest(file_path), ",".join(str(n) for n in pages or ()))
+        except OSError:
+            key = None
+        symbols = extraction_cache.get(KIND_BARCODES, key)
+        if symbols is None:
+            symbols = read_barcodes(file_path, pages)
+            if decoder() is not None:  # without one, nothing was tried: a decoder installed later must run
+                extraction_cache.put(KIND_BARCODES, key, symbols)
+        barcodes = barcode_fields(symbols, self.handler.barcode_fields, text)
+        if record:
+            record_decode(barcodes)
+        return barcodes
+
+    # Runs before text extraction: with BARCODE_SKIP_LLM, a label whose required
+    # fields decode is answered without pypdf, OCR or Gemini. None otherwise;
+    # process() then gets the text and reads the (cached) symbols again.
+    def barcode_answer(self, file_path, pages=None):
+        if not BARCODE_SKIP_LLM:
+            return None
+        barcodes = self.read_barcodes(file_path, pages, record=False)
+        if not can_skip_llm(barcodes):
+            return None
+        record_decode(barcodes)
+        logger.info(f"▮ Barcodes gave {', '.join(barcodes)}. Skipping OCR and Gemini.")
+        return self.handler.normalize(dict(barcodes))
+
+    def process(self, pdf_content, file_path=None, pages=None):
+        name = self.handler.name
+        # Barcode values fill or correct the extracted fields, or replace Gemini when they are all that's needed
+        barcodes = self.read_barcodes(file_path, pages, pdf_content)
+        if can_skip_llm(barcodes):
+            logger.info(f"▮ Barcodes gave {', '.join(barcodes)}. Skipping Gemini call.")
+            return self.handler.normalize(dict(barcodes))
+        if not pdf_content.strip():
+            # Nothing for Gemini to read: the barcodes are the whole answer, if any decoded
+            if barcodes:
+                logger.info(f"▮ No text in the {name} label; answering with its barcodes ({', '.join(barcodes)}).")
+                return self.handler.normalize(dict(barcodes))
+            logger.warning(f"PDF content for {name} label is empty. Skipping Gemini call.")
+            return None
+
+        # Known courier layouts are parsed with regex templates; Gemini only sees the rest
+        if self.handler.fast_path:
+            fast_data, template_name = extract_fast(pdf_content)
+            if fast_data:
+                logger.info(f"⚡ Fast path '{template_name}' extracted all required fields. Skipping Gemini call.")
+                return reconcile(name, fast_data, barcodes)
+
+        pdf_content = self.reducer.reduce(pdf_content)
+        model_name = getattr(self.model, "model_name", None) or self.model_name
+        result_key = text_digest(model_name, self.handler.prompt_version, pdf_content)
+        cached = extraction_cache.get(KIND_RESULT, result_key)
+        if cached is not None:
+            logger.info(f"♻️ Using cached Gemini result for identical {name} label content.")
+            return reconcile(name, cached, barcodes)
+
+        if self.escalator:
+            data = self.escalator.run(pdf_content, file_path, pages)
+        else:
+            data = self.first_tier(pdf_content)
+        if data is not None:
+            extraction_cache.put(KIND_RESULT, result_key, data)
+        return reconcile(name, data, barcodes)
+
+    def shutdown(self):
+        if self.batcher:
+            self.batcher.shutdown()
+
+
+# --- Handle extraction result ---
+def handle_extracted_data(label_name, file_path, extracted_data):
+    if extracted_data:
+        logger.info(f"✅ Extracted {label_name.capitalize()} Label Data for {file_path}:")
+        logger.info(json.dumps(extracted_data, indent=2, ensure_ascii=False)) # Indent 2 for brevity in logs
+    else:
+        logger.error(f"Failed to extract data from {label_name} label: {file_path}")
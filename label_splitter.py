@@ -0,0 +1,190 @@
+import os
+import logging
+import collections
+from dotenv import load_dotenv  # type: ignore
+
+from page_router import measure_page, needs_ocr
+from ocr_stage import ocr_pages
+from retry_queues import LabelFailure
+from metrics import OCR_FALLBACKS, SPLIT_LABELS
+
+# Warehouse exports put dozens of labels in one PDF, usually one per page,
+# sometimes several per page. Joining every page into one text and asking
+# for one JSON object returns a single label's fields and loses the rest.
+# For files with SPLIT_MIN_PAGES pages or more the pages are streamed instead:
+#   pages     read SPLIT_WINDOW_PAGES at a time (a fresh PdfReader per window,
+#             OCR only for pages without a usable text layer)
+#   segments  a new label starts where the handler's split_key (e.g. the
+#             tracking number) changes: at a page, or inside a page holding
+#             several keys; pages without a key continue the current label
+#   fan-out   each finished segment goes to llm_fn, at most SPLIT_PARALLEL
+#             in flight, so memory stays bounded on 500-page files
+#   results   one aggregate per source file with a parent_id; the results
+#             sink also stores every label as its own row (see split_children)
+# A file that turns out to hold one label gives that label's result as before.
+
+load_dotenv()
+
+# --- Config ---
+SPLIT_ENABLED = os.getenv("SPLIT_ENABLED", "true").lower() in ("1", "true", "yes")
+SPLIT_MIN_PAGES = int(os.getenv("SPLIT_MIN_PAGES", "2"))
+SPLIT_WINDOW_PAGES = int(os.getenv("SPLIT_WINDOW_PAGES", "20"))
+SPLIT_PARALLEL = int(os.getenv("SPLIT_PARALLEL", "4"))  # labels of one file sent to Gemini at once
+# Lines above a key that belong to the new label when a page holds several (courier header, barcode)
+SPLIT_REGION_LOOKBACK = int(os.getenv("SPLIT_REGION_LOOKBACK", "1"))
+
+logger = logging.getLogger(__name__)
+
+
+class LabelSegment:
+    __slots__ = ("index", "pages", "key", "text")
+
+    def __init__(self, index, pages, key, text):
+        self.index = index
+        self.pages = pages
+        self.key = key
+        self.text = text
+
+
+# --- Pages ---
+def page_count(pdf_path):
+    from pypdf import PdfReader  # imported on first use, see startup.py
+    return len(PdfReader(pdf_path).pages)
+
+
+def should_split(pdf_path, handler):
+    if not SPLIT_ENABLED or handler.split_key is None:
+        return False
+    return page_count(pdf_path) >= SPLIT_MIN_PAGES
+
+
+# Yields (page number, text) in order. Each window gets its own PdfReader, so
+# pypdf's object cache never holds more than SPLIT_WINDOW_PAGES pages.
+def iter_page_texts(pdf_path, ocr_fallback=True, window=SPLIT_WINDOW_PAGES):
+    from pypdf import PdfReader
+    total = page_count(pdf_path)
+    window = max(1, window)
+    for start in range(1, total + 1, window):
+        reader = PdfReader(pdf_path)
+        texts, ocr_needed = {}, []
+        for number in range(start, min(total, start + window - 1) + 1):
+            try:
+                stats = measure_page(reader.pages[number - 1])
+            except Exception as e:
+                logger.warning(f"pypdf could not read page {number} of {pdf_path}: {e}")
+                stats = {"text": "", "glyphs": 0, "image_coverage": 0.0, "barcode_share": 0.0}
+            texts[number] = stats["text"]
+            if ocr_fallback and needs_ocr(stats):
+                ocr_needed.append(number)
+        del reader
+        if ocr_needed:
+            OCR_FALLBACKS.labels("page").inc(len(ocr_needed))
+            for number, text in ocr_pages(pdf_path, ocr_needed).items():
+                texts[number] = text + ("\n" + texts[number] if texts[number].strip() else "")
+        for number in sorted(texts):
+            yield number, texts[number].strip()
+
+
+# --- Segments ---
+# Splits one page into (lines, key) regions, one per distinct key on it
+def page_regions(text, split_key, lookback=SPLIT_REGION_LOOKBACK):
+    lines = [line for line in text.splitlines() if line.strip()]
+    starts, seen = [], set()
+    for i, line in enumerate(lines):
+        key = split_key(line)
+        if key and key not in seen:
+            seen.add(key)
+            starts.append((i, key))
+    if len(starts) <= 1:
+        return [(lines, starts[0][1] if starts else None)]
+    cuts = [0]
+    for i, _ in starts[1:]:
+        cuts.append(max(cuts[-1] + 1, i - lookback))
+    cuts.append(len(lines))
+    return [(lines[cuts[n]:cuts[n + 1]], key) for n, (_, key) in enumerate(starts)]
+
+
+def split_segments(pages, split_key, lookback=SPLIT_REGION_LOOKBACK):
+    index = 0
+    current_pages, current_lines, current_key = [], [], None
+    for number, text in pages:
+        for lines, key in page_regions(text, split_key, lookback):
+            if key and current_key and key != current_key:
+                yield LabelSegment(index, current_pages, current_key, "\n".join(current_lines))
+                index += 1
+                current_pages, current_lines, current_key = [], [], None
+            current_key = current_key or key
+            current_lines.extend(lines)
+            if number not in current_pages:
+                current_pages.append(number)
+    if current_lines:
+        yield LabelSegment(index, current_pages, current_key, "\n".join(current_lines))
+
+
+# --- Fan-out and aggregation ---
+# Runs llm_fn(text, file_path, pages) for every segment, through submit (an
+# executor's submit) with at most `parallel` in flight, or inline without one.
+# Returns [(segment, data)] in file order; segment texts are dropped once sent.
+def extract_segments(segments, llm_fn, file_path, submit=None, parallel=SPLIT_PARALLEL):
+    results = []
+    in_flight = collections.deque()
+    for segment in segments:
+        if not segment.text.strip():
+            results.append((segment, None))
+            continue
+        if submit is None:
+            results.append((segment, llm_fn(segment.text, file_path, segment.pages)))
+        else:
+            if len(in_flight) >= max(1, parallel):
+                done, future = in_flight.popleft()
+                results.append((done, future.result()))
+            in_flight.append((segment, submit(llm_fn, segment.text, file_path, segment.pages)))
+        segment.text = None
+    while in_flight:
+        done, future = in_flight.popleft()
+        results.append((done, future.result()))
+    return sorted(results, key=lambda item: item[0].index)
+
+
+def aggregate(file_path, parent_id, results):
+    labels, failed = [], []
+    for segment, data in results:
+        if data:
+            labels.append({**data, "parent_id": parent_id, "label_index": segment.index, "pages": segment.pages})
+        else:
+            failed.append({"label_index": segment.index, "pages": segment.pages, "key": segment.key})
+    return {"parent_id": parent_id, "source_file": file_path, "label_count": len(results),
+            "labels": labels, "failed_labels": failed}
+
+
+# Whole extraction of a multi-page file. Returns the label's data when the file
+# holds one label, the aggregate when it holds several. Labels without a result
+# fail the message (retryable: the labels that worked come from the result
+# cache next time) unless final is set, in which case they are reported in
+# failed_labels and the rest is kept. source names the file in the aggregate
+# when file_path is a local copy (see task_payload.py).
+def extract_split_file(file_path, handler, llm_fn, parent_id, submit=None, final=False, source=None):
+    pages = iter_page_texts(file_path, ocr_fallback=handler.ocr_fallback)
+    results = extract_segments(split_segments(pages, handler.split_key), llm_fn, file_path, submit)
+    if not results:
+        raise LabelFailure("unreadable", retryable=False, detail="no text after pypdf and OCR")
+    if len(results) == 1:
+        return results[0][1]
+
+    SPLIT_LABELS.labels(handler.name).inc(len(results))
+    data = aggregate(source or file_path, parent_id, results)
+    logger.info(f"✂️ Split {source or file_path} into {len(results)} {handler.name} labels "
+                f"({len(data['failed_labels'])} without a result).")
+    if not data["labels"]:
+        return None
+    if data["failed_labels"] and not final:
+        raise LabelFailure("labels_failed", retryable=True,
+                           detail=f"{len(data['failed_labels'])} of {len(results)} labels without a result")
+    return data
+
+
+# (file path, data) of every label in a split result, for ResultsSink.submit(children=...)
+def split_children(file_path, data):
+    if not isinstance(data, dict) or "labels" not in data or "parent_id" not in data:
+        return []
+    return [(f"{file_path}#label={label['label_index']}", label) for label in data["labels"]]
@@ -0,0 +1,230 @@
+import itertools
+import queue
+import threading
+import time
+from collections import deque
+from types import SimpleNamespace
+
+# In-process stand-in for a RabbitMQ broker, shaped like the parts of
+# pika.BlockingConnection / BlockingChannel the processors use.
+# Used by the benchmarks so they can run without a real RabbitMQ server.
+
+
+# A queue declared with x-max-priority: one FIFO per priority, highest first,
+# like RabbitMQ (messages without a priority count as 0)
+class PriorityQueue:
+    def __init__(self, max_priority):
+        self.max_priority = max_priority
+        self.levels = [deque() for _ in range(max_priority + 1)]
+
+    def _level(self, message):
+        priority = getattr(message[2], "priority", None) or 0
+        return self.levels[max(0, min(self.max_priority, int(priority)))]
+
+    def append(self, message):
+        self._level(message).append(message)
+
+    def appendleft(self, message):
+        self._level(message).appendleft(message)
+
+    def popleft(self):
+        for level in reversed(self.levels):
+            if level:
+                return level.popleft()
+        raise IndexError("pop from an empty queue")
+
+    def __len__(self):
+        return sum(len(level) for level in self.levels)
+
+
+# --- Broker ---
+class LocalBroker:
+    def __init__(self, stop_when_idle=False):
+        self.stop_when_idle = stop_when_idle
+        self.queues = {}
+        self.bindings = {}  # (exchange, routing_key) -> [queue names]
+        self.dead_letter = {}  # queue -> (ttl seconds, dead-letter routing key), from x-message-ttl arguments
+        self.delayed = {}  # queue -> deque of (due, routing_key, body, properties)
+        self.lock = threading.Lock()
+        self.published = 0
+        self.acked = 0
+        self.on_settle = None  # (body, acked) -> None, called on the consumer thread
+
+    def queue_declare(self, queue, durable=False, arguments=None):
+        with self.lock:
+            if arguments and "x-max-priority" in arguments and not isinstance(self.queues.get(queue), PriorityQueue):
+                waiting = self.queues.get(queue, ())
+                self.queues[queue] = PriorityQueue(arguments["x-max-priority"])
+                for message in waiting:
+                    self.queues[queue].append(message)
+            self.queues.setdefault(queue, deque())
+            if arguments and "x-message-ttl" in arguments:
+                self.dead_letter[queue] = (arguments["x-message-ttl"] / 1000,
+                                           arguments.get("x-dead-letter-routing-key", queue))
+        return SimpleNamespace(method=SimpleNamespace(queue=queue, message_count=self.queue_depth(queue)))
+
+    def queue_bind(self, exchange, queue, routing_key):
+        with self.lock:
+            self.bindings.setdefault((exchange, routing_key), [])
+            if queue not in self.bindings[(exchange, routing_key)]:
+                self.bindings[(exchange, routing_key)].append(queue)
+
+    def publish(self, exchange, routing_key, body, properties=None):
+        if isinstance(body, str):
+            body = body.encode()
+        with self.lock:
+            if exchange == "":
+                targets = [routing_key]
+            else:
+                targets = self.bindings.get((exchange, routing_key), [])
+            for name in targets:
+                if name in self.dead_letter:
+                    # Held until the TTL expires, then dead-lettered like RabbitMQ does
+                    ttl, _ = self.dead_letter[name]
+                    self.delayed.setdefault(name, deque()).append((time.monotonic() + ttl, routing_key, body, properties))
+                else:
+                    self.queues.setdefault(name, deque()).append((routing_key, body, properties))
+                self.published += 1
+
+    # Moves expired messages of TTL queues to their dead-letter queue
+    def expire(self):
+        now = time.monotonic()
+        with self.lock:
+            for name, held in self.delayed.items():
+                _, target = self.dead_letter[name]
+                while held and held[0][0] <= now:
+                    _, _, body, properties = held.popleft()
+                    self.queues.setdefault(target, deque()).append((target, body, properties))
+
+    def get(self, queue):
+        with self.lock:
+            q = self.queues.get(queue)
+            if q:
+                return q.popleft()
+            return None
+
+    def queue_depth(self, queue):
+        q = self.queues.get(queue)
+        return len(q) if q else 0
+
+    def connection(self):
+        return LocalConnection(self)
+
+
+# --- Connection ---
+class LocalConnection:
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_open = True
+        self._callbacks = queue.Queue()
+        self._channels = []
+
+    def channel(self):
+        channel = LocalChannel(self)
+        self._channels.append(channel)
+        return channel
+
+    # Same contract as pika: safe to call from any thread, runs on the consumer thread
+    def add_callback_threadsafe(self, callback):
+        self._callbacks.put(callback)
+
+    # Delivers to every channel's consumers (like pika), then runs queued callbacks
+    def process_data_events(self, time_limit=0):
+        self.broker.expire()
+        for channel in self._channels:
+            channel._deliver()
+        deadline = time.monotonic() + (time_limit or 0)
+        while True:
+            timeout = max(0.0, deadline - time.monotonic())
+            try:
+                callback = self._callbacks.get(timeout=timeout) if timeout else self._callbacks.get_nowait()
+            except queue.Empty:
+                return
+            callback()
+
+    def idle(self):
+        return all(channel._idle() for channel in self._channels)
+
+    def close(self):
+        self.is_open = False
+
+
+# --- Channel ---
+class LocalChannel:
+    def __init__(self, connection):
+        self.connection = connection
+        self.broker = connection.broker
+        self.prefetch_count = 0
+        self._consumers = []
+        self._unacked = {}
+        self._tags = itertools.count(1)
+        self._consuming = False
+        self.is_open = True
+
+    def exchange_declare(self, exchange, exchange_type="direct", durable=False):
+        pass
+
+    def queue_declare(self, queue, durable=False, arguments=None, passive=False):
+        return self.broker.queue_declare(queue, durable=durable, arguments=arguments)
+
+    def queue_bind(self, exchange, queue, routing_key):
+        self.broker.queue_bind(exchange, queue, routing_key)
+
+    def basic_qos(self, prefetch_count=0):
+        self.prefetch_count = prefetch_count
+
+    def basic_consume(self, queue, on_message_callback):
+        tag = f"ctag-{next(self._tags)}"
+        self._consumers.append((queue, on_message_callback, tag))
+        return tag
+
+    def basic_cancel(self, consumer_tag):
+        self._consumers = [c for c in self._consumers if c[2] != consumer_tag]
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.broker.publish(exchange, routing_key, body, properties)
+
+    def basic_ack(self, delivery_tag):
+        message = self._unacked.pop(delivery_tag, None)
+        with self.broker.lock:
+            self.broker.acked += 1
+        if message and self.broker.on_settle:
+            self.broker.on_settle(message[2], True)
+
+    def basic_nack(self, delivery_tag, requeue=True):
+        message = self._unacked.pop(delivery_tag, None)
+        if message and self.broker.on_settle:
+            self.broker.on_settle(message[2], False)
+        if message and requeue:
+            queue_name, routing_key, body, properties = message
+            with self.broker.lock:
+                self.broker.queues[queue_name].appendleft((routing_key, body, properties))
+
+    def stop_consuming(self):
+        self._consuming = False
+
+    def _deliver(self):
+        delivered = False
+        for queue_name, on_message, _ in self._consumers:
+            while not self.prefetch_count or len(self._unacked) < self.prefetch_count:
+                message = self.broker.get(queue_name)
+                if message is None:
+                    break
+                routing_key, body, properties = message
+                tag = next(self._tags)
+                self._unacked[tag] = (queue_name, routing_key, body, properties)
+                method = SimpleNamespace(delivery_tag=tag, routing_key=routing_key, redelivered=False)
+                on_message(self, method, properties or SimpleNamespace(headers=None, message_id=None), body)
+                delivered = True
+        return delivered
+
+    def _idle(self):
+        return (not self._unacked and not any(self.broker.delayed.values())
+                and all(self.broker.queue_depth(q) == 0 for q, _, _ in self._consumers))
+
+    def start_consuming(self):
+        self._consuming = True
+        while self._consuming:
+            self.connection.process_data_events(time_limit=0.01)
+            if self.broker.stop_when_idle and self.connection.idle():
+                self._consuming = False
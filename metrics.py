@@ -0,0 +1,202 @@
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import threading
+import contextlib
+import collections
+from dotenv import load_dotenv  # type: ignore
+
+load_dotenv()
+
+# --- Config ---
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))  # 0 disables the /metrics endpoint
+METRICS_DIR = os.getenv("METRICS_DIR", os.path.join(tempfile.gettempdir(), "label_metrics"))
+QUEUE_DEPTH_INTERVAL = float(os.getenv("QUEUE_DEPTH_INTERVAL", "5"))
+# Sampling profiler: snapshots every thread's stack, like py-spy, and writes collapsed stacks
+PROFILE_ENABLED = os.getenv("PROFILE_ENABLED", "false").lower() in ("1", "true", "yes")
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "10"))
+PROFILE_PATH = os.getenv("PROFILE_PATH", "label_profile.txt")
+
+logger = logging.getLogger(__name__)
+
+# pypdf/OCR run in worker processes: with prometheus_client's multiprocess mode
+# every process writes its samples under one directory per agent run (children
+# inherit the variable) and /metrics adds them up.
+if METRICS_ENABLED and "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = os.path.join(METRICS_DIR, str(os.getpid()))
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+try:
+    import prometheus_client  # type: ignore
+    from prometheus_client import multiprocess  # type: ignore
+except ImportError:  # metrics become no-ops
+    prometheus_client = None
+
+
+class _NoopMetric:
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+def _metric(kind, name, documentation, labelnames=(), **kwargs):
+    if not METRICS_ENABLED or prometheus_client is None:
+        return _NoopMetric()
+    return getattr(prometheus_client, kind)(name, documentation, labelnames, **kwargs)
+
+
+# --- Metrics ---
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# stage: extract_text_from_pdf, convert_from_path, ocr_preprocess, image_to_string, barcode_decode,
+#        generate_content, json_parse
+STAGE_SECONDS = _metric("Histogram", "label_stage_seconds", "Time spent per processing stage", ("stage",),
+                        buckets=STAGE_BUCKETS)
+OCR_FALLBACKS = _metric("Counter", "label_ocr_fallbacks_total", "Documents or pages sent to OCR", ("mode",))
+JSON_DECODE_FAILURES = _metric("Counter", "label_json_decode_failures_total", "Gemini answers that were not valid JSON")
+JSON_RECOVERED = _metric("Counter", "label_json_recovered_total",
+                         "Gemini answers parsed only after fence stripping, extraction or repair", ("method",))
+# stage: raw (extracted text) or sent (after prompt_reducer.py)
+PROMPT_TOKENS = _metric("Counter", "label_prompt_tokens_total", "Estimated label text tokens", ("label_type", "stage"))
+SPLIT_LABELS = _metric("Counter", "label_split_labels_total", "Labels found in multi-label files", ("label_type",))
+BARCODE_CHECKS = _metric("Counter", "label_barcode_checks_total",
+                         "Barcode values compared with the extracted fields", ("label_type", "field", "outcome"))
+EMPTY_RESPONSES = _metric("Counter", "label_empty_responses_total", "Gemini responses without content parts")
+MESSAGES = _metric("Counter", "label_messages_total", "Processed queue messages", ("label_type", "outcome"))
+IN_FLIGHT = _metric("Gauge", "label_in_flight", "Labels being processed", ("label_type",),
+                    multiprocess_mode="livesum")
+QUEUE_DEPTH = _metric("Gauge", "label_queue_depth", "Messages waiting in the broker queue", ("queue",),
+                      multiprocess_mode="livemax")
+# tenant: the task's merchant or courier (see fair_scheduler.py); keep TENANT_KEYS to low-cardinality fields
+QUEUE_LATENCY = _metric("Histogram", "label_queue_latency_seconds", "Time from publishing to the start of processing",
+                        ("label_type", "tenant"), buckets=(0.1, 0.5, 1, 5, 15, 30, 60, 300, 900, 1800, 3600))
+SCHEDULER_PENDING = _metric("Gauge", "label_scheduler_pending", "Deliveries waiting for a worker in the consumer",
+                            ("label_type", "tenant"), multiprocess_mode="livesum")
+# Whole label, delivery to settle; supervisor.py sizes the worker pools from it
+LABEL_SECONDS = _metric("Histogram", "label_processing_seconds", "Time to process one label", ("label_type",),
+                        buckets=STAGE_BUCKETS)
+# state: running or draining
+SUPERVISOR_WORKERS = _metric("Gauge", "label_supervisor_workers", "Worker processes started by supervisor.py",
+                             ("label_type", "state"), multiprocess_mode="livemax")
+
+
+@contextlib.contextmanager
+def stage_timer(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - start)
+
+
+# --- /metrics endpoint ---
+def start_metrics_server(port=METRICS_PORT):
+    if not METRICS_ENABLED or not port:
+        return
+    if prometheus_client is None:
+        logger.warning("prometheus_client is not installed; /metrics endpoint disabled.")
+        return
+    _remove_stale_dirs()
+    registry = prometheus_client.CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    try:
+        prometheus_client.start_http_server(port, registry=registry)
+        logger.info(f"📈 Metrics on http://localhost:{port}/metrics")
+    except OSError as e:
+        logger.error(f"Cannot serve metrics on port {port}: {e}")
+
+
+# Directories left by earlier runs whose process is gone
+def _remove_stale_dirs():
+    try:
+        entries = os.listdir(METRICS_DIR)
+    except OSError:
+        return
+    for entry in entries:
+        if entry.isdigit() and int(entry) != os.getpid() and not _pid_alive(int(entry)):
+            shutil.rmtree(os.path.join(METRICS_DIR, entry), ignore_errors=True)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+# --- Sampling profiler ---
+# A daemon thread reads sys._current_frames() every PROFILE_INTERVAL_MS and
+# counts each thread's stack. stop() writes them as collapsed stacks
+# ("frame;frame;frame count"), readable by flamegraph.pl or speedscope, and
+# logs the functions seen most often. Covers every thread of this process;
+# for the OCR worker processes attach py-spy to their pids instead.
+class SamplingProfiler:
+    def __init__(self, interval_ms=PROFILE_INTERVAL_MS, path=PROFILE_PATH):
+        self.interval = interval_ms / 1000
+        self.path = path
+        self.stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name="profiler", daemon=True)
+
+    def start(self):
+        logger.info(f"Sampling profiler started ({self.interval * 1000:.0f} ms), writing to {self.path}")
+        self._thread.start()
+        return self
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self, top=20):
+        self._stop.set()
+        self._thread.join()
+        with open(self.path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        leaves = collections.Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        total = sum(leaves.values()) or 1
+        lines = [f"{count / total:6.1%}  {frame}" for frame, count in leaves.most_common(top)]
+        logger.info(f"Profile ({total} samples, collapsed stacks in {self.path}):\n" + "\n".join(lines))
+
+
+def start_profiler():
+    return SamplingProfiler().start() if PROFILE_ENABLED else None
+
+
+# --- Queue depth (pika) ---
+# A passive declare returns the broker's message count without touching the queue
+def report_queue_depth(channel, queue):
+    try:
+        depth = channel.queue_declare(queue=queue, durable=True, passive=True).method.message_count
+    except Exception as e:
+        logger.debug(f"Cannot read depth of {queue}: {e}")
+        return
+    QUEUE_DEPTH.labels(queue).set(depth)
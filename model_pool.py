@@ -0,0 +1,153 @@
+import os
+import json
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv  # type: ignore
+
+load_dotenv()
+
+# --- Config ---
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL_NAME", "gemini-1.5-flash-latest")
+GEMINI_TRANSPORT = os.getenv("GEMINI_TRANSPORT") or None  # "grpc" (default) or "rest"
+# Optional JSON file mapping label types to model names, re-read when it changes:
+#   {"default": "gemini-1.5-flash-latest", "return": "gemini-1.5-pro-latest"}
+MODEL_CONFIG_PATH = os.getenv("MODEL_CONFIG_PATH", "gemini_models.json")
+MODEL_CONFIG_CHECK_SECONDS = float(os.getenv("MODEL_CONFIG_CHECK_SECONDS", "5"))
+MODEL_HEALTH_INTERVAL = float(os.getenv("MODEL_HEALTH_INTERVAL", "60"))  # 0 disables background checks
+
+logger = logging.getLogger(__name__)
+
+
+# --- Model pool ---
+# One GenerativeModel per model name per process, created on first use behind
+# a lock and reused by every thread afterwards: genai.configure() runs once,
+# so all models share the client's long-lived connection and no message pays
+# for setup. warm_up() opens that connection at startup; health checks use
+# count_tokens, which touches the API without generating anything.
+# A model with a system instruction (the static label prompt, see
+# prompt_reducer.py) is a separate entry keyed by (name, instruction).
+class ModelPool:
+    def __init__(self, config_path=MODEL_CONFIG_PATH):
+        self.config_path = config_path
+        self._models = {}
+        self._lock = threading.Lock()
+        self._configured = False
+        self._routes = {}
+        self._config_mtime = None
+        self._config_checked = 0.0
+        self.health = {}  # model name -> {"ok", "latency_ms", "checked_at", "error"}
+        self._health_thread = None
+
+    def get(self, model_name=GEMINI_MODEL_NAME, system_instruction=None):
+        key = (model_name, system_instruction)
+        model = self._models.get(key)
+        if model is not None:
+            return model
+        with self._lock:
+            # google.generativeai (and grpc) take long to import: loaded here, on first use,
+            # which startup.py does in the background while the broker connection opens
+            import google.generativeai as genai
+            if not self._configured:
+                genai.configure(api_key=GEMINI_API_KEY, transport=GEMINI_TRANSPORT)
+                self._configured = True
+            if key not in self._models:
+                if system_instruction:
+                    self._models[key] = genai.GenerativeModel(model_name, system_instruction=system_instruction)
+                else:
+                    self._models[key] = genai.GenerativeModel(model_name)
+                logger.info(f"Gemini model '{model_name}' initialized successfully"
+                            f"{' (with system instruction)' if system_instruction else ''}.")
+            return self._models[key]
+
+    # --- Per-label model routing, re-read from MODEL_CONFIG_PATH without a restart ---
+    def _reload_config(self):
+        now = time.monotonic()
+        if now - self._config_checked < MODEL_CONFIG_CHECK_SECONDS:
+            return
+        self._config_checked = now
+        try:
+            mtime = os.path.getmtime(self.config_path)
+        except OSError:
+            mtime = None
+        if mtime == self._config_mtime:
+            return
+        routes = {}
+        if mtime is not None:
+            try:
+                with open(self.config_path, encoding="utf-8") as f:
+                    routes = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.error(f"Cannot read model config {self.config_path}: {e}. Keeping the previous models.")
+                return
+        if routes != self._routes:
+            logger.info(f"Gemini model routing: {routes or {'default': GEMINI_MODEL_NAME}}")
+        self._routes, self._config_mtime = routes, mtime
+
+    def model_name_for(self, label_name=None):
+        with self._lock:
+            self._reload_config()
+            return self._routes.get(label_name) or self._routes.get("default") or GEMINI_MODEL_NAME
+
+    def handle(self, label_name=None, system_instruction=None):
+        return ModelHandle(self, label_name, system_instruction)
+
+    # --- Warm-up and health checks ---
+    def check(self, model_name):
+        start = time.perf_counter()
+        try:
+            self.get(model_name).count_tokens("ping")
+            status = {"ok": True, "error": None}
+        except Exception as e:
+            status = {"ok": False, "error": str(e)}
+            logger.warning(f"Gemini model '{model_name}' failed its health check: {e}")
+        status.update(latency_ms=round((time.perf_counter() - start) * 1000, 1), checked_at=time.time())
+        self.health[model_name] = status
+        return status["ok"]
+
+    # Creates and checks the given models (default: every routed model) in parallel
+    def warm_up(self, model_names=None):
+        if model_names is None:
+            model_names = {self.model_name_for()} | set(self._routes.values())
+        model_names = sorted(set(model_names))
+        with ThreadPoolExecutor(max_workers=max(1, len(model_names))) as executor:
+            results = dict(zip(model_names, executor.map(self.check, model_names)))
+        logger.info(f"Gemini warm-up: {self.health}")
+        return all(results.values())
+
+    def start_health_checks(self, interval=MODEL_HEALTH_INTERVAL):
+        if interval <= 0 or self._health_thread is not None:
+            return
+
+        def loop():
+            while True:
+                time.sleep(interval)
+                for model_name in {name for name, _ in list(self._models)}:
+                    self.check(model_name)
+        self._health_thread = threading.Thread(target=loop, name="gemini-health", daemon=True)
+        self._health_thread.start()
+
+
+# --- Swappable model for one label type ---
+# Looks the model up on every call, so editing MODEL_CONFIG_PATH moves the
+# label type to another model for the next request.
+class ModelHandle:
+    def __init__(self, pool, label_name=None, system_instruction=None):
+        self.pool = pool
+        self.label_name = label_name
+        self.system_instruction = system_instruction
+
+    @property
+    def model_name(self):
+        return self.pool.model_name_for(self.label_name)
+
+    def generate_content(self, *args, **kwargs):
+        return self.pool.get(self.model_name, self.system_instruction).generate_content(*args, **kwargs)
+
+    def count_tokens(self, *args, **kwargs):
+        return self.pool.get(self.model_name, self.system_instruction).count_tokens(*args, **kwargs)
+
+
+model_pool = ModelPool()
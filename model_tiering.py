@@ -0,0 +1,121 @@
+import os
+import time
+import logging
+import threading
+from dotenv import load_dotenv  # type: ignore
+
+load_dotenv()
+
+# --- Config ---
+# Off by default: every label goes to the label type's model once.
+TIERING_ENABLED = os.getenv("TIERING_ENABLED", "false").lower() in ("1", "true", "yes")
+GEMINI_STRONG_MODEL = os.getenv("GEMINI_STRONG_MODEL", "gemini-1.5-pro-latest")
+ESCALATION_OCR_DPI = int(os.getenv("ESCALATION_OCR_DPI", "300"))
+# USD per million input tokens, only used to report the estimated saving
+TIER_CHEAP_PRICE_PER_MTOK = float(os.getenv("TIER_CHEAP_PRICE_PER_MTOK", "0.075"))
+TIER_STRONG_PRICE_PER_MTOK = float(os.getenv("TIER_STRONG_PRICE_PER_MTOK", "1.25"))
+
+logger = logging.getLogger(__name__)
+
+# Escalation steps a handler can list, tried in order after the cheap model's answer fails validation
+ESCALATE_OCR = "ocr"      # re-run OCR at ESCALATION_OCR_DPI and ask the cheap model again
+ESCALATE_MODEL = "model"  # ask GEMINI_STRONG_MODEL
+
+
+def parse_escalation(value):
+    steps = tuple(s.strip() for s in value.split(",") if s.strip())
+    unknown = [s for s in steps if s not in (ESCALATE_OCR, ESCALATE_MODEL)]
+    if unknown:
+        raise ValueError(f"Unknown escalation step(s): {', '.join(unknown)}")
+    return steps
+
+
+# --- Metrics (per label type) ---
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _record(label_name, **counts):
+    with _stats_lock:
+        entry = _stats.setdefault(label_name, {
+            "labels": 0, "escalated": 0, "ocr_reruns": 0, "strong_calls": 0, "still_invalid": 0,
+            "cheap_ms": 0.0, "escalation_ms": 0.0, "strong_ms": 0.0, "first_tier_tokens": 0})
+        for key, value in counts.items():
+            entry[key] += value
+
+
+# Escalation rate, plus the latency and cost saved against sending every label to the strong model
+def tiering_stats():
+    with _stats_lock:
+        snapshot = {name: dict(entry) for name, entry in _stats.items()}
+    for entry in snapshot.values():
+        labels = entry["labels"] or 1
+        entry["escalation_rate"] = round(entry["escalated"] / labels, 3)
+        not_escalated = entry["labels"] - entry["escalated"]
+        if entry["strong_calls"]:
+            strong_avg_ms = entry["strong_ms"] / entry["strong_calls"]
+            cheap_avg_ms = entry["cheap_ms"] / labels
+            entry["estimated_ms_saved"] = round(not_escalated * (strong_avg_ms - cheap_avg_ms))
+        tokens_per_label = entry["first_tier_tokens"] / labels
+        entry["estimated_cost_saved_usd"] = round(
+            not_escalated * tokens_per_label * (TIER_STRONG_PRICE_PER_MTOK - TIER_CHEAP_PRICE_PER_MTOK) / 1e6
+            - entry["escalated"] * tokens_per_label * TIER_CHEAP_PRICE_PER_MTOK / 1e6, 4)
+        for key in ("cheap_ms", "escalation_ms", "strong_ms"):
+            entry[key] = round(entry[key])
+    return snapshot
+
+
+# --- Escalator ---
+# Runs the cheap model first and checks its answer with handler.problems();
+# only answers that fail go through the handler's escalation steps. The
+# answer with the fewest problems is returned.
+#   cheap_fn(text) / strong_fn(text) -> normalized dict | None
+#   ocr_fn(file_path, pages) -> OCR text at ESCALATION_OCR_DPI (pages None: every page)
+class Escalator:
+    def __init__(self, handler, cheap_fn, strong_fn, ocr_fn, token_fn=None):
+        self.handler = handler
+        self.cheap_fn = cheap_fn
+        self.strong_fn = strong_fn
+        self.ocr_fn = ocr_fn
+        self.token_fn = token_fn or (lambda text: len(text) // 4 + 1)
+
+    def run(self, text, file_path=None, pages=None):
+        name = self.handler.name
+        start = time.perf_counter()
+        data = self.cheap_fn(text)
+        cheap_ms = (time.perf_counter() - start) * 1000
+        problems = self.handler.problems(data)
+        _record(name, labels=1, cheap_ms=cheap_ms, first_tier_tokens=self.token_fn(text))
+        if not problems:
+            return data
+
+        logger.info(f"⬆️ Escalating {name} label {file_path or ''} (failed checks: {', '.join(problems)})")
+        _record(name, escalated=1)
+        best, best_problems = data, problems
+        escalation_start = time.perf_counter()
+        for step in self.handler.escalation:
+            if step == ESCALATE_OCR:
+                if not file_path:
+                    continue
+                ocr_text = self.ocr_fn(file_path, pages)
+                _record(name, ocr_reruns=1)
+                if not ocr_text or not ocr_text.strip():
+                    continue
+                # Keep the first pass's text too: the OCR may have fixed some fields and garbled others
+                text = text + "\n" + ocr_text
+                data = self.cheap_fn(text)
+            elif step == ESCALATE_MODEL:
+                strong_start = time.perf_counter()
+                data = self.strong_fn(text)
+                _record(name, strong_calls=1, strong_ms=(time.perf_counter() - strong_start) * 1000)
+            problems = self.handler.problems(data)
+            if len(problems) <= len(best_problems):
+                best, best_problems = data, problems
+            if not problems:
+                break
+        _record(name, escalation_ms=(time.perf_counter() - escalation_start) * 1000)
+        if best_problems:
+            _record(name, still_invalid=1)
+            logger.warning(f"{name.capitalize()} label {file_path or ''} still fails checks after escalation: "
+                           f"{', '.join(best_problems)}")
+        return best
@@ -0,0 +1,186 @@
+import os
+import logging
+from dotenv import load_dotenv  # type: ignore
+
+try:
+    import numpy as np  # type: ignore
+except ImportError:  # preprocessing is skipped, Tesseract gets the rendered page as is
+    np = None
+
+from metrics import stage_timer
+
+# Page images are cleaned up before Tesseract sees them. Speckled thermal
+# prints and skewed phone scans make Tesseract slow (it tries to read every
+# speck) and give Gemini garbage. All steps are vectorized NumPy on the
+# grayscale page, in this order:
+#   crop        to the bounding box of the ink, i.e. the label on a larger scan
+#   deskew      the angle whose row profile is sharpest (text lines line up),
+#               searched within +-OCR_DESKEW_MAX_ANGLE degrees
+#   downscale   from the render DPI to the DPI Tesseract gets (OCR_RENDER_DPI
+#               renders larger, so thin strokes survive the threshold)
+#   barcodes    tiles with dense vertical bars are painted white: Tesseract
+#               reads them as rows of I and l and spends time doing it
+#   binarize    Otsu threshold, then specks without dark neighbours are removed
+# Without NumPy the page goes to Tesseract unchanged.
+
+load_dotenv()
+
+# --- Config ---
+OCR_PREPROCESS = os.getenv("OCR_PREPROCESS", "true").lower() in ("1", "true", "yes")
+OCR_DESKEW = os.getenv("OCR_DESKEW", "true").lower() in ("1", "true", "yes")
+OCR_DESKEW_MAX_ANGLE = float(os.getenv("OCR_DESKEW_MAX_ANGLE", "5"))  # degrees
+OCR_DESKEW_STEP = float(os.getenv("OCR_DESKEW_STEP", "0.5"))
+OCR_CROP = os.getenv("OCR_CROP", "true").lower() in ("1", "true", "yes")
+OCR_CROP_MARGIN = float(os.getenv("OCR_CROP_MARGIN", "0.1"))  # inches of white kept around the label
+OCR_MASK_BARCODES = os.getenv("OCR_MASK_BARCODES", "true").lower() in ("1", "true", "yes")
+OCR_BINARIZE = os.getenv("OCR_BINARIZE", "true").lower() in ("1", "true", "yes")
+OCR_DESPECKLE = os.getenv("OCR_DESPECKLE", "true").lower() in ("1", "true", "yes")
+
+logger = logging.getLogger(__name__)
+_warned = []
+
+
+def available():
+    return np is not None
+
+
+# --- Steps (grayscale uint8 arrays, 0 = ink) ---
+def otsu_threshold(gray):
+    hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    weight = np.cumsum(hist)
+    mean = np.cumsum(hist * np.arange(256))
+    total, total_mean = weight[-1], mean[-1]
+    background = total - weight
+    with np.errstate(divide="ignore", invalid="ignore"):
+        between = (total_mean * weight - mean * total) ** 2 / (weight * background)
+    return int(np.nanargmax(between[:-1]))
+
+
+# Ink mask: True where the page is darker than the Otsu threshold
+def ink_mask(gray):
+    return gray <= otsu_threshold(gray)
+
+
+# Drops ink pixels with fewer than `min_neighbours` ink pixels in their 3x3 neighbourhood
+def despeckle(ink, min_neighbours=2):
+    padded = np.pad(ink, 1).astype(np.uint8)
+    h, w = ink.shape
+    neighbours = sum(padded[dy:dy + h, dx:dx + w] for dy in range(3) for dx in range(3)) - ink
+    return ink & (neighbours >= min_neighbours)
+
+
+# Skew in degrees (positive: lines fall to the right). Shears the ink
+# coordinates instead of rotating the image, on at most ~600 px of width.
+def skew_angle(ink, max_angle=OCR_DESKEW_MAX_ANGLE, step=OCR_DESKEW_STEP):
+    if max_angle <= 0 or step <= 0:
+        return 0.0
+    factor = max(1, ink.shape[1] // 600)
+    ys, xs = np.nonzero(ink[::factor, ::factor])
+    if len(ys) < 100:
+        return 0.0
+    angles = np.arange(-max_angle, max_angle + step / 2, step)
+    best, best_score = 0.0, -1.0
+    for angle in angles:
+        rows = np.round(ys - xs * np.tan(np.radians(angle))).astype(np.int64)
+        profile = np.bincount(rows - rows.min())
+        score = float(np.sum(np.diff(profile).astype(np.float64) ** 2))
+        if score > best_score:
+            best, best_score = float(angle), score
+    return best
+
+
+# (top, bottom, left, right) of the ink, `margin` pixels wider; rows or columns
+# with less than 0.1% ink (leftover specks) don't count
+def ink_bounds(ink, margin=0):
+    h, w = ink.shape
+    rows = np.flatnonzero(ink.sum(axis=1) > w * 0.001)
+    cols = np.flatnonzero(ink.sum(axis=0) > h * 0.001)
+    if not len(rows) or not len(cols):
+        return 0, h, 0, w
+    return (max(0, rows[0] - margin), min(h, rows[-1] + 1 + margin),
+            max(0, cols[0] - margin), min(w, cols[-1] + 1 + margin))
+
+
+# Tiles of a 1-D barcode: many ink edges along the rows, few along the
+# columns. Bars run at least three tiles tall (a text line is shorter, so
+# the upright strokes of 1, l and I never qualify) and a barcode is several
+# tiles wide: gaps of up to `gap` tiles (wide bars) are closed, and the
+# tiles where the bars end are added when they still hold bars.
+def barcode_tiles(ink, tile=16, min_edges=0.1, max_ratio=0.25, gap=2):
+    h, w = ink.shape
+    th, tw = h // tile, w // tile
+    if th < 3 or not tw:
+        return np.zeros((max(0, th), max(0, tw)), dtype=bool)
+    ink = ink[:th * tile, :tw * tile]
+    across = np.zeros(ink.shape, dtype=np.float32)
+    down = np.zeros(ink.shape, dtype=np.float32)
+    across[:, 1:] = ink[:, 1:] != ink[:, :-1]
+    down[1:, :] = ink[1:, :] != ink[:-1, :]
+    across = across.reshape(th, tile, tw, tile).mean(axis=(1, 3))
+    down = down.reshape(th, tile, tw, tile).mean(axis=(1, 3))
+    bars = (across >= min_edges) & (down <= across * max_ratio)
+    tall = np.zeros_like(bars)
+    tall[1:-1] = bars[1:-1] & bars[:-2] & bars[2:]
+    left, right = np.zeros_like(tall), np.zeros_like(tall)
+    for k in range(1, gap + 2):
+        left[:, k:] |= tall[:, :-k]
+        right[:, :-k] |= tall[:, k:]
+    found = (tall & (left | right)) | (left & right)
+    striped = across >= min_edges / 4
+    for _ in range(2):
+        ends = np.zeros_like(found)
+        ends[1:] |= found[:-1]
+        ends[:-1] |= found[1:]
+        found |= ends & striped
+    return found
+
+
+def mask_barcodes(gray, ink, tile=16):
+    bars = barcode_tiles(ink, tile)
+    if bars.any():
+        mask = np.zeros(gray.shape, dtype=bool)
+        mask[:bars.shape[0] * tile, :bars.shape[1] * tile] = np.kron(bars, np.ones((tile, tile), dtype=bool))
+        gray = gray.copy()
+        gray[mask] = 255
+    return gray
+
+
+# --- Whole page ---
+# image: the rendered page (PIL). render_dpi: the DPI it was rendered at;
+# target_dpi: the DPI Tesseract gets. Returns a PIL image ready for OCR.
+def preprocess_page(image, render_dpi, target_dpi=None):
+    if not OCR_PREPROCESS:
+        return image
+    if np is None:
+        if not _warned:
+            _warned.append(True)
+            logger.warning("NumPy is not installed; OCR pages are not preprocessed (pip install numpy).")
+        return image
+    from PIL import Image  # type: ignore  # installed with pdf2image
+
+    target_dpi = target_dpi or render_dpi
+    with stage_timer("ocr_preprocess"):
+        gray = np.asarray(image.convert("L"))
+        # One threshold for every step: rotating (white fill) and downscaling keep the histogram's two peaks
+        threshold = otsu_threshold(gray)
+        if OCR_CROP:
+            top, bottom, left, right = ink_bounds(despeckle(gray <= threshold), int(OCR_CROP_MARGIN * render_dpi))
+            gray = gray[top:bottom, left:right]
+        if OCR_DESKEW:
+            angle = skew_angle(gray <= threshold)
+            if angle:
+                # Rotating the cropped label is cheaper than the page; expand keeps its corners
+                gray = np.asarray(Image.fromarray(gray).rotate(angle, resample=Image.BILINEAR, expand=True,
+                                                               fillcolor=255))
+        if target_dpi < render_dpi:
+            scale = target_dpi / render_dpi
+            size = (max(1, round(gray.shape[1] * scale)), max(1, round(gray.shape[0] * scale)))
+            gray = np.asarray(Image.fromarray(gray).resize(size, Image.LANCZOS))
+        if OCR_MASK_BARCODES:
+            gray = mask_barcodes(gray, gray <= threshold)
+        if not OCR_BINARIZE:
+            return Image.fromarray(gray)
+        ink = gray <= threshold
+        if OCR_DESPECKLE:
+            ink = despeckle(ink)
+        return Image.fromarray(np.where(ink, 0, 255).astype(np.uint8))
@@ -0,0 +1,218 @@
+import os
+import time
+import logging
+import queue
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv  # type: ignore
+
+from metrics import stage_timer
+
+load_dotenv()
+
+# --- Config ---
+TESSERACT_CMD_PATH = os.getenv("TESSERACT_CMD_PATH", r"D:\Tesseract-OCR\tesseract.exe")
+GHOSTSCRIPT_PATH = os.getenv("GHOSTSCRIPT_PATH", r"D:\gs\gs10.02.1\bin\gswin64c.exe")
+POPPLER_PATH = os.getenv("POPPLER_PATH", r"D:\Release-24.08.0-0\poppler-24.08.0\Library\bin")
+OCR_DPI = int(os.getenv("OCR_DPI", "200"))  # resolution Tesseract sees
+# Render larger than OCR_DPI and downscale after cleanup (see ocr_preprocess.py); 0 renders at OCR_DPI
+OCR_RENDER_DPI = int(os.getenv("OCR_RENDER_DPI", "0"))
+OCR_GRAYSCALE = os.getenv("OCR_GRAYSCALE", "true").lower() in ("1", "true", "yes")
+# OCR runs in OCR_PROCESSES worker processes (see worker_pool.py; 0: in the worker thread), each
+# reading OCR_THREADS pages at once, so up to OCR_PROCESSES x OCR_THREADS Tesseract runs share the
+# host. Keep the product at about the core count: by default the cores are divided among the
+# processes, i.e. one thread per process, or every core for a single process.
+CPU_COUNT = os.cpu_count() or 1
+OCR_PROCESSES = int(os.getenv("OCR_PROCESSES", str(CPU_COUNT)))
+OCR_THREADS = int(os.getenv("OCR_THREADS", str(max(1, CPU_COUNT // max(1, OCR_PROCESSES)))))
+OCR_LANG = os.getenv("OCR_LANG", "vie+eng")  # needs the vie and eng traineddata packs
+OCR_EARLY_STOP = os.getenv("OCR_EARLY_STOP", "true").lower() in ("1", "true", "yes")
+# auto: tesserocr when installed (Tesseract stays loaded in the process), else pytesseract (a subprocess per page)
+OCR_ENGINE = os.getenv("OCR_ENGINE", "auto").lower()
+# 4: one column of lines of varying size, how most labels read; 3: full layout analysis, 11: sparse text
+OCR_PSM = int(os.getenv("OCR_PSM", "4"))
+OCR_OEM = int(os.getenv("OCR_OEM", "1"))  # 1: LSTM only, skips the legacy engine
+TESSERACT_CONFIG = f"--oem {OCR_OEM} --psm {OCR_PSM}"
+# What OCR text depends on, for cache keys (see label_pipeline.text_cache_key): the settings above
+# and every other OCR_* variable set (preprocessing, see ocr_preprocess.py), but not the pool sizes
+OCR_SETTINGS = ";".join([f"dpi={OCR_DPI}", f"render_dpi={OCR_RENDER_DPI}", f"grayscale={OCR_GRAYSCALE}",
+                         f"lang={OCR_LANG}", f"engine={OCR_ENGINE}", f"early_stop={OCR_EARLY_STOP}",
+                         TESSERACT_CONFIG] +
+                        [f"{k}={v}" for k, v in sorted(os.environ.items())
+                         if k.startswith("OCR_") and k not in ("OCR_PROCESSES", "OCR_THREADS")])
+
+logger = logging.getLogger(__name__)
+
+# Tesseract's own OpenMP threads fight with our process- and page-level parallelism
+if max(1, OCR_PROCESSES) * OCR_THREADS > 1:
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+
+# --- OCR backend, loaded on first use ---
+# pdf2image, pytesseract, tesserocr and NumPy (ocr_preprocess) are imported
+# by the first OCR call (or by the background warm-up in startup.py), so
+# processes and workers that never OCR don't pay for them. The tool paths are
+# applied at the same time, once per process; OCR worker processes load their
+# own copy.
+_ocr_lock = threading.Lock()
+_ocr_backend = None
+_tesserocr = None
+
+
+def ocr_backend():
+    global _ocr_backend
+    if _ocr_backend is None:
+        with _ocr_lock:
+            if _ocr_backend is None:
+                from pdf2image import convert_from_path, pdfinfo_from_path  # type: ignore
+                import pytesseract  # type: ignore
+                if TESSERACT_CMD_PATH:
+                    pytesseract.pytesseract.tesseract_cmd = TESSERACT_CMD_PATH
+                if GHOSTSCRIPT_PATH:  # Though often not directly needed by pdf2image if Poppler is set
+                    os.environ["GHOSTSCRIPT_PATH"] = GHOSTSCRIPT_PATH
+                if POPPLER_PATH and POPPLER_PATH not in os.environ.get("PATH", ""):
+                    # Set the path to Poppler's bin directory for pdf2image to find pdftoppm.exe
+                    os.environ["PATH"] += os.pathsep + POPPLER_PATH
+                _load_tesserocr()
+                import ocr_preprocess  # noqa: F401  (NumPy)
+                _ocr_backend = (convert_from_path, pdfinfo_from_path, pytesseract)
+    return _ocr_backend
+
+
+def _load_tesserocr():
+    global _tesserocr
+    if OCR_ENGINE == "pytesseract":
+        return
+    try:
+        import tesserocr  # type: ignore
+        _tesserocr = tesserocr
+        logger.info(f"OCR engine: tesserocr (Tesseract {tesserocr.tesseract_version().split()[1]}), "
+                    f"{TESSERACT_CONFIG}")
+    except ImportError:
+        if OCR_ENGINE == "tesserocr":
+            logger.warning("OCR_ENGINE=tesserocr but tesserocr is not installed; using pytesseract.")
+
+
+# --- Persistent Tesseract instances (tesserocr) ---
+# A PyTessBaseAPI loads the traineddata once and is reused for every page
+# afterwards; pytesseract starts a tesseract process (and loads the
+# traineddata) per page. Idle instances wait in a stack per language, so
+# there are never more than the OCR threads that ran at once.
+class TesseractInstances:
+    def __init__(self, tesserocr, lang, psm=OCR_PSM, oem=OCR_OEM):
+        self.tesserocr = tesserocr
+        self.lang = lang
+        self.psm = psm
+        self.oem = oem
+        self._idle = queue.LifoQueue()
+
+    def recognize(self, image):
+        try:
+            api = self._idle.get_nowait()
+        except queue.Empty:
+            api = self.tesserocr.PyTessBaseAPI(lang=self.lang, psm=self.psm, oem=self.oem)
+        try:
+            api.SetImage(image)
+            return api.GetUTF8Text()  # releases the GIL while Tesseract runs
+        finally:
+            api.Clear()
+            self._idle.put(api)
+
+
+_instances = {}
+
+
+def recognize(image, lang=OCR_LANG):
+    _, _, pytesseract = ocr_backend()
+    if _tesserocr is None:
+        return pytesseract.image_to_string(image, lang=lang, config=TESSERACT_CONFIG)
+    instances = _instances.get(lang)
+    if instances is None:
+        with _ocr_lock:
+            instances = _instances.setdefault(lang, TesseractInstances(_tesserocr, lang))
+    if isinstance(image, str):
+        from PIL import Image  # type: ignore
+        with Image.open(image) as page:
+            return instances.recognize(page.copy())
+    return instances.recognize(image)
+
+
+# --- Page count without rasterizing ---
+def count_pages(pdf_path):
+    _, pdfinfo_from_path, _ = ocr_backend()
+    info = pdfinfo_from_path(pdf_path, poppler_path=POPPLER_PATH or None)
+    return int(info.get("Pages", 0))
+
+
+# --- One page: render to a temp file, clean it up, OCR it, delete it ---
+def ocr_page(pdf_path, page_number, workdir, dpi=OCR_DPI, grayscale=OCR_GRAYSCALE, lang=OCR_LANG):
+    convert_from_path, _, _ = ocr_backend()
+    from ocr_preprocess import preprocess_page, OCR_PREPROCESS
+    render_dpi = max(dpi, OCR_RENDER_DPI)
+    with stage_timer("convert_from_path"):
+        paths = convert_from_path(pdf_path, dpi=render_dpi, first_page=page_number, last_page=page_number,
+                                  grayscale=grayscale, poppler_path=POPPLER_PATH or None,
+                                  output_folder=workdir, fmt="png", paths_only=True)
+    text = []
+    for path in paths:
+        try:
+            image = path
+            if OCR_PREPROCESS:
+                from PIL import Image  # type: ignore  # installed with pdf2image
+                with Image.open(path) as page:
+                    cleaned = preprocess_page(page, render_dpi, dpi)
+                if cleaned is not page:  # unchanged without NumPy
+                    image = cleaned
+            with stage_timer("image_to_string"):
+                text.append(recognize(image, lang))
+        finally:
+            os.remove(path)
+    return "\n".join(text)
+
+
+# --- Streaming OCR over selected pages ---
+# Pages are rendered and OCR'd in windows of `threads` pages, so at most that
+# many page images exist at once (on disk, not as PIL images in memory).
+# After each window `stop_when(known_text + text_so_far)` may end the run early.
+# Returns {page_number: text}; per-page milliseconds go into `timings` if given.
+# A page whose render or OCR fails (Poppler, Tesseract, missing backend) is
+# logged and left out, so callers keep their text-layer text for it.
+def ocr_pages(pdf_path, page_numbers, dpi=OCR_DPI, grayscale=OCR_GRAYSCALE, threads=OCR_THREADS,
+              lang=OCR_LANG, stop_when=None, known_text="", timings=None):
+    threads = max(1, threads)
+    page_numbers = list(page_numbers)
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="ocr_") as workdir, \
+            ThreadPoolExecutor(max_workers=threads, thread_name_prefix="ocr") as executor:
+        for start in range(0, len(page_numbers), threads):
+            window = page_numbers[start:start + threads]
+            futures = {n: executor.submit(_timed_ocr_page, pdf_path, n, workdir, dpi, grayscale, lang) for n in window}
+            for n, future in futures.items():
+                try:
+                    results[n], elapsed_ms = future.result()
+                except Exception as e:
+                    logger.warning(f"OCR failed for page {n} of {pdf_path}: {e}")
+                    continue
+                if timings is not None:
+                    timings[n] = elapsed_ms
+            if OCR_EARLY_STOP and stop_when:
+                text_so_far = "\n".join(results[n] for n in sorted(results))
+                if stop_when(known_text + "\n" + text_so_far):
+                    logger.info(f"OCR stopped early after {len(results)}/{len(page_numbers)} pages: required fields found.")
+                    break
+    return results
+
+
+def _timed_ocr_page(pdf_path, page_number, workdir, dpi, grayscale, lang):
+    start = time.perf_counter()
+    text = ocr_page(pdf_path, page_number, workdir, dpi, grayscale, lang)
+    return text, (time.perf_counter() - start) * 1000
+
+
+# --- Streaming OCR over the whole document ---
+def stream_ocr(pdf_path, dpi=OCR_DPI, grayscale=OCR_GRAYSCALE, threads=OCR_THREADS,
+               lang=OCR_LANG, stop_when=None):
+    total = count_pages(pdf_path)
+    pages = ocr_pages(pdf_path, range(1, total + 1), dpi, grayscale, threads, lang, stop_when=stop_when)
+    return "\n".join(pages[n] for n in sorted(pages)).strip()
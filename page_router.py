@@ -0,0 +1,112 @@
+import os
+import re
+import time
+import logging
+from dotenv import load_dotenv  # type: ignore
+
+from ocr_stage import ocr_pages
+from metrics import STAGE_SECONDS, OCR_FALLBACKS
+
+load_dotenv()
+
+# --- Config ---
+PAGE_ROUTING_ENABLED = os.getenv("PAGE_ROUTING_ENABLED", "true").lower() in ("1", "true", "yes")
+# A page goes to OCR when its text layer has fewer glyphs than this...
+PAGE_MIN_GLYPHS = int(os.getenv("PAGE_MIN_GLYPHS", "40"))
+# ...or images cover this share of the page and there is little text per image area
+PAGE_IMAGE_COVERAGE = float(os.getenv("PAGE_IMAGE_COVERAGE", "0.5"))
+PAGE_MIN_GLYPHS_ON_IMAGE = int(os.getenv("PAGE_MIN_GLYPHS_ON_IMAGE", "200"))
+# ...or most of its "words" look like barcode strings rather than language
+PAGE_MAX_BARCODE_SHARE = float(os.getenv("PAGE_MAX_BARCODE_SHARE", "0.6"))
+
+logger = logging.getLogger(__name__)
+
+BARCODE_TOKEN = re.compile(r"^[A-Z0-9*|/\-]{12,}$")
+
+
+# --- Per-page measurements from the text layer ---
+# Image coverage is taken from the content stream: each image XObject drawn
+# with `Do` covers |det(CTM)| of user space, summed and divided by page area.
+def measure_page(page):
+    images = set()
+    try:
+        xobjects = page["/Resources"]["/XObject"]
+        images = {name for name in xobjects if xobjects[name].get_object().get("/Subtype") == "/Image"}
+    except (KeyError, TypeError):
+        pass
+    covered = [0.0]
+
+    def visitor(op, args, cm, tm):
+        if op == b"Do" and args and args[0] in images:
+            a, b, c, d = cm[0], cm[1], cm[2], cm[3]
+            covered[0] += abs(a * d - b * c)
+
+    text = page.extract_text(visitor_operand_before=visitor) or ""
+    box = page.mediabox
+    area = float(box.width) * float(box.height) or 1.0
+    tokens = text.split()
+    barcode_tokens = sum(1 for t in tokens if BARCODE_TOKEN.match(t))
+    return {
+        "text": text,
+        "glyphs": sum(1 for ch in text if ch.isalnum()),
+        "image_coverage": min(1.0, covered[0] / area),
+        "barcode_share": barcode_tokens / len(tokens) if tokens else 0.0,
+    }
+
+
+def needs_ocr(stats):
+    if stats["glyphs"] < PAGE_MIN_GLYPHS:
+        return True
+    if stats["image_coverage"] >= PAGE_IMAGE_COVERAGE and stats["glyphs"] < PAGE_MIN_GLYPHS_ON_IMAGE:
+        return True
+    return stats["barcode_share"] >= PAGE_MAX_BARCODE_SHARE
+
+
+# --- Routed extraction ---
+# Returns (text, page_report). Pages with a usable text layer keep their pypdf
+# text; the others are OCR'd (in parallel, see ocr_stage.ocr_pages) and the
+# two are merged back in page order. page_report has one entry per page with
+# the route taken, the measurements and the time spent.
+def extract_routed_text(pdf_path, ocr_fallback=True, stop_when=None):
+    from pypdf import PdfReader  # imported on first use, see startup.py
+    reader = PdfReader(pdf_path)
+    pages, report = {}, []
+    ocr_needed = []
+    for number, page in enumerate(reader.pages, start=1):
+        start = time.perf_counter()
+        try:
+            stats = measure_page(page)
+        except Exception as e:
+            logger.warning(f"pypdf could not read page {number} of {pdf_path}: {e}")
+            stats = {"text": "", "glyphs": 0, "image_coverage": 0.0, "barcode_share": 0.0}
+        route = "ocr" if ocr_fallback and needs_ocr(stats) else "text"
+        pages[number] = stats.pop("text")
+        report.append({"page": number, "route": route, **stats,
+                       "text_ms": round((time.perf_counter() - start) * 1000, 1), "ocr_ms": 0.0})
+        if route == "ocr":
+            ocr_needed.append(number)
+
+    STAGE_SECONDS.labels("extract_text_from_pdf").observe(sum(entry["text_ms"] for entry in report) / 1000)
+    if ocr_needed:
+        known_text = "\n".join(pages[n] for n in pages if n not in ocr_needed)
+        if stop_when and stop_when(known_text):
+            logger.info(f"Text layer already has the required fields; skipping OCR of {len(ocr_needed)} pages.")
+            ocr_needed = []
+        else:
+            logger.info(f"🔁 OCR for {len(ocr_needed)}/{len(pages)} pages of {pdf_path}: {ocr_needed}")
+            OCR_FALLBACKS.labels("page").inc(len(ocr_needed))
+        timings = {}
+        ocr_text = ocr_pages(pdf_path, ocr_needed, stop_when=stop_when, known_text=known_text, timings=timings)
+        for entry in report:
+            n = entry["page"]
+            if n in ocr_text:
+                # Keep whatever the text layer had (e.g. a barcode string) after the OCR text
+                pages[n] = ocr_text[n] + ("\n" + pages[n] if pages[n].strip() else "")
+                entry["ocr_ms"] = round(timings.get(n, 0.0), 1)
+            elif entry["route"] == "ocr":
+                entry["route"] = "skipped"
+
+    for entry in report:
+        logger.debug(f"Page {entry['page']} of {pdf_path}: {entry}")
+    text = "\n".join(pages[n].strip() for n in sorted(pages) if pages[n].strip())
+    return text.strip(), report
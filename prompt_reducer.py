@@ -0,0 +1,167 @@
+import os
+import re
+import logging
+import threading
+import unicodedata
+from dotenv import load_dotenv  # type: ignore
+
+from metrics import PROMPT_TOKENS
+from gemini_batcher import estimate_tokens
+
+# Shrinks label text before it goes to Gemini. pypdf and OCR dumps carry
+# runs of whitespace, barcode glyphs, rules, legal boilerplate and whole
+# pages printed twice; all of it is paid for as input tokens on every call.
+#   1. normalize   NFC, no control/zero-width characters, single spaces
+#   2. dedupe      drop any run of PROMPT_DEDUPE_WINDOW lines seen before
+#                  (a duplicated page), single repeated lines are kept
+#   3. filter      drop lines with (almost) no letters or digits, boilerplate
+#                  matching PROMPT_DROP_PATTERNS, long digit-free prose
+#   4. crop        optional: only the lines around the handler's anchors
+#                  (FROM/Từ, TO/Đến, Mã vận đơn...)
+# Lines matching the anchors are never dropped. Tokens before and after are
+# counted per label and reported by reduction_stats() and the
+# label_prompt_tokens_total metric.
+
+load_dotenv()
+
+# --- Config ---
+PROMPT_REDUCTION_ENABLED = os.getenv("PROMPT_REDUCTION_ENABLED", "true").lower() in ("1", "true", "yes")
+PROMPT_DEDUPE_WINDOW = int(os.getenv("PROMPT_DEDUPE_WINDOW", "3"))
+PROMPT_MAX_PROSE_CHARS = int(os.getenv("PROMPT_MAX_PROSE_CHARS", "160"))  # longer lines without digits are dropped
+PROMPT_DROP_PATTERNS = [p.strip() for p in os.getenv(
+    "PROMPT_DROP_PATTERNS",
+    r"điều khoản|terms and conditions|chính sách|policy|www\.|https?://|"
+    r"lưu ý|cam kết|chữ ký|signature|được phép đồng kiểm|kiểm tra hàng").split("|") if p.strip()]
+# Cropping keeps only the anchor lines, CROP_BEFORE lines above and CROP_AFTER lines below them
+PROMPT_CROP_ENABLED = os.getenv("PROMPT_CROP_ENABLED", "false").lower() in ("1", "true", "yes")
+PROMPT_CROP_BEFORE = int(os.getenv("PROMPT_CROP_BEFORE", "1"))
+PROMPT_CROP_AFTER = int(os.getenv("PROMPT_CROP_AFTER", "5"))
+# "estimate" (~4 characters per token) or "model" (count_tokens, one extra round trip per label)
+PROMPT_TOKEN_COUNT = os.getenv("PROMPT_TOKEN_COUNT", "estimate").lower()
+# Send the static prompt once per model as its system instruction rather than in every request
+PROMPT_SYSTEM_INSTRUCTION = os.getenv("PROMPT_SYSTEM_INSTRUCTION", "true").lower() in ("1", "true", "yes")
+
+logger = logging.getLogger(__name__)
+
+CONTROL_CHARS = re.compile(r"[\x00-\x08\x0b-\x1f\x7f\u200b-\u200f\u2060\ufeff]")
+SPACES = re.compile(r"[ \t\xa0\u2000-\u200a\u3000]+")
+DROP_PATTERN = re.compile("|".join(PROMPT_DROP_PATTERNS), re.IGNORECASE) if PROMPT_DROP_PATTERNS else None
+MIN_ALNUM_SHARE = 0.4
+
+
+# --- Stats (per label type) ---
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _record(label_name, report, labels=1):
+    with _stats_lock:
+        entry = _stats.setdefault(label_name, {"labels": 0, "raw_tokens": 0, "sent_tokens": 0,
+                                               "duplicate_lines": 0, "dropped_lines": 0, "cropped_lines": 0})
+        entry["labels"] += labels
+        for key in ("raw_tokens", "sent_tokens", "duplicate_lines", "dropped_lines", "cropped_lines"):
+            entry[key] += report[key]
+    PROMPT_TOKENS.labels(label_name, "raw").inc(report["raw_tokens"])
+    PROMPT_TOKENS.labels(label_name, "sent").inc(report["sent_tokens"])
+
+
+def reduction_stats():
+    with _stats_lock:
+        snapshot = {name: dict(entry) for name, entry in _stats.items()}
+    for entry in snapshot.values():
+        saved = entry["raw_tokens"] - entry["sent_tokens"]
+        entry["tokens_saved"] = saved
+        entry["tokens_saved_per_label"] = round(saved / (entry["labels"] or 1), 1)
+        entry["saved_share"] = round(saved / (entry["raw_tokens"] or 1), 3)
+    return snapshot
+
+
+# --- Steps ---
+def normalize_text(text):
+    text = unicodedata.normalize("NFC", text.replace("\r\n", "\n").replace("\r", "\n"))
+    text = CONTROL_CHARS.sub("", text)
+    return [SPACES.sub(" ", line).strip() for line in text.split("\n")]
+
+
+def dedupe_runs(lines, window=PROMPT_DEDUPE_WINDOW):
+    if window <= 0 or len(lines) < window:
+        return lines, 0
+    seen = set()
+    duplicate = [False] * len(lines)
+    for i in range(len(lines) - window + 1):
+        key = tuple(line.casefold() for line in lines[i:i + window])
+        if key in seen:
+            for j in range(i, i + window):
+                duplicate[j] = True
+        else:
+            seen.add(key)
+    return [line for line, dup in zip(lines, duplicate) if not dup], sum(duplicate)
+
+
+def low_information(line):
+    if not line:
+        return True
+    visible = [ch for ch in line if not ch.isspace()]
+    alnum = sum(1 for ch in visible if ch.isalnum())
+    if alnum <= 1 or alnum / len(visible) < MIN_ALNUM_SHARE:
+        return True  # rules, box drawing, barcode glyphs, OCR specks
+    if DROP_PATTERN and DROP_PATTERN.search(line):
+        return True
+    return len(line) > PROMPT_MAX_PROSE_CHARS and not any(ch.isdigit() for ch in line)
+
+
+def crop_to_anchors(lines, anchors, before=PROMPT_CROP_BEFORE, after=PROMPT_CROP_AFTER):
+    hits = [i for i, line in enumerate(lines) if anchors.search(line)]
+    if not hits:
+        return lines  # nothing to crop around; better to send everything
+    keep = set()
+    for i in hits:
+        keep.update(range(max(0, i - before), min(len(lines), i + after + 1)))
+    return [line for i, line in enumerate(lines) if i in keep]
+
+
+def token_counter(model=None):
+    if PROMPT_TOKEN_COUNT == "model" and model is not None:
+        def count(text):
+            try:
+                return model.count_tokens(text).total_tokens
+            except Exception as e:
+                logger.warning(f"count_tokens failed ({e}); using the estimate.")
+                return estimate_tokens(text)
+        return count
+    return estimate_tokens
+
+
+# --- Reducer ---
+# One per label type. reduce(text) returns the text to send; count_fn(text)
+# gives its token count (see token_counter).
+class PromptReducer:
+    def __init__(self, label_name, anchors=None, count_fn=None, crop=PROMPT_CROP_ENABLED,
+                 enabled=PROMPT_REDUCTION_ENABLED):
+        self.label_name = label_name
+        self.anchors = anchors
+        self.count_fn = count_fn or estimate_tokens
+        self.crop = crop and anchors is not None
+        self.enabled = enabled
+
+    # extra=True for more text of a label already counted (the OCR re-run of model tiering)
+    def reduce(self, text, extra=False):
+        if not self.enabled or not text:
+            return text
+        lines = [line for line in normalize_text(text) if line]
+        lines, duplicates = dedupe_runs(lines)
+        kept = [line for line in lines
+                if (self.anchors is not None and self.anchors.search(line)) or not low_information(line)]
+        dropped = len(lines) - len(kept)
+        cropped = crop_to_anchors(kept, self.anchors) if self.crop else kept
+        # Filtering everything away would turn a hard label into an empty prompt
+        reduced = "\n".join(cropped) or "\n".join(lines)
+
+        report = {"raw_tokens": self.count_fn(text), "sent_tokens": self.count_fn(reduced),
+                  "duplicate_lines": duplicates, "dropped_lines": dropped, "cropped_lines": len(kept) - len(cropped)}
+        _record(self.label_name, report, labels=0 if extra else 1)
+        saved = report["raw_tokens"] - report["sent_tokens"]
+        logger.info(f"✂️ {self.label_name.capitalize()} label text: {report['raw_tokens']} -> {report['sent_tokens']} "
+                    f"tokens ({saved} saved; {duplicates} duplicate, {dropped} low-information, "
+                    f"{report['cropped_lines']} cropped lines)")
+        return reduced
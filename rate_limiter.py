@@ -0,0 +1,217 @@
+import os
+import re
+import time
+import random
+import sqlite3
+import logging
+import threading
+import contextlib
+from dotenv import load_dotenv  # type: ignore
+
+from metrics import stage_timer
+
+load_dotenv()
+
+# --- Config ---
+GEMINI_RPM = float(os.getenv("GEMINI_RPM", "60"))            # requests per minute, all processes together
+GEMINI_TPM = float(os.getenv("GEMINI_TPM", "1000000"))       # tokens per minute, all processes together
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "5"))
+GEMINI_BACKOFF_BASE = float(os.getenv("GEMINI_BACKOFF_BASE", "1.0"))
+GEMINI_BACKOFF_MAX = float(os.getenv("GEMINI_BACKOFF_MAX", "60"))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_COOLDOWN_SECONDS = float(os.getenv("BREAKER_COOLDOWN_SECONDS", "60"))
+GEMINI_OUTPUT_TOKENS = int(os.getenv("GEMINI_OUTPUT_TOKENS", "512"))  # budgeted per call until the real usage is known
+LIMITER_DB_PATH = os.getenv("LIMITER_DB_PATH", "gemini_limiter.sqlite3")
+
+logger = logging.getLogger(__name__)
+
+# Errors worth retrying: rate limits, overload and server-side failures
+RETRYABLE_ERRORS = {"ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "InternalServerError",
+                    "DeadlineExceeded", "GatewayTimeout"}
+RETRYABLE_CODES = {429, 500, 502, 503, 504}
+RETRY_HINT_PATTERNS = (re.compile(r"retry in ([\d.]+)\s*s", re.IGNORECASE),
+                       re.compile(r"retry_delay\s*\{\s*seconds:\s*(\d+)", re.IGNORECASE))
+
+
+# Raised instead of calling Gemini while the API is unhealthy; the message
+# must go back to the queue rather than being acked as a failure.
+class GeminiUnavailable(Exception):
+    pass
+
+
+def is_retryable(exc):
+    return type(exc).__name__ in RETRYABLE_ERRORS or getattr(exc, "code", None) in RETRYABLE_CODES
+
+
+def retry_hint_seconds(exc):
+    delay = getattr(exc, "retry_delay", None)
+    if delay is not None:
+        return getattr(delay, "total_seconds", lambda: float(delay))()
+    for pattern in RETRY_HINT_PATTERNS:
+        match = pattern.search(str(exc))
+        if match:
+            return float(match.group(1))
+    return None
+
+
+# --- Shared state ---
+# Token buckets and breaker state live in one SQLite file. Every change runs
+# in a BEGIN IMMEDIATE transaction, which is the cross-process lock: all
+# worker threads and all processes on the host draw from the same budget.
+class _SharedState:
+    def __init__(self, path=LIMITER_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+
+    def connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, level REAL NOT NULL, updated_at REAL NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS breaker (name TEXT PRIMARY KEY, failures INTEGER NOT NULL, "
+                         "opened_until REAL NOT NULL)")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    # BEGIN IMMEDIATE ... COMMIT, rolled back on any error: a transaction left
+    # open would make every later BEGIN on this thread's connection fail
+    @contextlib.contextmanager
+    def transaction(self):
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+
+# --- Rate limiter (requests/minute and tokens/minute token buckets) ---
+class RateLimiter:
+    def __init__(self, state, rpm=GEMINI_RPM, tpm=GEMINI_TPM):
+        self.state = state
+        self.limits = {"requests": rpm, "tokens": tpm}
+
+    def _refill(self, conn, name, now):
+        capacity = self.limits[name]
+        row = conn.execute("SELECT level, updated_at FROM buckets WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return capacity
+        level, updated_at = row
+        return min(capacity, level + (now - updated_at) * capacity / 60.0)
+
+    # Blocks until one request and `tokens` tokens are available, then takes them
+    def acquire(self, tokens):
+        tokens = min(tokens, self.limits["tokens"])  # a single oversized call must still get through
+        while True:
+            now = time.time()
+            with self.state.transaction() as conn:
+                requests_level = self._refill(conn, "requests", now)
+                tokens_level = self._refill(conn, "tokens", now)
+                if requests_level >= 1 and tokens_level >= tokens:
+                    requests_level -= 1
+                    tokens_level -= tokens
+                    wait = 0.0
+                else:
+                    wait = max((1 - requests_level) * 60.0 / self.limits["requests"],
+                               (tokens - tokens_level) * 60.0 / self.limits["tokens"], 0.01)
+                conn.executemany("INSERT OR REPLACE INTO buckets (name, level, updated_at) VALUES (?, ?, ?)",
+                                 [("requests", requests_level, now), ("tokens", tokens_level, now)])
+            if wait == 0.0:
+                return
+            time.sleep(wait * random.uniform(1.0, 1.2))  # jitter so waiters don't wake in lockstep
+
+    # Correct the token bucket once the real usage is known
+    def settle(self, estimated, actual):
+        if actual is None or actual == estimated:
+            return
+        with self.state.transaction() as conn:
+            conn.execute("UPDATE buckets SET level = MIN(?, level + ?) WHERE name = 'tokens'",
+                         (self.limits["tokens"], estimated - actual))
+
+
+# --- Circuit breaker ---
+# Opens after BREAKER_FAILURE_THRESHOLD consecutive retryable failures and
+# stays open for BREAKER_COOLDOWN_SECONDS (or longer if the API asked for it).
+# After that calls go through again (half-open): the failure count is kept,
+# so one more failure re-opens it and a success closes it.
+class CircuitBreaker:
+    def __init__(self, state, name="gemini", threshold=BREAKER_FAILURE_THRESHOLD, cooldown=BREAKER_COOLDOWN_SECONDS):
+        self.state = state
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+
+    def _row(self, conn):
+        row = conn.execute("SELECT failures, opened_until FROM breaker WHERE name = ?", (self.name,)).fetchone()
+        return row or (0, 0.0)
+
+    def is_open(self):
+        _, opened_until = self._row(self.state.connection())
+        return time.time() < opened_until
+
+    def record_success(self):
+        conn = self.state.connection()
+        failures, _ = self._row(conn)
+        if failures:
+            conn.execute("INSERT OR REPLACE INTO breaker (name, failures, opened_until) VALUES (?, 0, 0)", (self.name,))
+            logger.info("Gemini circuit breaker closed.")
+
+    def record_failure(self, retry_after=None):
+        with self.state.transaction() as conn:
+            failures, opened_until = self._row(conn)
+            failures += 1
+            if failures >= self.threshold:
+                opened_until = time.time() + max(self.cooldown, retry_after or 0)
+                logger.warning(f"Gemini circuit breaker open for {opened_until - time.time():.0f}s "
+                               f"after {failures} consecutive failures.")
+            conn.execute("INSERT OR REPLACE INTO breaker (name, failures, opened_until) VALUES (?, ?, ?)",
+                         (self.name, failures, opened_until))
+
+
+# --- Guarded call: limiter + retries + breaker ---
+class GeminiGuard:
+    def __init__(self, path=LIMITER_DB_PATH, max_retries=GEMINI_MAX_RETRIES):
+        state = _SharedState(path)
+        self.limiter = RateLimiter(state)
+        self.breaker = CircuitBreaker(state)
+        self.max_retries = max_retries
+
+    def call(self, fn, estimated_tokens):
+        for attempt in range(self.max_retries + 1):
+            if self.breaker.is_open():
+                raise GeminiUnavailable("Gemini circuit breaker is open")
+            self.limiter.acquire(estimated_tokens)
+            try:
+                response = fn()
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                hint = retry_hint_seconds(e)
+                self.breaker.record_failure(retry_after=hint)
+                if attempt == self.max_retries:
+                    raise GeminiUnavailable(f"Gemini still failing after {attempt + 1} attempts: {e}") from e
+                # Full jitter, but never sooner than the server asked for
+                delay = max(hint or 0.0, random.uniform(0, min(GEMINI_BACKOFF_MAX, GEMINI_BACKOFF_BASE * 2 ** attempt)))
+                logger.warning(f"Gemini call failed (attempt {attempt + 1}/{self.max_retries + 1}): {e}. "
+                               f"Retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            self.breaker.record_success()
+            usage = getattr(response, "usage_metadata", None)
+            self.limiter.settle(estimated_tokens, getattr(usage, "total_token_count", None))
+            return response
+
+    # model.generate_content(parts) under the limiter, retries and breaker
+    def generate(self, model, parts, generation_config=None):
+        estimated = sum(len(str(part)) for part in parts) // 4 + GEMINI_OUTPUT_TOKENS
+        kwargs = {"generation_config": generation_config} if generation_config else {}
+
+        def call():
+            with stage_timer("generate_content"):
+                response = model.generate_content(parts, **kwargs)
+                response.resolve()
+            return response
+        return self.call(call, estimated)
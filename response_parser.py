@@ -0,0 +1,191 @@
+import os
+import re
+import ast
+import json
+import logging
+from dotenv import load_dotenv  # type: ignore
+
+from metrics import stage_timer, JSON_DECODE_FAILURES, JSON_RECOVERED
+
+# One place that turns Gemini answers into Python objects, for every caller
+# (single labels, batches, the standalone processors).
+# Where the model supports it, the answer is requested as JSON
+# (response_mime_type) shaped by a response_schema built from the handler's
+# fields, so most answers parse on the first json.loads. Everything else goes
+# through increasingly tolerant steps:
+#   direct     the text is the JSON value
+#   fenced     inside a ```json ... ``` block
+#   extracted  the first object/array in surrounding prose, trailing text ignored
+#   repaired   trailing commas, smart quotes, Python literals, truncated output
+# A parse that still fails costs a retried Gemini call, so it is counted.
+
+load_dotenv()
+
+# --- Config ---
+GEMINI_JSON_MODE = os.getenv("GEMINI_JSON_MODE", "true").lower() in ("1", "true", "yes")
+GEMINI_RESPONSE_SCHEMA = os.getenv("GEMINI_RESPONSE_SCHEMA", "true").lower() in ("1", "true", "yes")
+
+logger = logging.getLogger(__name__)
+
+FENCE_PATTERN = re.compile(r"```(?:json|JSON)?[ \t]*\n?(.*?)(?:```|$)", re.DOTALL)
+TRAILING_COMMA_PATTERN = re.compile(r",(\s*[}\]])")
+SMART_QUOTES = str.maketrans({"“": '"', "”": '"', "„": '"', "‘": "'", "’": "'"})
+
+# Models that answered a JSON-mode request with InvalidArgument; asked for plain text from then on
+_plain_text_models = set()
+
+
+class ResponseParseError(ValueError):
+    pass
+
+
+# --- Structured output requests ---
+def response_schema(fields, array=False):
+    item = {"type": "OBJECT", "properties": {field: {"type": "STRING"} for field in fields},
+            "required": list(fields)}
+    if not array:
+        return item
+    item["properties"]["label_id"] = {"type": "STRING"}
+    item["required"].append("label_id")
+    return {"type": "ARRAY", "items": item}
+
+
+def generation_config(fields=(), array=False):
+    if not GEMINI_JSON_MODE:
+        return None
+    config = {"response_mime_type": "application/json"}
+    if GEMINI_RESPONSE_SCHEMA and fields:
+        config["response_schema"] = response_schema(fields, array)
+    return config
+
+
+# generate(model, parts, generation_config=...) with a one-time fallback to plain
+# text for models that do not support JSON mode or response schemas
+def generate_structured(generate, model, parts, config):
+    model_name = getattr(model, "model_name", None)
+    if config is None or model_name in _plain_text_models:
+        return generate(model, parts)
+    try:
+        return generate(model, parts, generation_config=config)
+    except Exception as e:
+        if type(e).__name__ not in ("InvalidArgument", "BadRequest"):
+            raise
+        logger.warning(f"Gemini model '{model_name}' rejected JSON mode ({e}); using plain text for it.")
+        _plain_text_models.add(model_name)
+        return generate(model, parts)
+
+
+# --- Parsing ---
+def parse_response(text, array=False, fields=()):
+    with stage_timer("json_parse"):
+        try:
+            value, method = _parse(text or "", "[" if array else "{")
+        except ResponseParseError:
+            JSON_DECODE_FAILURES.inc()
+            raise
+    if method != "direct":
+        JSON_RECOVERED.labels(method).inc()
+        logger.debug(f"Gemini answer parsed after {method} step.")
+    return _coerce_list(value) if array else _coerce_object(value, fields)
+
+
+def _parse(text, opener):
+    text = text.strip()
+    if text[:1] in "{[":
+        try:
+            return json.loads(text), "direct"
+        except json.JSONDecodeError:
+            pass
+
+    fence = FENCE_PATTERN.search(text)
+    if fence:
+        try:
+            return json.loads(fence.group(1).strip()), "fenced"
+        except json.JSONDecodeError:
+            text = fence.group(1).strip()
+
+    start = _first_opener(text, opener)
+    if start < 0:
+        raise ResponseParseError(f"no JSON {'array' if opener == '[' else 'object'} in the answer")
+    candidate = text[start:]
+    try:
+        return json.JSONDecoder().raw_decode(candidate)[0], "extracted"
+    except json.JSONDecodeError as e:
+        error = e
+
+    repaired = _repair(candidate)
+    if repaired is not None:
+        return repaired, "repaired"
+    raise ResponseParseError(str(error))
+
+
+def _first_opener(text, opener):
+    # An object answer may still come wrapped in a list, and a batch may come as a lone object
+    positions = [i for i in (text.find(opener), text.find("{" if opener == "[" else "[")) if i >= 0]
+    return min(positions) if positions else -1
+
+
+def _repair(candidate):
+    candidate = TRAILING_COMMA_PATTERN.sub(r"\1", candidate.translate(SMART_QUOTES))
+    for attempt in (candidate, _close_truncated(candidate)):
+        try:
+            return json.JSONDecoder().raw_decode(attempt)[0]
+        except json.JSONDecodeError:
+            pass
+        try:
+            # {'key': 'value', 'ok': True} and other Python-style literals
+            value = ast.literal_eval(attempt)
+        except (ValueError, SyntaxError, MemoryError, RecursionError):
+            continue
+        if isinstance(value, (dict, list)):
+            return value
+    return None
+
+
+# Closes the strings and brackets of an answer cut off by the output token limit
+def _close_truncated(candidate):
+    stack = []
+    in_string = escaped = False
+    for ch in candidate:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]" and stack:
+            stack.pop()
+    closed = candidate + ('"' if in_string else "")
+    closed = closed.rstrip().rstrip(",")
+    if closed.endswith(":"):
+        closed += " null"
+    return TRAILING_COMMA_PATTERN.sub(r"\1", closed + "".join(reversed(stack)))
+
+
+# --- Shape checks ---
+def _coerce_object(value, fields):
+    if isinstance(value, list):
+        value = next((item for item in value if isinstance(item, dict)), None)
+    if not isinstance(value, dict):
+        raise ResponseParseError(f"expected a JSON object, got {type(value).__name__}")
+    # {"shipping_label": {...fields...}}: unwrap a single nested object holding the fields
+    if fields and not any(field in value for field in fields) and len(value) == 1:
+        inner = next(iter(value.values()))
+        if isinstance(inner, dict) and any(field in inner for field in fields):
+            return inner
+    return value
+
+
+def _coerce_list(value):
+    if isinstance(value, dict):
+        # {"labels": [...]} or a single label object
+        nested = [v for v in value.values() if isinstance(v, list)]
+        value = nested[0] if len(nested) == 1 else [value]
+    if not isinstance(value, list):
+        raise ResponseParseError(f"expected a JSON array, got {type(value).__name__}")
+    return value
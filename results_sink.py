@@ -0,0 +1,220 @@
+import os
+import sys
+import json
+import time
+import queue
+import sqlite3
+import logging
+import argparse
+import threading
+from dotenv import load_dotenv  # type: ignore
+
+load_dotenv()
+
+# --- Config ---
+RESULTS_SINK_ENABLED = os.getenv("RESULTS_SINK_ENABLED", "true").lower() in ("1", "true", "yes")
+RESULTS_DB_PATH = os.getenv("RESULTS_DB_PATH", "label_results.sqlite3")
+RESULTS_BATCH_SIZE = int(os.getenv("RESULTS_BATCH_SIZE", "200"))
+RESULTS_FLUSH_MS = int(os.getenv("RESULTS_FLUSH_MS", "200"))
+# FULL fsyncs every committed batch; NORMAL is faster but may lose the last batch on power loss
+RESULTS_SYNCHRONOUS = os.getenv("RESULTS_SYNCHRONOUS", "FULL").upper()
+# Ack redelivered or already-processed labels with their stored result (see ResultsSink.lookup)
+IDEMPOTENCY_ENABLED = os.getenv("IDEMPOTENCY_ENABLED", "true").lower() in ("1", "true", "yes")
+
+logger = logging.getLogger(__name__)
+
+NOT_FOUND = "Not found"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS label_results (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    label_type TEXT NOT NULL,
+    file_path TEXT,
+    tracking_number TEXT,
+    order_id TEXT,
+    status TEXT NOT NULL,
+    data TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS label_results_tracking ON label_results (tracking_number);
+CREATE INDEX IF NOT EXISTS label_results_order ON label_results (order_id);
+CREATE TABLE IF NOT EXISTS label_ledger (
+    message_id TEXT PRIMARY KEY,
+    label_type TEXT NOT NULL,
+    file_hash TEXT,
+    result_id INTEGER NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS label_ledger_file ON label_ledger (label_type, file_hash);
+"""
+
+
+def _indexed_value(data, field):
+    value = data.get(field) if isinstance(data, dict) else None
+    if not value or value == NOT_FOUND:
+        return None
+    return str(value).strip()
+
+
+def _row(label_type, file_path, data, created_at):
+    return (label_type, file_path, _indexed_value(data, "tracking_number"), _indexed_value(data, "order_id"),
+            "ok" if data else "failed", json.dumps(data, ensure_ascii=False) if data else None, created_at)
+
+
+def connect(path=RESULTS_DB_PATH):
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA synchronous={RESULTS_SYNCHRONOUS}")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+# --- Write-behind sink ---
+# submit() queues a result and returns at once; a writer thread commits
+# queued results in batches (one transaction each) and only then calls each
+# result's on_done(True). The caller acks the message from on_done, so a
+# message is never acked before its result is on disk. On a failed write
+# on_done(False) is called and the caller should requeue.
+# Successful results also go into the idempotency ledger, in the same
+# transaction, keyed by message id and file hash: lookup() lets a redelivered
+# or republished label be acked with its stored result instead of being
+# extracted (and paid for) again.
+class ResultsSink:
+    def __init__(self, path=RESULTS_DB_PATH, batch_size=RESULTS_BATCH_SIZE, flush_seconds=RESULTS_FLUSH_MS / 1000):
+        self.path = path
+        self.batch_size = max(1, batch_size)
+        self.flush_seconds = flush_seconds
+        self._queue = queue.Queue()
+        self._conn = connect(path)
+        self._reader = connect(path)  # lookups from worker threads, WAL lets them run beside the writer
+        self._read_lock = threading.Lock()
+        self._writer = threading.Thread(target=self._write_loop, name="results-sink", daemon=True)
+        self._writer.start()
+        logger.info(f"Results sink writing to {path} (batch {self.batch_size}, flush {flush_seconds:.3f}s)")
+
+    # children: (file path, data) of the labels of a multi-label file (see label_splitter.split_children),
+    # stored as rows of their own in the same transaction as the aggregate
+    def submit(self, label_type, file_path, data, on_done=None, message_id=None, file_hash=None, children=()):
+        now = time.time()
+        rows = [_row(label_type, file_path, data, now)]
+        rows.extend(_row(label_type, child_path, child, now) for child_path, child in children)
+        ledger = (message_id, label_type, file_hash) if data and (message_id or file_hash) else None
+        self._queue.put((rows, ledger, on_done))
+
+    # Stored result for this message id, else for the same file content of this label type
+    def lookup(self, label_type, message_id=None, file_hash=None):
+        if not IDEMPOTENCY_ENABLED or (not message_id and not file_hash):
+            return None
+        try:
+            with self._read_lock:
+                row = None
+                if message_id:
+                    row = self._reader.execute(
+                        "SELECT r.data FROM label_ledger l JOIN label_results r ON r.id = l.result_id "
+                        "WHERE l.message_id = ?", (message_id,)).fetchone()
+                if row is None and file_hash:
+                    row = self._reader.execute(
+                        "SELECT r.data FROM label_ledger l JOIN label_results r ON r.id = l.result_id "
+                        "WHERE l.label_type = ? AND l.file_hash = ? ORDER BY l.created_at DESC LIMIT 1",
+                        (label_type, file_hash)).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Ledger lookup failed: {e}")
+            return None
+        return json.loads(row[0]) if row and row[0] else None
+
+    def _write_loop(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_seconds
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._flush(batch)
+
+    def _flush(self, batch):
+        ok = True
+        try:
+            with self._conn:  # one transaction per batch
+                for rows, ledger, _ in batch:
+                    # The ledger points at the first row: the label, or the aggregate of a split file
+                    cursor = self._conn.execute(
+                        "INSERT INTO label_results (label_type, file_path, tracking_number, order_id, status, data, "
+                        "created_at) VALUES (?, ?, ?, ?, ?, ?, ?)", rows[0])
+                    result_id = cursor.lastrowid
+                    self._conn.executemany(
+                        "INSERT INTO label_results (label_type, file_path, tracking_number, order_id, status, data, "
+                        "created_at) VALUES (?, ?, ?, ?, ?, ?, ?)", rows[1:])
+                    if ledger:
+                        message_id, label_type, file_hash = ledger
+                        # Messages without an id are only deduplicated by file content
+                        self._conn.execute(
+                            "INSERT OR REPLACE INTO label_ledger (message_id, label_type, file_hash, result_id, "
+                            "created_at) VALUES (?, ?, ?, ?, ?)",
+                            (message_id or f"file:{label_type}:{file_hash}", label_type, file_hash,
+                             result_id, rows[0][-1]))
+            logger.debug(f"Results sink flushed {len(batch)} results.")
+        except sqlite3.Error as e:
+            ok = False
+            logger.error(f"Results sink failed to write {len(batch)} results: {e}", exc_info=True)
+        for _, _, on_done in batch:
+            if on_done:
+                try:
+                    on_done(ok)
+                except Exception as e:
+                    logger.error(f"Results sink callback failed: {e}", exc_info=True)
+
+    def close(self):
+        self._queue.put(None)
+        self._writer.join()
+        self._conn.close()
+        self._reader.close()
+        logger.info("Results sink closed.")
+
+
+# batch_size: at most the consumer's prefetch, which bounds the results that
+# can be waiting for their ack; a fuller batch could only wait for the flush timer
+def open_sink(batch_size=RESULTS_BATCH_SIZE):
+    return ResultsSink(batch_size=batch_size) if RESULTS_SINK_ENABLED else None
+
+
+# --- Lookups for reconciliation jobs ---
+def find_results(conn, tracking_number=None, order_id=None):
+    if tracking_number:
+        rows = conn.execute("SELECT label_type, file_path, data, created_at FROM label_results "
+                            "WHERE tracking_number = ? ORDER BY id", (tracking_number,))
+    else:
+        rows = conn.execute("SELECT label_type, file_path, data, created_at FROM label_results "
+                            "WHERE order_id = ? ORDER BY id", (order_id,))
+    return [{"label_type": t, "file_path": p, "data": json.loads(d) if d else None, "created_at": c}
+            for t, p, d, c in rows]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Look up stored label extraction results")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--tracking", help="tracking number")
+    group.add_argument("--order", help="order id")
+    parser.add_argument("--db", default=RESULTS_DB_PATH)
+    args = parser.parse_args()
+
+    conn = connect(args.db)
+    results = find_results(conn, tracking_number=args.tracking, order_id=args.order)
+    json.dump(results, sys.stdout, indent=2, ensure_ascii=False)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import pika  # type: ignore
+from dotenv import load_dotenv  # type: ignore
+
+from rate_limiter import is_retryable
+
+# Delayed retries and dead-lettering for label tasks. Every work queue Q gets
+#   Q.retry.1 .. Q.retry.N   holding queues with a per-tier x-message-ttl; when
+#                            a message expires RabbitMQ dead-letters it back to Q
+#   Q.dead                   failed labels with the reason in their headers
+# A retryable failure moves the message to the next tier and acks the
+# original; after the last tier, or on a permanent failure (corrupt PDF,
+# missing file, bad message), it goes to Q.dead. Q itself is not re-declared
+# with new arguments, so existing queues keep working.
+#   python retry_queues.py stats shipping_queue
+#   python retry_queues.py replay shipping_queue     # move Q.dead back to Q
+
+load_dotenv()
+
+# --- Config ---
+MESSAGE_QUEUE_HOST = os.getenv("MESSAGE_QUEUE_HOST", "localhost")
+# Delay of each retry tier in seconds; empty sends every failure straight to the dead-letter queue
+RETRY_DELAYS = [float(s) for s in os.getenv("RETRY_DELAYS", "30,300,1800").split(",") if s.strip()]
+
+logger = logging.getLogger(__name__)
+
+# Headers carried by retried and dead-lettered messages
+ATTEMPT_HEADER = "retry_attempt"
+REASON_HEADER = "failure_reason"
+DETAIL_HEADER = "failure_detail"
+FAILED_AT_HEADER = "failed_at"
+
+RETRIED = "retried"
+DEAD_LETTERED = "dead_lettered"
+
+
+# --- Failures ---
+# Raised by the consumers for labels that produced no result. retryable=False
+# means trying again cannot help, so the message is dead-lettered at once.
+class LabelFailure(Exception):
+    def __init__(self, reason, retryable, detail=None):
+        super().__init__(f"{reason}: {detail}" if detail else reason)
+        self.reason = reason
+        self.retryable = retryable
+        self.detail = detail
+
+
+def classify(exc):
+    if isinstance(exc, LabelFailure):
+        return exc
+    if isinstance(exc, (json.JSONDecodeError, UnicodeDecodeError)):
+        return LabelFailure("bad_message", False, str(exc))
+    if isinstance(exc, FileNotFoundError):
+        return LabelFailure("file_not_found", False, str(exc))
+    if is_retryable(exc) or isinstance(exc, (OSError, TimeoutError)):
+        return LabelFailure("transient_error", True, f"{type(exc).__name__}: {exc}")
+    # Unknown errors are not retried in a loop; the dead-letter queue can be replayed after a fix
+    return LabelFailure("error", False, f"{type(exc).__name__}: {exc}")
+
+
+# --- Topology ---
+def retry_queue_name(queue, tier):
+    return f"{queue}.retry.{tier}"
+
+
+def dead_letter_queue_name(queue):
+    return f"{queue}.dead"
+
+
+# (queue name, arguments) of every retry tier and the dead-letter queue
+def retry_topology(queue, delays=RETRY_DELAYS):
+    for tier, delay in enumerate(delays, start=1):
+        yield retry_queue_name(queue, tier), {
+            "x-message-ttl": int(delay * 1000),
+            "x-dead-letter-exchange": "",
+            "x-dead-letter-routing-key": queue,
+        }
+    yield dead_letter_queue_name(queue), None
+
+
+def declare_retry_queues(channel, queue, delays=RETRY_DELAYS):
+    for name, arguments in retry_topology(queue, delays):
+        channel.queue_declare(queue=name, durable=True, arguments=arguments)
+
+
+def attempts(properties):
+    headers = getattr(properties, "headers", None) or {}
+    try:
+        return int(headers.get(ATTEMPT_HEADER, 0))
+    except (TypeError, ValueError):
+        return 0
+
+
+# True when a retryable failure of this delivery would be dead-lettered
+def last_attempt(properties, delays=RETRY_DELAYS):
+    return attempts(properties) >= len(delays)
+
+
+# Where a failed message goes next: (routing key, outcome). Pure, so worker
+# threads can count the outcome before the publish runs on the connection thread.
+def next_destination(queue, properties, failure, delays=RETRY_DELAYS):
+    attempt = attempts(properties) + 1
+    if failure.retryable and attempt <= len(delays):
+        return retry_queue_name(queue, attempt), RETRIED
+    return dead_letter_queue_name(queue), DEAD_LETTERED
+
+
+def failure_headers(properties, failure):
+    headers = dict(getattr(properties, "headers", None) or {})
+    headers.update({
+        ATTEMPT_HEADER: attempts(properties) + 1,
+        REASON_HEADER: failure.reason,
+        DETAIL_HEADER: (failure.detail or "")[:500],
+        FAILED_AT_HEADER: time.time(),
+    })
+    return headers
+
+
+# Publishes the failed message to its retry tier or the dead-letter queue.
+# Must run on the connection thread; the caller acks the original afterwards.
+def route_failure(channel, queue, body, properties, failure, delays=RETRY_DELAYS):
+    routing_key, outcome = next_destination(queue, properties, failure, delays)
+    channel.basic_publish(exchange="", routing_key=routing_key, body=body, properties=pika.BasicProperties(
+        delivery_mode=2, content_type=getattr(properties, "content_type", None) or "application/json",
+        message_id=getattr(properties, "message_id", None), priority=getattr(properties, "priority", None),
+        headers=failure_headers(properties, failure)))
+    if outcome == RETRIED:
+        delay = delays[attempts(properties)]
+        logger.warning(f"Retrying in {delay:g}s ({routing_key}): {failure}")
+    else:
+        logger.error(f"Dead-lettered to {routing_key} after {attempts(properties) + 1} attempt(s): {failure}")
+    return outcome
+
+
+# --- CLI: inspect and replay dead-lettered labels ---
+def dead_letter_stats(channel, queue):
+    return {name: channel.queue_declare(queue=name, durable=True, passive=True).method.message_count
+            for name, _ in retry_topology(queue)}
+
+
+def replay(channel, queue, limit=None):
+    replayed = 0
+    while limit is None or replayed < limit:
+        method, properties, body = channel.basic_get(queue=dead_letter_queue_name(queue))
+        if method is None:
+            break
+        headers = dict(properties.headers or {})
+        logger.info(f"Replaying {body[:200]!r} (reason: {headers.get(REASON_HEADER)})")
+        # A replayed label starts over with the full set of retries
+        for key in (ATTEMPT_HEADER, REASON_HEADER, DETAIL_HEADER, FAILED_AT_HEADER):
+            headers.pop(key, None)
+        channel.basic_publish(exchange="", routing_key=queue, body=body, properties=pika.BasicProperties(
+            delivery_mode=2, content_type=properties.content_type, message_id=properties.message_id,
+            priority=properties.priority, headers=headers))
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+        replayed += 1
+    return replayed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Retry and dead-letter queues for label tasks")
+    parser.add_argument("command", choices=["stats", "replay"])
+    parser.add_argument("queue", help="work queue, e.g. shipping_queue")
+    parser.add_argument("--limit", type=int, help="replay at most this many messages")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+
+    connection = pika.BlockingConnection(pika.ConnectionParameters(host=MESSAGE_QUEUE_HOST))
+    try:
+        channel = connection.channel()
+        declare_retry_queues(channel, args.queue)
+        if args.command == "stats":
+            print(json.dumps(dead_letter_stats(channel, args.queue), indent=2))
+        else:
+            print(f"Replayed {replay(channel, args.queue, args.limit)} message(s) to {args.queue}")
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,10 @@ import pika # type: ignore
 import json
 import google.generativeai as genai
 from pypdf import PdfReader
+from response_parser import parse_response
+from task_payload import task_file
+from retry_queues import LabelFailure, route_failure, dead_letter_queue_name
+from fair_scheduler import declare_work_queue
 
 # --- Configuration ---
 MESSAGE_QUEUE_HOST = "localhost"
@@ -43,7 +47,7 @@ def process_return_label(pdf_content):
         if response.parts:
             print("Gemini response:")
             print(response.parts[0].text)  # In ra nội dung để kiểm tra
-            return json.loads(response.parts[0].text)
+            return parse_response(response.parts[0].text)  # fenced or chatty answers too
         else:
             print("No parts in Gemini response.")
             return None
@@ -55,6 +59,14 @@ def callback(ch, method, properties, body):
     message = json.loads(body.decode())
     file_path = message['file_path']
     print(f"Received task for shipping label: {file_path}")
+    try:
+        _, file_path = task_file(message)  # local copy when the PDF came inline or from the blob store
+    except LabelFailure as e:
+        # Bad payload: nothing to retry, keep the message in return_queue.dead
+        print(f"Invalid task for {file_path}: {e}")
+        route_failure(ch, 'return_queue', body, properties, e)
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+        return
 
     pdf_text = extract_text_from_pdf(file_path)
     if pdf_text:
@@ -73,8 +85,9 @@ def main():
     connection = pika.BlockingConnection(pika.ConnectionParameters(MESSAGE_QUEUE_HOST))
     channel = connection.channel()
     channel.exchange_declare(exchange='label_tasks', exchange_type='direct', durable=True)
-    channel.queue_declare(queue='return_queue', durable=True)
+    channel = declare_work_queue(connection, channel, 'return_queue')
     channel.queue_bind(exchange='label_tasks', queue='return_queue', routing_key='return')
+    channel.queue_declare(queue=dead_letter_queue_name('return_queue'), durable=True)
 
 
     channel.basic_qos(prefetch_count=1)
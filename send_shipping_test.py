@@ -1,5 +1,7 @@
 import pika # type: ignore
 import json
+from task_payload import attach_payload, open_store
+from fair_scheduler import task_properties
 
 connection = pika.BlockingConnection(pika.ConnectionParameters('localhost'))
 channel = connection.channel()
@@ -9,10 +11,15 @@ channel.exchange_declare(exchange='label_tasks', exchange_type='direct', durable
 message = {
     "file_path": r"D:\Desktop\Thực tập\A2A và MCP\Build the Label Detection Agent (A2A)\......pdf"
 }
+# Optional: "priority" (0-10 or bulk/low/normal/high/urgent/same_day) and the merchant or courier ("tenant")
+message.update({"priority": "urgent", "tenant": "test-merchant"})
+# Send the PDF itself (inline or via BLOB_STORE_URL) so the processor needs no access to this disk
+attach_payload(message, store=open_store())
 
 channel.basic_publish(
     exchange='label_tasks',
     routing_key='shipping',
+    properties=pika.BasicProperties(**task_properties(message, delivery_mode=2, content_type="application/json")),
     body=json.dumps(message)
 )
 
@@ -3,6 +3,9 @@ import pika   # type: ignore
 import json
 import google.generativeai as genai
 from pypdf import PdfReader
+from response_parser import parse_response, ResponseParseError
+from task_payload import task_file
+from fair_scheduler import declare_work_queue
 from pdf2image import convert_from_path # type: ignore
 import pytesseract # type: ignore
 pytesseract.pytesseract.tesseract_cmd = r"D:\Tesseract-OCR\tesseract.exe"
@@ -75,18 +78,11 @@ Return ONLY a valid JSON object with clear field names. Do not include explanati
             print("=== Gemini Raw Response ===")
             print(result)
 
-            # Clean up markdown (e.g., ```json ... ```)
-            if result.startswith("```"):
-                result = result.replace("```json", "").replace("```", "").strip()
-
-            if result.startswith("{") and result.endswith("}"):
-                try:
-                    return json.loads(result)
-                except json.JSONDecodeError as e:
-                    print(f"[!] JSON decode error: {e}")
-                    return None
-            else:
-                print("[!] Gemini response is not valid JSON.")
+            # Fences, surrounding text and small JSON mistakes are handled by response_parser
+            try:
+                return parse_response(result)
+            except ResponseParseError as e:
+                print(f"[!] Gemini response is not valid JSON: {e}")
                 return None
         else:
             print("[!] No content received from Gemini.")
@@ -101,6 +97,7 @@ def callback(ch, method, properties, body):
     message = json.loads(body.decode())
     file_path = message.get("file_path")
     print(f"\n📄 Received task for shipping label: {file_path}")
+    _, file_path = task_file(message)  # local copy when the PDF came inline or from the blob store
 
     # Step 1: Try extract with pypdf
     pdf_text = extract_text_from_pdf(file_path)
@@ -132,7 +129,7 @@ def main():
     connection = pika.BlockingConnection(pika.ConnectionParameters(MESSAGE_QUEUE_HOST))
     channel = connection.channel()
     channel.exchange_declare(exchange='label_tasks', exchange_type='direct', durable=True)
-    channel.queue_declare(queue='shipping_queue', durable=True)
+    channel = declare_work_queue(connection, channel, 'shipping_queue')
     channel.queue_bind(exchange='label_tasks', queue='shipping_queue', routing_key='shipping')
 
     channel.basic_qos(prefetch_count=1)
@@ -1,27 +1,37 @@
 import os
 import pika  # type: ignore
 import json
-import google.generativeai as genai
-from pypdf import PdfReader
-from pdf2image import convert_from_path # type: ignore
-import pytesseract # type: ignore
+import time
+import functools
 import logging
 from dotenv import load_dotenv # type: ignore
 import sys # Import sys for logging to sys.stdout
+from startup import (IMPORT_START, StartupTimer, warm_up_backends, report_when_warm, run_checks, print_checks)
+from worker_pool import (LabelWorkerPool, ConsumerGate, WORKER_CONCURRENCY, PREFETCH_COUNT, ack_threadsafe,
+                         settle_threadsafe, ledger_lookup)
+from results_sink import open_sink, RESULTS_BATCH_SIZE
+from fast_path import template_stats
+from model_tiering import tiering_stats
+from prompt_reducer import reduction_stats
+from barcode_stage import barcode_stats
+from metrics import start_metrics_server, start_profiler, report_queue_depth, MESSAGES, QUEUE_DEPTH_INTERVAL
+from label_handlers import SHIPPING_HANDLER, shipping_fields_found
+from label_pipeline import LabelExtractor, extraction_cache, gemini_guard
+from rate_limiter import GeminiUnavailable
+from retry_queues import LabelFailure, classify, route_failure, declare_retry_queues, last_attempt
+from label_splitter import should_split, extract_split_file, split_children
+from task_payload import task_file, blob_cache
+from fair_scheduler import declare_work_queue, prefetch_for, record_queue_latency
+import label_pipeline
+
+# Standalone shipping-only processor. label_agent.py runs shipping and return
+# labels in one process; this script is kept for running a single queue.
 
 # Load environment variables from .env file
 load_dotenv()
 
 # --- Config ---
 MESSAGE_QUEUE_HOST = os.getenv("MESSAGE_QUEUE_HOST", "localhost")
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL_NAME", "gemini-1.5-flash-latest")
-
-# If needed, specify the path to Tesseract (if it cannot be found automatically)
-# pytesseract.pytesseract.tesseract_cmd = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
-TESSERACT_CMD_PATH = os.getenv("TESSERACT_CMD_PATH", r"D:\Tesseract-OCR\tesseract.exe")
-GHOSTSCRIPT_PATH = os.getenv("GHOSTSCRIPT_PATH", r"D:\gs\gs10.02.1\bin\gswin64c.exe")
-POPPLER_PATH = os.getenv("POPPLER_PATH", r"D:\Release-24.08.0-0\poppler-24.08.0\Library\bin")
 
 # --- Logging Setup ---
 logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(),
@@ -29,159 +39,170 @@ logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(),
                     stream=sys.stdout) # Use sys.stdout for compatibility with containerized environments
 logger = logging.getLogger(__name__)
 
-# --- Initialize External Tools ---
-if TESSERACT_CMD_PATH:
-    pytesseract.pytesseract.tesseract_cmd = TESSERACT_CMD_PATH
-if GHOSTSCRIPT_PATH: # Though often not directly needed by pdf2image if Poppler is set
-    os.environ["GHOSTSCRIPT_PATH"] = GHOSTSCRIPT_PATH
-if POPPLER_PATH:
-    # Set the path to Poppler's bin directory for pdf2image to find pdftoppm.exe
-    os.environ["PATH"] += os.pathsep + POPPLER_PATH
-
-genai.configure(api_key=GEMINI_API_KEY)
-try:
-    gemini_model = genai.GenerativeModel(GEMINI_MODEL_NAME)
-    logger.info(f"Gemini model '{GEMINI_MODEL_NAME}' initialized successfully.")
-except Exception as e:
-    logger.critical(f"CRITICAL: Error initializing Gemini model: {e}", exc_info=True)
-    exit()
-
-# --- Gemini Prompt ---
-prompt = """
-You are an AI agent specialized in analyzing shipping labels from various courier services.
-Your task is to extract key shipment details from the attached shipping label (provided as a PDF document).
-Labels may be in different languages (including Vietnamese and English), contain both printed and handwritten text,
-and come in a variety of formats. Please extract the following fields clearly and return them in a clean JSON object:
-1. tracking_number  The shipment tracking number (e.g., SPXVM056647973), often labeled as "Tracking No.", "Tracking ID", or "Mã vận đơn". If multiple tracking numbers are present, prioritize the primary one or the longest one.
-2. order_id  The customer order ID (e.g., "258319PMADJ01"), often labeled as "Order ID" or "Mã đơn hàng".
-3. sender_address  Full sender's name, phone number, and address, typically after keywords like "FROM", "Từ", or "Sender".
-4. recipient_address  Full receiver's name, phone number, and address, typically after keywords like "TO", "Đến", or "Receiver".
-If any field is missing, ambiguous, or not found, return its value as "Not found".
-Return your output strictly as a valid JSON object. Do not include any explanations or additional text.
-Example output format: {"tracking_number": "...", "order_id": "...", "sender_address": "...", "recipient_address": "...", "delivery_date": "..."}
-"""
-
-# --- Extract PDF text via pypdf ---
-def extract_text_from_pdf(pdf_path):
-    text = ""
-    try:
-        reader = PdfReader(pdf_path)
-        for page in reader.pages:
-            extracted = page.extract_text()
-            if extracted:
-                text += extracted + "\n"
-    except FileNotFoundError:
-        logger.error(f"File not found: {pdf_path}")
-        return ""
-    except Exception as e:
-        logger.error(f"Error reading PDF {pdf_path} with pypdf: {e}", exc_info=True)
-        return ""
-    return text.strip()
-
-# --- Fallback OCR for image-based PDFs ---
-def extract_text_with_ocr(pdf_path):
-    logger.info(f"🔁 Falling back to OCR for: {pdf_path}")
-    try:
-        # Path to the directory containing pdftoppm.exe
-        if not POPPLER_PATH:
-            logger.warning("POPPLER_PATH not configured. OCR might fail or be slow.")
-        images = convert_from_path(pdf_path, poppler_path=POPPLER_PATH)
-        text = ""
-        for image in images:
-            text += pytesseract.image_to_string(image) + "\n" # Add newline like pypdf extraction
-        return text.strip()
-    except Exception as e:
-        logger.error(f"OCR failed for {pdf_path}: {e}", exc_info=True)
-        return ""
+# --- Gemini model and OCR tools ---
+# Created in the background at startup (see startup.py) while the broker
+# connection opens; MODEL_CONFIG_PATH can swap the model without a restart.
 
-# --- Process shipping label via Gemini ---
-def process_shipping_label(pdf_content: str):
-    try:
-        if not pdf_content.strip():
-            logger.warning("PDF content for shipping label is empty. Skipping Gemini call.")
-            return None
-
-        logger.info(f"Sending content (length: {len(pdf_content)}) to Gemini for shipping label processing.")
-        response = gemini_model.generate_content([prompt, pdf_content]) # Corrected method name
-        response.resolve()
-
-        if response.parts:
-            result = response.parts[0].text.strip()
-            logger.debug(f"=== Gemini Raw Response (Shipping) ===\n{result}")
-
-            # Clean up markdown (e.g., ```json ... ```)
-            if result.startswith("```json"):
-                result = result[len("```json"):].strip()
-            if result.startswith("```"): # General case after json specific
-                result = result[len("```"):].strip()
-            if result.endswith("```"):
-                result = result[:-len("```")].strip()
-            try:
-                return json.loads(result)
-            except json.JSONDecodeError as e:
-                logger.error(f"JSON decode error for shipping label: {e}. Raw response: '{result}'", exc_info=True)
-                return None
-        else:
-            logger.warning(f"No content (parts) received from Gemini for shipping label. Prompt feedback: {getattr(response, 'prompt_feedback', 'N/A')}")
-            return None
+# --- Gemini Prompt (see label_handlers.py) ---
+prompt = SHIPPING_HANDLER.prompt
+shipping_extractor = LabelExtractor(SHIPPING_HANDLER)
 
-    except Exception as e:
-        logger.error(f"Error during Gemini extraction for shipping label: {e}", exc_info=True)
-        if 'response' in locals() and hasattr(response, 'prompt_feedback'): # Log feedback if available
-            logger.error(f"Gemini Prompt Feedback: {response.prompt_feedback}")
-        return None
+# --- Results sink: batched SQLite writes, acks only after the batch is committed ---
+# Opened by main(), so importing this module (or --check) creates no database
+results_sink = None
 
-# --- RabbitMQ callback ---
-def callback(ch, method, properties, body):
-    message = json.loads(body.decode())
-    file_path = message.get("file_path")
-    logger.info(f"📄 Received task for shipping label: {file_path}")
+# --- Read label text: pypdf first, OCR fallback ---
+def read_label_text(file_path):
+    return label_pipeline.read_label_text(file_path, stop_when=shipping_fields_found)
 
-    # Step 1: Try extract with pypdf
-    pdf_text = extract_text_from_pdf(file_path)
-    logger.debug(f"🔍 PDF Text Preview (pypdf) for {file_path}:\n{pdf_text[:300] if pdf_text else '[Empty]'}")
+# --- Process shipping label via fast path / cache / Gemini ---
+def process_shipping_label(pdf_content: str, file_path=None, pages=None):
+    return shipping_extractor.process(pdf_content, file_path, pages)
 
-    # Step 2: Fallback to OCR if needed
-    if not pdf_text.strip():
-        pdf_text = extract_text_with_ocr(file_path)
-        logger.debug(f"🔍 PDF Text Preview (OCR) for {file_path}:\n{pdf_text[:300] if pdf_text else '[Empty]'}")
+# --- Handle extraction result ---
+def handle_extracted_data(file_path, extracted_data):
+    label_pipeline.handle_extracted_data(SHIPPING_HANDLER.name, file_path, extracted_data)
 
-    if not pdf_text.strip():
-        logger.warning(f"Skipping file (unreadable after pypdf and OCR): {file_path}")
+# --- RabbitMQ callback ---
+def callback(ch, method, properties, body):
+    file_path = None
+    try:
+        message = json.loads(body.decode())
+        file_path = message.get("file_path")
+        logger.info(f"📄 Received task for shipping label: {file_path}")
+        record_queue_latency(SHIPPING_HANDLER.name, properties, message)
+        # The PDF on this node: inline payload, blob-store reference or shared path
+        file_path, local_path = task_file(message)
+
+        # Redelivered or republished label: ack with the result already stored
+        stored, file_hash = ledger_lookup(results_sink, SHIPPING_HANDLER.name, properties, local_path)
+        if stored is not None:
+            logger.info(f"♻️ {file_path} was already processed; acking with the stored result.")
+            handle_extracted_data(file_path, stored)
+            MESSAGES.labels(SHIPPING_HANDLER.name, "duplicate").inc()
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
+
+        if should_split(local_path, SHIPPING_HANDLER):
+            # Multi-label export: one Gemini call per label, one aggregated result for the file
+            extracted_data = extract_split_file(local_path, SHIPPING_HANDLER, process_shipping_label,
+                                                getattr(properties, "message_id", None) or file_hash or file_path,
+                                                final=last_attempt(properties), source=file_path)
+        else:
+            # Barcodes first: when they answer the label, neither OCR nor Gemini runs
+            extracted_data = shipping_extractor.barcode_answer(local_path)
+            if extracted_data is None:
+                pdf_text = read_label_text(local_path) or ""
+                extracted_data = process_shipping_label(pdf_text, local_path)
+                if not extracted_data and not pdf_text.strip():
+                    raise LabelFailure("unreadable", retryable=False, detail="no text after pypdf and OCR, no barcodes")
+        handle_extracted_data(file_path, extracted_data)
+        if not extracted_data:
+            raise LabelFailure("extraction_failed", retryable=True)
+    except GeminiUnavailable as e:
+        # Gemini is unhealthy: put the label back instead of acking a failure
+        logger.warning(f"Requeueing {file_path}: {e}")
+        MESSAGES.labels(SHIPPING_HANDLER.name, "requeued").inc()
+        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+        return
+    except Exception as e:
+        # Retry tier or dead-letter queue, then ack (see retry_queues.py)
+        failure = classify(e)
+        if failure.reason == "error":
+            logger.error(f"Unhandled error while processing {file_path}: {e}", exc_info=True)
+        outcome = route_failure(ch, 'shipping_queue', body, properties, failure)
+        MESSAGES.labels(SHIPPING_HANDLER.name, outcome).inc()
         ch.basic_ack(delivery_tag=method.delivery_tag)
         return
+    MESSAGES.labels(SHIPPING_HANDLER.name, "processed").inc()
 
-    extracted_data = process_shipping_label(pdf_text)
-    if extracted_data:
-        logger.info(f"✅ Extracted Shipping Label Data for {file_path}:")
-        logger.info(json.dumps(extracted_data, indent=2, ensure_ascii=False)) # Indent 2 for brevity in logs
+    if results_sink:
+        results_sink.submit(SHIPPING_HANDLER.name, file_path, extracted_data,
+                            on_done=functools.partial(settle_threadsafe, ch, method.delivery_tag),
+                            message_id=getattr(properties, "message_id", None), file_hash=file_hash,
+                            children=split_children(file_path, extracted_data))
     else:
-        logger.error(f"Failed to extract data from shipping label: {file_path}")
-
-    ch.basic_ack(delivery_tag=method.delivery_tag)
+        ack_threadsafe(ch, method.delivery_tag)
 
 # --- Main function to start RabbitMQ consumer ---
 def main():
+    global results_sink
+    if "--check" in sys.argv[1:]:
+        # Dependency readiness report, no consuming
+        sys.exit(print_checks(run_checks([SHIPPING_HANDLER], MESSAGE_QUEUE_HOST), as_json="--json" in sys.argv[1:]))
+
+    # No more results can wait for their ack than the channel has unacked deliveries: with prefetch 1
+    # each result is committed at once instead of after RESULTS_FLUSH_MS
+    prefetch = prefetch_for(PREFETCH_COUNT) if WORKER_CONCURRENCY > 1 else 1
+    results_sink = open_sink(batch_size=min(RESULTS_BATCH_SIZE, prefetch))
+
     connection = None
+    channel = None
+    pool = None
+    profiler = None
+    timer = StartupTimer()
+    timer.mark("imports", IMPORT_START)
     try:
-        connection = pika.BlockingConnection(pika.ConnectionParameters(host=MESSAGE_QUEUE_HOST))
+        warm_up = warm_up_backends([SHIPPING_HANDLER], timer)
+        start_metrics_server()
+        profiler = start_profiler()
+        with timer.phase("rabbitmq"):
+            connection = pika.BlockingConnection(pika.ConnectionParameters(host=MESSAGE_QUEUE_HOST))
         channel = connection.channel()
-        channel.queue_declare(queue='shipping_queue', durable=True)
-
-        channel.basic_qos(prefetch_count=1)
-        channel.basic_consume(queue='shipping_queue', on_message_callback=callback)
+        # Priority queue (see fair_scheduler.py); an existing plain queue is used as it is
+        channel = declare_work_queue(connection, channel, 'shipping_queue')
+        declare_retry_queues(channel, 'shipping_queue')
+        # Stop consuming while the Gemini circuit breaker is open
+        gate = ConsumerGate(gemini_guard.breaker)
+
+        if WORKER_CONCURRENCY > 1:
+            # Worker-pool mode: several labels in flight, acked per delivery tag from the pool
+            pool = LabelWorkerPool(read_label_text, process_shipping_label, handle_extracted_data, sink=results_sink,
+                                   split_handler=SHIPPING_HANDLER, barcode_fn=shipping_extractor.barcode_answer)
+            # Deliveries beyond the pool's concurrency wait in its fair scheduler
+            channel.basic_qos(prefetch_count=prefetch)
+            gate.consume(channel, 'shipping_queue', pool.on_message)
+        else:
+            channel.basic_qos(prefetch_count=prefetch)
+            gate.consume(channel, 'shipping_queue', callback)
+        report_when_warm(timer, warm_up)
         logger.info("🔄 [*] Waiting for shipping label tasks. To exit press CTRL+C")
-        channel.start_consuming()
+        # Our own loop, not start_consuming(): that returns as soon as the gate cancels the only consumer
+        next_depth_check = 0.0
+        while True:
+            connection.process_data_events(time_limit=1)
+            gate.check()
+            if time.monotonic() >= next_depth_check:
+                report_queue_depth(channel, 'shipping_queue')
+                next_depth_check = time.monotonic() + QUEUE_DEPTH_INTERVAL
     except pika.exceptions.AMQPConnectionError as e:
         logger.critical(f"Failed to connect to RabbitMQ: {e}", exc_info=True)
         sys.exit(1) # Exit if connection fails
     except KeyboardInterrupt:
         logger.info("KeyboardInterrupt received. Stopping consumer...")
-        if connection and connection.is_open:
-            connection.stop_consuming()
+        if channel and channel.is_open:
+            channel.stop_consuming()
     except Exception as e:
         logger.critical(f"Unhandled exception in main consumer loop: {e}", exc_info=True)
     finally:
+        logger.info(f"Extraction cache stats: {extraction_cache.stats()}")
+        logger.info(f"Fast path template stats: {template_stats()}")
+        logger.info(f"Model tiering stats: {tiering_stats()}")
+        logger.info(f"Prompt reduction stats: {reduction_stats()}")
+        logger.info(f"Barcode stats: {barcode_stats()}")
+        logger.info(f"Blob cache stats: {blob_cache.stats}")
+        if pool:
+            # Let in-flight labels finish before the last results are stored
+            pool.shutdown(wait=True)
+            logger.info(f"Scheduler stats: {pool.scheduler_stats()}")
+        if results_sink:
+            # Commit the last batch; its acks are flushed below
+            results_sink.close()
+        if connection and connection.is_open:
+            connection.process_data_events(time_limit=1)
+        shipping_extractor.shutdown()
+        if profiler:
+            profiler.stop()
         if connection and connection.is_open:
             connection.close()
             logger.info("RabbitMQ connection closed. Exiting.")
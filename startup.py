@@ -0,0 +1,295 @@
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import sqlite3
+import threading
+import importlib
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv  # type: ignore
+
+# Imported first by the entry points, so IMPORT_START is close to interpreter start
+IMPORT_START = time.perf_counter()
+
+# Fast startup for the processor processes. pypdf, pytesseract/pdf2image and
+# google.generativeai are imported where they are first used, not at module
+# level; at startup they are loaded in the background instead:
+#   warm_up_backends()  imports pypdf, loads the OCR backend (if a label type
+#                       OCRs) and the barcode decoder (if it reads barcodes)
+#                       and opens the Gemini models, in parallel threads,
+#                       while the broker connection is opened and the
+#                       consumers are declared
+#   StartupTimer        times each phase (imports, broker, consumers and every
+#                       background backend) and logs the breakdown once ready
+#   run_checks()        the --check readiness mode: reports whether each
+#                       dependency is available, without consuming anything
+#   python label_agent.py --check          # exit code 0 when every required check passes
+#   python label_agent.py --check --json
+
+load_dotenv()
+
+# --- Config ---
+STARTUP_WARM_UP = os.getenv("STARTUP_WARM_UP", "true").lower() in ("1", "true", "yes")
+STARTUP_CHECK_TIMEOUT = float(os.getenv("STARTUP_CHECK_TIMEOUT", "10"))  # seconds per readiness check
+
+logger = logging.getLogger(__name__)
+
+
+# --- Startup breakdown ---
+# Phases are timed with `with timer.phase(name):`, from any thread. Phases
+# that ran in the background are reported with their start offset, so the
+# breakdown shows what overlapped with the broker connection.
+class StartupTimer:
+    def __init__(self, start=IMPORT_START):
+        self.start = start
+        self.phases = {}  # name -> (offset seconds, duration seconds, error)
+        self._lock = threading.Lock()
+
+    def mark(self, name, since):
+        self._record(name, since, None)
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def _record(self, name, since, error):
+        now = time.perf_counter()
+        with self._lock:
+            self.phases[name] = (since - self.start, now - since, error)
+
+    def report(self):
+        with self._lock:
+            phases = sorted(self.phases.items(), key=lambda item: item[1][0])
+        report = {name: {"at_ms": round(offset * 1000, 1), "ms": round(duration * 1000, 1),
+                         **({"error": error} if error else {})}
+                  for name, (offset, duration, error) in phases}
+        report["total_ms"] = round((time.perf_counter() - self.start) * 1000, 1)
+        return report
+
+    def log_report(self, label="Startup"):
+        report = self.report()
+        total = report.pop("total_ms")
+        parts = ", ".join(f"{name} {entry['ms']:.0f} ms @{entry['at_ms']:.0f}"
+                          + (" (failed)" if "error" in entry else "") for name, entry in report.items())
+        logger.info(f"⏱️ {label} ready in {total:.0f} ms: {parts}")
+
+
+class _Phase:
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.since = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.timer._record(self.name, self.since, str(exc) if exc is not None else None)
+        return False
+
+
+# --- Background warm-up ---
+def _warm_pdf():
+    importlib.import_module("pypdf")
+
+
+def _warm_ocr():
+    from ocr_stage import ocr_backend
+    ocr_backend()
+
+
+def _warm_barcodes():
+    from barcode_stage import decoder
+    decoder()
+
+
+def _warm_gemini(handlers):
+    from model_pool import model_pool
+    model_pool.warm_up({model_pool.model_name_for(h.name) for h in handlers})
+    model_pool.start_health_checks()
+
+
+# Loads the backends the given label types need, one thread each, and returns
+# at once. Failures are logged: the first label that needs the backend retries
+# the import or connection itself. Pass gemini=False when the caller supplies
+# its own model (benchmarks, fake Gemini).
+def warm_up_backends(handlers, timer=None, gemini=True):
+    timer = timer or StartupTimer(time.perf_counter())
+    if not STARTUP_WARM_UP:
+        return None
+    tasks = {"pypdf": _warm_pdf}
+    if any(h.ocr_fallback for h in handlers):
+        tasks["ocr"] = _warm_ocr
+    if any(h.barcode_fields for h in handlers):
+        tasks["barcodes"] = _warm_barcodes
+    if gemini:
+        tasks["gemini"] = lambda: _warm_gemini(handlers)
+
+    def run(name, fn):
+        try:
+            with timer.phase(name):
+                fn()
+        except Exception as e:
+            logger.warning(f"Background warm-up of {name} failed: {e}")
+
+    executor = ThreadPoolExecutor(max_workers=len(tasks), thread_name_prefix="warm-up")
+    futures = [executor.submit(run, name, fn) for name, fn in tasks.items()]
+    executor.shutdown(wait=False)
+    return futures
+
+
+# Waits for the warm-up futures (if any) and logs the startup breakdown
+def report_when_warm(timer, futures, label="Startup"):
+    def wait():
+        for future in futures or ():
+            future.result()
+        timer.log_report(label)
+    threading.Thread(target=wait, name="startup-report", daemon=True).start()
+
+
+# --- Readiness checks (--check) ---
+# Each check returns a short detail string (a version, a path) or raises.
+def _check_module(name):
+    def check():
+        module = importlib.import_module(name)
+        return getattr(module, "__version__", None) or "installed"
+    return check
+
+
+def _check_tesseract():
+    from ocr_stage import ocr_backend, OCR_LANG
+    _, _, pytesseract = ocr_backend()
+    version = pytesseract.get_tesseract_version()
+    missing = set(OCR_LANG.split("+")) - set(pytesseract.get_languages(config=""))
+    if missing:
+        raise RuntimeError(f"tesseract {version} lacks traineddata for {'+'.join(sorted(missing))}")
+    return f"tesseract {version} ({OCR_LANG})"
+
+
+def _check_poppler():
+    from ocr_stage import ocr_backend, POPPLER_PATH
+    ocr_backend()  # puts POPPLER_PATH on PATH
+    path = shutil.which("pdftoppm") or shutil.which("pdftoppm", path=POPPLER_PATH or None)
+    if path is None:
+        raise RuntimeError(f"pdftoppm not found on PATH or in POPPLER_PATH ({POPPLER_PATH})")
+    return path
+
+
+def _check_barcode_decoder():
+    from barcode_stage import decoder, BARCODE_ENABLED
+    if not BARCODE_ENABLED:
+        return "disabled"
+    if decoder() is None:
+        raise RuntimeError("neither zxing-cpp nor pyzbar (with the zbar library) is installed")
+    return "available"
+
+
+def _check_gemini(handlers):
+    def check():
+        from model_pool import model_pool, GEMINI_API_KEY
+        if not GEMINI_API_KEY:
+            raise RuntimeError("GEMINI_API_KEY is not set")
+        names = sorted({model_pool.model_name_for(h.name) for h in handlers})
+        model_pool.warm_up(names)
+        failed = {name: model_pool.health[name]["error"] for name in names if not model_pool.health[name]["ok"]}
+        if failed:
+            raise RuntimeError(f"count_tokens failed: {failed}")
+        return ", ".join(f"{name} {model_pool.health[name]['latency_ms']:.0f} ms" for name in names)
+    return check
+
+
+def _check_broker(host):
+    def check():
+        import pika  # type: ignore
+        connection = pika.BlockingConnection(pika.ConnectionParameters(
+            host=host, socket_timeout=STARTUP_CHECK_TIMEOUT, blocked_connection_timeout=STARTUP_CHECK_TIMEOUT))
+        connection.close()
+        return host
+    return check
+
+
+# An existing database must open read-write; a missing one is created on first
+# use, so only its directory is checked (--check leaves no files behind)
+def _check_sqlite(path):
+    def check():
+        if not os.path.exists(path):
+            directory = os.path.dirname(os.path.abspath(path))
+            if not os.access(directory, os.W_OK | os.X_OK):
+                raise RuntimeError(f"{directory} does not exist or is not writable")
+            return f"{path} (created on first use)"
+        uri = "file:" + os.path.abspath(path).replace(os.sep, "/") + "?mode=rw"
+        sqlite3.connect(uri, uri=True, timeout=STARTUP_CHECK_TIMEOUT).execute("PRAGMA schema_version").fetchone()
+        if not os.access(path, os.W_OK):
+            raise RuntimeError(f"{path} is not writable")
+        return path
+    return check
+
+
+def _check_blob_store():
+    from task_payload import open_store
+    store = open_store()
+    if store is None:
+        return "not configured (shared paths)"
+    return store.check()
+
+
+# (name, check, required) for the given label types and broker host
+def readiness_checks(handlers, host):
+    from label_cache import CACHE_ENABLED, CACHE_PATH
+    from results_sink import RESULTS_SINK_ENABLED, RESULTS_DB_PATH
+    from rate_limiter import LIMITER_DB_PATH
+    ocr = any(h.ocr_fallback for h in handlers)
+    checks = [
+        ("pypdf", _check_module("pypdf"), True),
+        ("google.generativeai", _check_module("google.generativeai"), True),
+        ("pika", _check_module("pika"), True),
+        ("pytesseract", _check_module("pytesseract"), ocr),
+        ("pdf2image", _check_module("pdf2image"), ocr),
+        ("numpy", _check_module("numpy"), False),       # OCR preprocessing (ocr_preprocess.py)
+        ("tesserocr", _check_module("tesserocr"), False),  # persistent Tesseract (ocr_stage.py)
+        ("tesseract", _check_tesseract, ocr),
+        ("poppler", _check_poppler, ocr),
+        ("barcode_decoder", _check_barcode_decoder, False),  # barcode_stage.py
+        ("prometheus_client", _check_module("prometheus_client"), False),
+        ("gemini", _check_gemini(handlers), True),
+        ("rabbitmq", _check_broker(host), True),
+        ("results_db", _check_sqlite(RESULTS_DB_PATH), RESULTS_SINK_ENABLED),
+        ("limiter_db", _check_sqlite(LIMITER_DB_PATH), True),
+        ("blob_store", _check_blob_store, True),
+    ]
+    if CACHE_ENABLED:
+        checks.append(("cache_db", _check_sqlite(CACHE_PATH), False))
+    return checks
+
+
+# Runs every check in parallel; returns [{"name", "ok", "required", "detail", "ms"}]
+def run_checks(handlers, host):
+    def run(name, check, required):
+        start = time.perf_counter()
+        try:
+            detail, ok = check(), True
+        except BaseException as e:  # a missing module can raise SystemExit on import
+            detail, ok = f"{type(e).__name__}: {e}", False
+        return {"name": name, "ok": ok, "required": bool(required), "detail": str(detail),
+                "ms": round((time.perf_counter() - start) * 1000, 1)}
+
+    checks = readiness_checks(handlers, host)
+    with ThreadPoolExecutor(max_workers=len(checks), thread_name_prefix="check") as executor:
+        futures = [executor.submit(run, *check) for check in checks]
+        return [future.result() for future in futures]
+
+
+# Prints the results and returns the exit code: 0 when every required check passed
+def print_checks(results, as_json=False, out=sys.stdout):
+    ready = all(r["ok"] for r in results if r["required"])
+    if as_json:
+        json.dump({"ready": ready, "checks": results}, out, indent=2)
+        out.write("\n")
+    else:
+        width = max(len(r["name"]) for r in results)
+        for r in results:
+            status = "ok" if r["ok"] else ("FAIL" if r["required"] else "missing")
+            out.write(f"{r['name']:<{width}}  {status:<7}  {r['ms']:>7.0f} ms  {r['detail']}\n")
+        out.write(f"{'ready' if ready else 'NOT READY'}\n")
+    return 0 if ready else 1
@@ -0,0 +1,430 @@
+import os
+import sys
+import json
+import math
+import time
+import base64
+import signal
+import logging
+import argparse
+import subprocess
+import urllib.error
+import urllib.request
+from urllib.parse import quote
+from dotenv import load_dotenv  # type: ignore
+
+from label_handlers import get_handlers
+from metrics import start_metrics_server, SUPERVISOR_WORKERS
+
+# Runs the label processors as a pool of worker processes per label type and
+# sizes each pool from its queue, instead of one hand-started terminal per
+# script:
+#   workers    `python label_agent.py <type>` per worker (SUPERVISOR_WORKER_SCRIPT);
+#              crashed workers are replaced, at most every SUPERVISOR_RESTART_BACKOFF
+#   depth      every SUPERVISOR_POLL_SECONDS from the RabbitMQ management API
+#              (ready, unacked, publish rate), or a passive AMQP declare when
+#              the plugin is not enabled, or a LocalBroker in-process
+#   time       the observed seconds per label, from the workers' shared
+#              Prometheus files (label_processing_seconds); before any label
+#              is done, SUPERVISOR_LABEL_SECONDS
+#   scaling    enough workers to keep up with arrivals and clear the backlog
+#              within SUPERVISOR_TARGET_DRAIN_SECONDS, within each type's
+#              bounds; up at once, down one worker at a time once fewer were
+#              needed for SUPERVISOR_SCALE_DOWN_DELAY
+#   draining   a worker is stopped with SIGTERM (CTRL_BREAK on Windows): it
+#              stops consuming, finishes and acks its labels, and exits; it is
+#              killed after SUPERVISOR_DRAIN_TIMEOUT
+# The workers write their metrics under the supervisor's multiprocess
+# directory, so the supervisor's /metrics endpoint covers all of them.
+#   python supervisor.py                          # every label type, default bounds
+#   python supervisor.py shipping return --bounds shipping=2:12 return=0:2
+#   python supervisor.py --dry-run                # log the decisions, start nothing
+
+load_dotenv()
+
+# --- Config ---
+MESSAGE_QUEUE_HOST = os.getenv("MESSAGE_QUEUE_HOST", "localhost")
+RABBITMQ_MANAGEMENT_URL = os.getenv("RABBITMQ_MANAGEMENT_URL", f"http://{MESSAGE_QUEUE_HOST}:15672")
+RABBITMQ_VHOST = os.getenv("RABBITMQ_VHOST", "/")
+RABBITMQ_USER = os.getenv("RABBITMQ_USER", "guest")
+RABBITMQ_PASSWORD = os.getenv("RABBITMQ_PASSWORD", "guest")
+SUPERVISOR_DEPTH_SOURCE = os.getenv("SUPERVISOR_DEPTH_SOURCE", "auto").lower()  # auto | management | amqp
+SUPERVISOR_WORKER_SCRIPT = os.getenv("SUPERVISOR_WORKER_SCRIPT", "label_agent.py")
+SUPERVISOR_MIN_WORKERS = int(os.getenv("SUPERVISOR_MIN_WORKERS", "1"))
+SUPERVISOR_MAX_WORKERS = int(os.getenv("SUPERVISOR_MAX_WORKERS", "8"))
+# type=min:max pairs, e.g. "shipping=2:12,return=0:2"; other types use the two settings above
+SUPERVISOR_BOUNDS = os.getenv("SUPERVISOR_BOUNDS", "")
+SUPERVISOR_POLL_SECONDS = float(os.getenv("SUPERVISOR_POLL_SECONDS", "5"))
+SUPERVISOR_TARGET_DRAIN_SECONDS = float(os.getenv("SUPERVISOR_TARGET_DRAIN_SECONDS", "120"))
+SUPERVISOR_SCALE_DOWN_DELAY = float(os.getenv("SUPERVISOR_SCALE_DOWN_DELAY", "120"))
+SUPERVISOR_DRAIN_TIMEOUT = float(os.getenv("SUPERVISOR_DRAIN_TIMEOUT", "300"))
+SUPERVISOR_RESTART_BACKOFF = float(os.getenv("SUPERVISOR_RESTART_BACKOFF", "10"))
+SUPERVISOR_LABEL_SECONDS = float(os.getenv("SUPERVISOR_LABEL_SECONDS", "5"))  # until a label has been timed
+
+# --- Logging Setup ---
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(),
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    stream=sys.stdout)
+logger = logging.getLogger(__name__)
+
+
+# --- Queue depth ---
+# Each source returns {"ready", "unacked", "consumers", "publish_rate"} for a
+# queue; publish_rate is None when the source cannot tell.
+class ManagementApiDepth:
+    def __init__(self, url=RABBITMQ_MANAGEMENT_URL, vhost=RABBITMQ_VHOST, user=RABBITMQ_USER,
+                 password=RABBITMQ_PASSWORD):
+        self.url = url.rstrip("/")
+        self.vhost = vhost
+        self.auth = "Basic " + base64.b64encode(f"{user}:{password}".encode()).decode()
+
+    def stats(self, queue):
+        request = urllib.request.Request(f"{self.url}/api/queues/{quote(self.vhost, safe='')}/{quote(queue, safe='')}",
+                                         headers={"Authorization": self.auth})
+        try:
+            with urllib.request.urlopen(request, timeout=5) as response:
+                data = json.load(response)
+        except urllib.error.HTTPError as e:
+            if e.code == 404:  # not declared yet: nothing waiting
+                return {"ready": 0, "unacked": 0, "consumers": 0, "publish_rate": None}
+            raise
+        rate = data.get("message_stats", {}).get("publish_details", {}).get("rate")
+        return {"ready": data.get("messages_ready", 0), "unacked": data.get("messages_unacknowledged", 0),
+                "consumers": data.get("consumers", 0), "publish_rate": rate}
+
+
+# Passive declares on one connection: ready messages and consumers only
+class AmqpDepth:
+    def __init__(self, host=MESSAGE_QUEUE_HOST):
+        self.host = host
+        self.connection = None
+        self.channel = None
+
+    def stats(self, queue):
+        import pika  # type: ignore
+        if self.connection is None or not self.connection.is_open:
+            self.connection = pika.BlockingConnection(pika.ConnectionParameters(host=self.host))
+            self.channel = None
+        if self.channel is None or not self.channel.is_open:
+            self.channel = self.connection.channel()
+        self.connection.process_data_events(time_limit=0)  # heartbeats between polls
+        try:
+            method = self.channel.queue_declare(queue=queue, durable=True, passive=True).method
+        except pika.exceptions.ChannelClosedByBroker as e:
+            self.channel = None
+            if e.reply_code == 404:
+                return {"ready": 0, "unacked": 0, "consumers": 0, "publish_rate": None}
+            raise
+        return {"ready": method.message_count, "unacked": 0, "consumers": method.consumer_count,
+                "publish_rate": None}
+
+
+# The in-process stand-in (local_broker.py), for benchmarks and trials
+class LocalBrokerDepth:
+    def __init__(self, broker):
+        self.broker = broker
+
+    def stats(self, queue):
+        return {"ready": self.broker.queue_depth(queue), "unacked": 0, "consumers": 0, "publish_rate": None}
+
+
+def open_depth_source(source=SUPERVISOR_DEPTH_SOURCE):
+    if source == "amqp":
+        return AmqpDepth()
+    management = ManagementApiDepth()
+    if source == "management":
+        return management
+    try:
+        management.stats("label-supervisor-probe")
+        logger.info(f"Queue depth from the management API at {management.url}")
+        return management
+    except (OSError, ValueError) as e:
+        logger.info(f"Management API unavailable ({e}); queue depth from passive AMQP declares.")
+        return AmqpDepth()
+
+
+# --- Observed time per label ---
+# label_processing_seconds of every worker, read from the multiprocess
+# directory they share with the supervisor: {label type: (sum, count)}
+def label_seconds_totals():
+    try:
+        from prometheus_client import CollectorRegistry  # type: ignore
+        from prometheus_client import multiprocess  # type: ignore
+    except ImportError:
+        return {}
+    if not os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        return {}
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    totals = {}
+    for metric in registry.collect():
+        if metric.name != "label_processing_seconds":
+            continue
+        for sample in metric.samples:
+            label_type = sample.labels.get("label_type")
+            total, count = totals.get(label_type, (0.0, 0.0))
+            if sample.name.endswith("_sum"):
+                totals[label_type] = (sample.value, count)
+            elif sample.name.endswith("_count"):
+                totals[label_type] = (total, sample.value)
+    return totals
+
+
+# Seconds per label and labels done per second, from the change in the
+# totals between two polls; the time is smoothed over polls
+class LabelTimer:
+    def __init__(self, default=SUPERVISOR_LABEL_SECONDS, smoothing=0.3):
+        self.seconds = default
+        self.smoothing = smoothing
+        self._last = None  # (time, sum, count)
+
+    def update(self, now, total, count):
+        done_rate = None
+        if self._last is not None and now > self._last[0]:
+            done = count - self._last[2]
+            done_rate = max(0.0, done) / (now - self._last[0])
+            if done > 0:
+                mean = (total - self._last[1]) / done
+                self.seconds += self.smoothing * (mean - self.seconds)
+        self._last = (now, total, count)
+        return done_rate
+
+
+# --- Scaling policy ---
+# Workers needed for one label type: each runs `concurrency` labels at once,
+# so it does concurrency / seconds_per_label labels a second. Enough workers
+# to keep up with the arrivals and clear the backlog in `target_drain`
+# seconds, within [min_workers, max_workers]. Scales up at once; scales down
+# one worker per `scale_down_delay` while fewer are needed, so a short lull
+# in a spike does not stop workers that are needed again a minute later.
+class Autoscaler:
+    def __init__(self, min_workers, max_workers, concurrency=1, target_drain=SUPERVISOR_TARGET_DRAIN_SECONDS,
+                 scale_down_delay=SUPERVISOR_SCALE_DOWN_DELAY):
+        self.min_workers = max(0, min_workers)
+        self.max_workers = max(self.min_workers, max_workers)
+        self.concurrency = max(1, concurrency)
+        self.target_drain = max(1.0, target_drain)
+        self.scale_down_delay = scale_down_delay
+        self.target = self.min_workers
+        self._lower_since = None
+
+    def needed(self, backlog, seconds_per_label, arrival_rate=0.0):
+        per_worker = self.concurrency / max(seconds_per_label, 0.001)  # labels/s
+        workers = (arrival_rate or 0.0) / per_worker + backlog / (per_worker * self.target_drain)
+        return max(self.min_workers, min(self.max_workers, math.ceil(workers - 1e-9)))
+
+    def decide(self, now, backlog, seconds_per_label, arrival_rate=0.0):
+        wanted = self.needed(backlog, seconds_per_label, arrival_rate)
+        if wanted >= self.target:
+            self.target = wanted
+            self._lower_since = None
+        elif self._lower_since is None:
+            self._lower_since = now
+        elif now - self._lower_since >= self.scale_down_delay:
+            self.target -= 1
+            self._lower_since = now
+        return self.target
+
+
+def parse_bounds(text, default=(SUPERVISOR_MIN_WORKERS, SUPERVISOR_MAX_WORKERS)):
+    bounds = {}
+    for pair in text.replace(" ", ",").split(","):
+        if "=" not in pair:
+            continue
+        name, _, span = pair.partition("=")
+        low, _, high = span.partition(":")
+        bounds[name.strip()] = (int(low or default[0]), int(high or default[1]))
+    return bounds
+
+
+# --- Worker processes ---
+class Worker:
+    def __init__(self, label_type, process):
+        self.label_type = label_type
+        self.process = process
+        self.started = time.monotonic()
+        self.draining_since = None
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+
+def _mark_dead(pid):
+    try:
+        from prometheus_client import multiprocess  # type: ignore
+        multiprocess.mark_process_dead(pid)
+    except (ImportError, OSError, KeyError):
+        pass
+
+
+class Supervisor:
+    def __init__(self, handlers, source, bounds=None, script=SUPERVISOR_WORKER_SCRIPT, dry_run=False,
+                 poll_seconds=SUPERVISOR_POLL_SECONDS):
+        bounds = bounds or {}
+        self.handlers = handlers
+        self.source = source
+        self.script = os.path.join(os.path.dirname(os.path.abspath(__file__)), script) \
+            if not os.path.isabs(script) else script
+        self.dry_run = dry_run
+        self.poll_seconds = poll_seconds
+        self.scalers = {h.name: Autoscaler(*bounds.get(h.name, (SUPERVISOR_MIN_WORKERS, SUPERVISOR_MAX_WORKERS)),
+                                           concurrency=h.concurrency) for h in handlers}
+        self.timers = {h.name: LabelTimer() for h in handlers}
+        self.workers = {h.name: [] for h in handlers}
+        self.last_backlog = {}  # label type -> (time, backlog)
+        self.last_crash = {}    # label type -> time of the last unexpected exit
+
+    # --- Processes ---
+    def spawn(self, handler):
+        # One /metrics endpoint (the supervisor's) for the shared multiprocess directory
+        env = dict(os.environ, METRICS_PORT="0")
+        kwargs = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP} if os.name == "nt" else {}
+        process = subprocess.Popen([sys.executable, self.script, handler.name], env=env, **kwargs)
+        self.workers[handler.name].append(Worker(handler.name, process))
+        logger.info(f"▶️ Started {handler.name} worker (pid {process.pid})")
+
+    # Stop consuming, finish and ack the labels in flight, exit (see label_agent.main)
+    def drain(self, worker):
+        if worker.draining_since is not None:
+            return
+        worker.draining_since = time.monotonic()
+        try:
+            worker.process.send_signal(signal.CTRL_BREAK_EVENT if os.name == "nt" else signal.SIGTERM)
+            logger.info(f"⏏️ Draining {worker.label_type} worker (pid {worker.pid})")
+        except OSError as e:
+            logger.warning(f"Cannot signal worker {worker.pid}: {e}")
+
+    # Forgets exited workers and kills those draining for too long
+    def reap(self):
+        now = time.monotonic()
+        for label_type, workers in self.workers.items():
+            for worker in list(workers):
+                code = worker.process.poll()
+                if code is None:
+                    if worker.draining_since is not None and now - worker.draining_since > SUPERVISOR_DRAIN_TIMEOUT:
+                        logger.error(f"Worker {worker.pid} still draining after {SUPERVISOR_DRAIN_TIMEOUT:.0f}s; "
+                                     f"killing it (its unacked labels are redelivered).")
+                        worker.process.kill()
+                    continue
+                workers.remove(worker)
+                _mark_dead(worker.pid)
+                if worker.draining_since is None:
+                    self.last_crash[label_type] = now
+                    logger.error(f"{label_type} worker (pid {worker.pid}) exited with code {code}; replacing it.")
+                else:
+                    logger.info(f"{label_type} worker (pid {worker.pid}) drained in "
+                                f"{now - worker.draining_since:.1f}s (exit code {code}).")
+
+    def active(self, label_type):
+        return [w for w in self.workers[label_type] if w.draining_since is None]
+
+    # --- Control loop ---
+    def tick(self):
+        self.reap()
+        now = time.monotonic()
+        totals = label_seconds_totals()
+        for handler in self.handlers:
+            name = handler.name
+            try:
+                stats = self.source.stats(handler.queue)
+            except Exception as e:
+                logger.warning(f"Cannot read the depth of {handler.queue}: {e}; keeping {name} as it is.")
+                continue
+            backlog = stats["ready"] + stats["unacked"]
+            timer = self.timers[name]
+            done_rate = timer.update(now, *totals.get(name, (0.0, 0.0)))
+            arrival_rate = stats["publish_rate"]
+            if arrival_rate is None and name in self.last_backlog and done_rate is not None:
+                # Arrivals = growth of the backlog + what the workers finished meanwhile
+                then, previous = self.last_backlog[name]
+                arrival_rate = max(0.0, (backlog - previous) / max(now - then, 0.001) + done_rate)
+            self.last_backlog[name] = (now, backlog)
+
+            target = self.scalers[name].decide(now, backlog, timer.seconds, arrival_rate)
+            active = self.active(name)
+            logger.debug(f"{name}: backlog {backlog}, {timer.seconds:.2f}s/label, "
+                         f"arrivals {arrival_rate or 0:.2f}/s -> {target} worker(s), {len(active)} running")
+            if self.dry_run:
+                if target != len(active):
+                    logger.info(f"[dry run] {name}: backlog {backlog}, {timer.seconds:.2f}s/label -> "
+                                f"{target} worker(s)")
+                    self.workers[name] = [Worker(name, _DryRunProcess()) for _ in range(target)]
+                continue
+            if len(active) < target:
+                if now - self.last_crash.get(name, -SUPERVISOR_RESTART_BACKOFF) < SUPERVISOR_RESTART_BACKOFF:
+                    continue  # a worker just crashed; don't start a crash loop
+                logger.info(f"📈 {name}: backlog {backlog}, {timer.seconds:.2f}s/label -> {target} worker(s)")
+                for _ in range(target - len(active)):
+                    self.spawn(handler)
+            elif len(active) > target:
+                logger.info(f"📉 {name}: backlog {backlog}, {timer.seconds:.2f}s/label -> {target} worker(s)")
+                # The youngest go first: the others have their caches and connections warm
+                for worker in sorted(active, key=lambda w: w.started)[target:]:
+                    self.drain(worker)
+            SUPERVISOR_WORKERS.labels(name, "running").set(len(self.active(name)))
+            SUPERVISOR_WORKERS.labels(name, "draining").set(len(self.workers[name]) - len(self.active(name)))
+
+    def run(self):
+        logger.info(f"🧭 Supervising {', '.join(h.name for h in self.handlers)} "
+                    f"(bounds {', '.join(f'{n} {s.min_workers}-{s.max_workers}' for n, s in self.scalers.items())}, "
+                    f"poll {self.poll_seconds:g}s)")
+        while True:
+            self.tick()
+            time.sleep(self.poll_seconds)
+
+    # Drains every worker and waits for them, up to SUPERVISOR_DRAIN_TIMEOUT
+    def stop(self):
+        for workers in self.workers.values():
+            for worker in workers:
+                self.drain(worker)
+        deadline = time.monotonic() + SUPERVISOR_DRAIN_TIMEOUT
+        while any(self.workers.values()) and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.2)
+        for workers in self.workers.values():
+            for worker in workers:
+                logger.error(f"Killing worker {worker.pid} after the drain timeout.")
+                worker.process.kill()
+        logger.info("All workers stopped.")
+
+
+class _DryRunProcess:
+    pid = 0
+
+    def poll(self):
+        return None
+
+    def send_signal(self, signum):
+        pass
+
+    def kill(self):
+        pass
+
+
+# --- Entry Point ---
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Worker processes per label type, scaled by queue depth")
+    parser.add_argument("label_types", nargs="*", help="label types to run (default: all)")
+    parser.add_argument("--bounds", nargs="*", default=[], metavar="TYPE=MIN:MAX",
+                        help="workers per label type (default: SUPERVISOR_BOUNDS or "
+                             f"{SUPERVISOR_MIN_WORKERS}:{SUPERVISOR_MAX_WORKERS})")
+    parser.add_argument("--source", default=SUPERVISOR_DEPTH_SOURCE, choices=["auto", "management", "amqp"],
+                        help="where queue depth comes from")
+    parser.add_argument("--dry-run", action="store_true", help="log the scaling decisions without starting workers")
+    args = parser.parse_args(argv)
+
+    handlers = get_handlers(args.label_types)
+    bounds = parse_bounds(",".join([SUPERVISOR_BOUNDS] + args.bounds))
+    supervisor = Supervisor(handlers, open_depth_source(args.source), bounds, dry_run=args.dry_run)
+    start_metrics_server()
+    try:
+        supervisor.run()
+    except KeyboardInterrupt:
+        logger.info("KeyboardInterrupt received. Draining workers...")
+    finally:
+        supervisor.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+import os
+import json
+import random
+import argparse
+import unicodedata
+
+# Synthetic shipping-label PDFs for the benchmarks: text-layer PDFs (pypdf
+# path) and image-only PDFs (OCR path), Vietnamese and English layouts,
+# 1-20 pages (label first, packing list after). Same seed, same corpus.
+#   python synthetic_labels.py bench_corpus --labels 40 --seed 1
+# Writes the PDFs and a manifest.json with each file's kind, language, page
+# count and the field values printed on it.
+#   python synthetic_labels.py ocr_corpus --image-share 1 --scan-noise 0.01
+# makes the image-only pages look like thermal-printer scans: specks, a
+# barcode under the label and a slight skew (benchmark_ocr.py). With zxing-cpp
+# installed the barcode is a real Code128 of the tracking number
+# (barcode_stage.py), otherwise random bars.
+#   python synthetic_labels.py bench_corpus --export 500 --per-page 2
+# also writes export.pdf, one warehouse export holding 500 labels (2 per
+# page), and export.json with their fields in order.
+
+PAGE_WIDTH, PAGE_HEIGHT = 288, 432  # 4x6 inch label, in points
+IMAGE_DPI = 150
+FONT_CANDIDATES = [
+    "DejaVuSans.ttf", "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/Library/Fonts/Arial Unicode.ttf", r"C:\Windows\Fonts\arial.ttf",
+]
+
+FIRST_NAMES = ["Nguyen Van An", "Tran Thi Binh", "Le Van Cuong", "Pham Thi Dung", "Hoang Van Em", "Vu Thi Giang"]
+STREETS = ["12 Le Loi", "34 Tran Hung Dao", "56 Hai Ba Trung", "78 Nguyen Hue", "90 Ly Thuong Kiet"]
+CITIES = ["Q1, TP HCM", "Hoan Kiem, Ha Noi", "Hai Chau, Da Nang", "Ninh Kieu, Can Tho", "TP Hue"]
+PRODUCTS = ["Ao thun cotton", "Op lung dien thoai", "Sach tieng Anh", "Tai nghe bluetooth", "Binh giu nhiet"]
+
+LAYOUTS = {
+    "vi": {"courier": "Shopee Xpress", "tracking": "Mã vận đơn", "order": "Mã đơn hàng",
+           "sender": "Từ", "recipient": "Đến", "weight": "Khối lượng", "items": "Danh sách sản phẩm"},
+    "en": {"courier": "Express Delivery", "tracking": "Tracking No.", "order": "Order ID",
+           "sender": "FROM", "recipient": "TO", "weight": "Weight", "items": "Packing list"},
+}
+
+
+# --- Label content ---
+def make_label(rng, language, pages):
+    words = LAYOUTS[language]
+    prefix = "SPXVN" if language == "vi" else rng.choice(["GHN", "JNT", "VTP"])
+    fields = {
+        "tracking_number": f"{prefix}{rng.randrange(10**9, 10**10)}",
+        "order_id": f"{rng.randrange(10**5, 10**6)}PM{rng.choice('ABCDEFGH')}{rng.randrange(10, 99)}",
+        "sender_address": _party(rng),
+        "recipient_address": _party(rng),
+    }
+    label = [
+        words["courier"],
+        f"{words['tracking']}: {fields['tracking_number']}",
+        f"{words['sender']}: {fields['sender_address'][0]}",
+        *fields["sender_address"][1:],
+        f"{words['recipient']}: {fields['recipient_address'][0]}",
+        *fields["recipient_address"][1:],
+        f"{words['order']}: {fields['order_id']}",
+        f"{words['weight']}: {rng.randrange(100, 5000)}g",
+    ]
+    fields["sender_address"] = ", ".join(fields["sender_address"])
+    fields["recipient_address"] = ", ".join(fields["recipient_address"])
+    page_lines = [label]
+    for page in range(2, pages + 1):
+        items = [f"{i}. {rng.choice(PRODUCTS)} x{rng.randrange(1, 5)}" for i in range(1, rng.randrange(8, 20))]
+        page_lines.append([f"{words['items']} ({page}/{pages})", *items])
+    return fields, page_lines
+
+
+def _party(rng):
+    return [rng.choice(FIRST_NAMES), f"0{rng.choice('389')}{rng.randrange(10**7, 10**8)}",
+            rng.choice(STREETS), rng.choice(CITIES)]
+
+
+# --- Text-layer PDF (hand-written, Helvetica / WinAnsi) ---
+# The standard fonts only cover cp1252, so Vietnamese letters outside it are
+# written without their diacritics (ã stays, ậ becomes a, đ becomes d).
+def _cp1252(text):
+    out = []
+    for ch in text:
+        try:
+            ch.encode("cp1252")
+            out.append(ch)
+        except UnicodeEncodeError:
+            base = unicodedata.normalize("NFD", ch.replace("đ", "d").replace("Đ", "D"))[0]
+            out.append(base if base.isascii() else "?")
+    return "".join(out).encode("cp1252")
+
+
+def _pdf_string(text):
+    return b"(" + _cp1252(text).replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)") + b")"
+
+
+def write_text_pdf(path, page_lines):
+    objects = [None, None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>"]
+    kids = []
+    for lines in page_lines:
+        content = b"BT /F1 11 Tf 14 TL 18 %d Td " % (PAGE_HEIGHT - 30)
+        content += b" T* ".join(_pdf_string(line) + b" Tj" for line in lines) + b" ET"
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content))
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] /Resources << /Font << /F1 3 0 R >> >> "
+                       b"/Contents %d 0 R >>" % (PAGE_WIDTH, PAGE_HEIGHT, len(objects)))
+        kids.append(len(objects))
+    objects[0] = b"<< /Type /Catalog /Pages 2 0 R >>"
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % k for k in kids), len(kids))
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+# --- Image-only PDF (Pillow: one scanned-looking page image per page) ---
+def _font(size):
+    from PIL import ImageFont  # type: ignore
+    for candidate in FONT_CANDIDATES:
+        try:
+            return ImageFont.truetype(candidate, size)
+        except OSError:
+            continue
+    return ImageFont.load_default()
+
+
+def write_image_pdf(path, page_lines, dpi=IMAGE_DPI, noise=0.0, barcode=None):
+    from PIL import Image, ImageDraw  # type: ignore
+    size = (PAGE_WIDTH * dpi // 72, PAGE_HEIGHT * dpi // 72)
+    font = _font(11 * dpi // 72)
+    rng = random.Random(os.path.basename(path))  # same file name, same specks
+    images = []
+    for number, lines in enumerate(page_lines):
+        image = Image.new("L", size, 255)
+        draw = ImageDraw.Draw(image)
+        y = 20 * dpi // 72
+        for line in lines:
+            draw.text((18 * dpi // 72, y), line, fill=0, font=font)
+            y += 14 * dpi // 72
+        if noise:
+            if number == 0:
+                _draw_barcode(image, draw, rng, 18 * dpi // 72, y + 8 * dpi // 72, size[0] - 18 * dpi // 72,
+                              40 * dpi // 72, barcode)
+            for _ in range(int(noise * size[0] * size[1])):
+                draw.point((rng.randrange(size[0]), rng.randrange(size[1])), fill=rng.randrange(0, 128))
+            image = image.rotate(rng.uniform(-3, 3), resample=Image.BILINEAR, fillcolor=255)
+        images.append(image)
+    images[0].save(path, "PDF", resolution=dpi, save_all=True, append_images=images[1:])
+
+
+# A Code128 of `text` when zxing-cpp is installed, else random bars
+def _draw_barcode(image, draw, rng, left, top, right, height, text=None):
+    if text:
+        try:
+            import numpy as np  # type: ignore
+            import zxingcpp  # type: ignore
+            from PIL import Image  # type: ignore
+            symbol = zxingcpp.create_barcode(text, zxingcpp.BarcodeFormat.Code128)
+            bars = Image.fromarray(np.asarray(zxingcpp.write_barcode_to_image(symbol, scale=2))).convert("L")
+            if bars.width > right - left:
+                bars = bars.resize((right - left, bars.height), Image.NEAREST)
+            image.paste(bars.resize((bars.width, height), Image.NEAREST), (left, top))
+            return
+        except (ImportError, AttributeError):  # older zxing-cpp has no create_barcode
+            pass
+    x = left
+    while x < right:
+        width = rng.choice((1, 2, 3))
+        draw.rectangle([x, top, x + width - 1, top + height], fill=0)
+        x += width + rng.choice((1, 2, 3))
+
+
+# --- Corpus ---
+def generate_corpus(out_dir, labels, seed=1, image_share=0.3, vi_share=0.5, max_pages=20, scan_noise=0.0):
+    os.makedirs(out_dir, exist_ok=True)
+    rng = random.Random(seed)
+    manifest = []
+    for i in range(labels):
+        language = "vi" if rng.random() < vi_share else "en"
+        kind = "image" if rng.random() < image_share else "text"
+        # Most labels are one page; a tail goes up to max_pages
+        pages = 1 if rng.random() < 0.6 else rng.randrange(2, max_pages + 1)
+        fields, page_lines = make_label(rng, language, pages)
+        path = os.path.join(out_dir, f"label_{i:04d}_{kind}_{language}_{pages}p.pdf")
+        if kind == "image":
+            write_image_pdf(path, page_lines, noise=scan_noise, barcode=fields["tracking_number"])
+        else:
+            write_text_pdf(path, page_lines)
+        manifest.append({"file_path": os.path.abspath(path), "kind": kind, "language": language,
+                         "pages": pages, "fields": fields})
+    with open(os.path.join(out_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    return manifest
+
+
+# --- Multi-label export (label_splitter.py) ---
+def generate_export(out_dir, labels, seed=1, per_page=1, vi_share=0.5):
+    os.makedirs(out_dir, exist_ok=True)
+    rng = random.Random(seed)
+    expected, pages = [], []
+    for i in range(labels):
+        fields, page_lines = make_label(rng, "vi" if rng.random() < vi_share else "en", 1)
+        expected.append(fields)
+        if i % per_page == 0:
+            pages.append([])
+        pages[-1].extend(page_lines[0])
+    write_text_pdf(os.path.join(out_dir, "export.pdf"), pages)
+    with open(os.path.join(out_dir, "export.json"), "w", encoding="utf-8") as f:
+        json.dump(expected, f, ensure_ascii=False, indent=1)
+    return expected
+
+
+def load_manifest(corpus_dir):
+    with open(os.path.join(corpus_dir, "manifest.json"), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic label PDF corpus")
+    parser.add_argument("out_dir")
+    parser.add_argument("--labels", type=int, default=40)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--image-share", type=float, default=0.3, help="share of image-only (OCR) PDFs")
+    parser.add_argument("--vi-share", type=float, default=0.5, help="share of Vietnamese layouts")
+    parser.add_argument("--max-pages", type=int, default=20)
+    parser.add_argument("--scan-noise", type=float, default=0.0,
+                        help="share of speckled pixels on image-only pages (adds a barcode and skew too)")
+    parser.add_argument("--export", type=int, default=0, help="also write export.pdf holding this many labels")
+    parser.add_argument("--per-page", type=int, default=1, help="labels per page of export.pdf")
+    args = parser.parse_args(argv)
+    manifest = generate_corpus(args.out_dir, args.labels, args.seed, args.image_share, args.vi_share, args.max_pages,
+                               args.scan_noise)
+    kinds = {k: sum(1 for m in manifest if m["kind"] == k) for k in ("text", "image")}
+    print(f"Wrote {len(manifest)} labels to {args.out_dir} ({kinds['text']} text-layer, {kinds['image']} image-only)")
+    if args.export:
+        generate_export(args.out_dir, args.export, args.seed, args.per_page, args.vi_share)
+        pages = -(-args.export // args.per_page)
+        print(f"Wrote export.pdf with {args.export} labels on {pages} pages")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,403 @@
+import os
+import sys
+import json
+import zlib
+import base64
+import shutil
+import hashlib
+import logging
+import argparse
+import tempfile
+import threading
+from urllib.parse import urlparse
+from dotenv import load_dotenv  # type: ignore
+
+try:
+    import boto3  # type: ignore
+    from botocore.exceptions import BotoCoreError, ClientError  # type: ignore
+except ImportError:  # only needed for s3:// blob stores
+    boto3 = None
+    BotoCoreError = ClientError = Exception
+
+from label_cache import file_digest
+from retry_queues import LabelFailure
+
+# Task messages used to carry only a local file_path, so every consumer had
+# to see the producer's filesystem. A message may now carry the PDF itself:
+#   {"file_path": "...", "payload": {"kind": "inline", "compression": "zlib",
+#    "data": "<base64>", "sha256": "...", "size": 1234}}
+#   {"file_path": "...", "payload": {"kind": "ref", "url": "s3://labels/ab/ab12...pdf",
+#    "sha256": "...", "size": 5678901}}
+# Small PDFs go inline (zlib + base64), larger ones are uploaded to the blob
+# store (a directory, or any S3-compatible store such as MinIO) under their
+# sha256 and sent by reference. Consumers only read file:// references under
+# their own BLOB_STORE_URL, and inflate inline payloads up to PAYLOAD_MAX_BYTES. file_path stays in the message as the
+# label's name in logs and results. Consumers call task_file(message) for a
+# local path: payloads are written to, and references streamed into, a
+# content-addressed read-through cache. Messages without a payload still
+# name a local file, as before.
+#   python task_payload.py put label.pdf      # upload, print the message payload
+#   python task_payload.py get <message.json> # resolve a message to a local file
+
+load_dotenv()
+
+# --- Config ---
+# auto: inline up to PAYLOAD_INLINE_MAX_BYTES, else a blob reference (or the path without a store)
+PAYLOAD_MODE = os.getenv("PAYLOAD_MODE", "auto").lower()  # auto | inline | ref | path
+PAYLOAD_INLINE_MAX_BYTES = int(os.getenv("PAYLOAD_INLINE_MAX_BYTES", str(256 * 1024)))
+# file:///srv/label-blobs, /srv/label-blobs or s3://bucket/prefix; empty disables references
+BLOB_STORE_URL = os.getenv("BLOB_STORE_URL", "")
+# Largest PDF an inline payload may inflate to; a bigger one is rejected as bad_payload
+PAYLOAD_MAX_BYTES = int(os.getenv("PAYLOAD_MAX_BYTES", str(64 * 1024 * 1024)))
+BLOB_S3_ENDPOINT = os.getenv("BLOB_S3_ENDPOINT") or None  # e.g. http://minio:9000
+BLOB_CACHE_DIR = os.getenv("BLOB_CACHE_DIR", os.path.join(tempfile.gettempdir(), "label_blobs"))
+BLOB_CACHE_MAX_BYTES = int(os.getenv("BLOB_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+BLOB_CACHE_EVICT_EVERY = int(os.getenv("BLOB_CACHE_EVICT_EVERY", "50"))  # cache writes between eviction passes
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+KIND_INLINE = "inline"
+KIND_REF = "ref"
+
+
+# A payload that can never be read (bad encoding, checksum mismatch, too
+# large, blob outside the store): the message is dead-lettered as bad_payload
+class PayloadError(LabelFailure):
+    def __init__(self, detail):
+        super().__init__("bad_payload", retryable=False, detail=detail)
+
+
+# --- Blob stores ---
+class LocalBlobStore:
+    def __init__(self, root):
+        self.root = root
+
+    def url(self, key):
+        return "file://" + os.path.abspath(os.path.join(self.root, key)).replace(os.sep, "/")
+
+    def exists(self, key):
+        return os.path.exists(os.path.join(self.root, key))
+
+    def put(self, key, path):
+        target = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp = f"{target}.{os.getpid()}.tmp"
+        shutil.copyfile(path, tmp)
+        os.replace(tmp, target)
+
+    def open(self, key):
+        return open(os.path.join(self.root, key), "rb")  # FileNotFoundError: permanent failure
+
+    # Readiness (see startup.py): the root must be a directory this process can read and write
+    def check(self):
+        if not os.path.isdir(self.root):
+            raise OSError(f"{self.root} does not exist or is not a directory")
+        if not os.access(self.root, os.R_OK | os.W_OK | os.X_OK):
+            raise OSError(f"{self.root} is not readable and writable")
+        return "file://" + os.path.abspath(self.root).replace(os.sep, "/")
+
+
+class S3BlobStore:
+    def __init__(self, bucket, prefix="", endpoint_url=BLOB_S3_ENDPOINT):
+        if boto3 is None:
+            raise RuntimeError("boto3 is required for s3:// blob stores (pip install boto3)")
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+
+    def _key(self, key):
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def url(self, key):
+        return f"s3://{self.bucket}/{self._key(key)}"
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+            return True
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise OSError(f"Blob store error for {self.url(key)}: {e}") from e
+
+    def put(self, key, path):
+        try:
+            self.client.upload_file(path, self.bucket, self._key(key))
+        except (BotoCoreError, ClientError) as e:
+            raise OSError(f"Cannot upload {path} to {self.url(key)}: {e}") from e
+
+    def open(self, key):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self._key(key))["Body"]
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                raise FileNotFoundError(f"No blob at {self.url(key)}") from e
+            raise OSError(f"Blob store error for {self.url(key)}: {e}") from e
+        except BotoCoreError as e:
+            raise OSError(f"Blob store unreachable for {self.url(key)}: {e}") from e
+
+    # Readiness (see startup.py): the bucket exists and these credentials may use it
+    def check(self):
+        root = f"s3://{self.bucket}/{self.prefix}".rstrip("/")
+        try:
+            self.client.head_bucket(Bucket=self.bucket)
+        except (BotoCoreError, ClientError) as e:
+            raise OSError(f"Blob store {root} unavailable: {e}") from e
+        return root
+
+
+def _local_path(url):
+    parsed = urlparse(url)
+    if parsed.scheme != "file":
+        return url
+    path = parsed.path
+    if os.name == "nt" and path.startswith("/") and path[2:3] == ":":
+        path = path[1:]  # file:///D:/blobs
+    return path
+
+
+# Store and key of one blob URL, as found in a message. A message must not
+# make the consumer read any file it can see: file:// references resolve only
+# under the local store `root` (BLOB_STORE_URL).
+def parse_blob_url(url, root=None):
+    root = BLOB_STORE_URL if root is None else root
+    parsed = urlparse(url)
+    if parsed.scheme == "s3":
+        return S3BlobStore(parsed.netloc), parsed.path.lstrip("/")
+    if parsed.scheme not in ("file", ""):
+        raise PayloadError(f"unsupported blob URL: {url[:100]}")
+    if not root or urlparse(root).scheme == "s3":
+        raise PayloadError(f"{url[:100]} is not in a local blob store (BLOB_STORE_URL={root or 'unset'})")
+    root_path = os.path.realpath(_local_path(root))
+    path = os.path.realpath(_local_path(url))
+    try:
+        inside = path != root_path and os.path.commonpath([root_path, path]) == root_path
+    except ValueError:  # another drive
+        inside = False
+    if not inside:
+        raise PayloadError(f"{url[:100]} is outside the blob store {root}")
+    return LocalBlobStore(root_path), os.path.relpath(path, root_path)
+
+
+# The producer's store, from BLOB_STORE_URL; None when references are disabled
+def open_store(url=BLOB_STORE_URL):
+    if not url:
+        return None
+    parsed = urlparse(url)
+    if parsed.scheme == "s3":
+        return S3BlobStore(parsed.netloc, parsed.path)
+    return LocalBlobStore(_local_path(url))
+
+
+def blob_key(sha256, file_path):
+    extension = os.path.splitext(file_path)[1].lower() or ".pdf"
+    return f"{sha256[:2]}/{sha256}{extension}"
+
+
+# --- Producer side ---
+def build_payload(file_path, mode=PAYLOAD_MODE, store=None):
+    if mode == "path":
+        return None
+    size = os.path.getsize(file_path)
+    if mode == KIND_INLINE or (mode == "auto" and size <= PAYLOAD_INLINE_MAX_BYTES):
+        with open(file_path, "rb") as f:
+            raw = f.read()
+        return {"kind": KIND_INLINE, "compression": "zlib", "sha256": hashlib.sha256(raw).hexdigest(),
+                "size": size, "data": base64.b64encode(zlib.compress(raw, 6)).decode("ascii")}
+    if store is None:
+        logger.warning(f"No BLOB_STORE_URL to upload {file_path} ({size} bytes) to; sending its path only.")
+        return None
+    sha256 = file_digest(file_path)
+    key = blob_key(sha256, file_path)
+    if not store.exists(key):  # content-addressed: the same PDF is uploaded once
+        store.put(key, file_path)
+    return {"kind": KIND_REF, "url": store.url(key), "sha256": sha256, "size": size}
+
+
+# Adds the payload for message["file_path"] to the message (in place) and returns it
+def attach_payload(message, mode=PAYLOAD_MODE, store=None):
+    payload = build_payload(message["file_path"], mode, store)
+    if payload is not None:
+        message["payload"] = payload
+    return message
+
+
+# --- Consumer side: content-addressed read-through cache ---
+class BlobCache:
+    def __init__(self, directory=BLOB_CACHE_DIR, max_bytes=BLOB_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.stats = {"hits": 0, "misses": 0, "bytes_fetched": 0, "evicted": 0}
+
+    def path_for(self, sha256, extension=".pdf"):
+        return os.path.join(self.directory, sha256[:2], sha256 + extension)
+
+    def get(self, sha256, extension=".pdf"):
+        path = self.path_for(sha256, extension)
+        if os.path.exists(path):
+            try:
+                os.utime(path)  # least recently used goes first
+            except OSError:
+                pass
+            with self._lock:
+                self.stats["hits"] += 1
+            return path
+        return None
+
+    # Streams chunks into the cache, checking the sha256 on the way; returns the cached path
+    def put_stream(self, sha256, chunks, extension=".pdf"):
+        path = self.path_for(sha256, extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        h = hashlib.sha256()
+        size = 0
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    h.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            if h.hexdigest() != sha256:
+                raise PayloadError(f"payload checksum mismatch (expected {sha256}, got {h.hexdigest()})")
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        with self._lock:
+            self.stats["misses"] += 1
+            self.stats["bytes_fetched"] += size
+            self._writes += 1
+            evict = self._writes % max(1, BLOB_CACHE_EVICT_EVERY) == 0
+        if evict:
+            self.evict()
+        return path
+
+    def evict(self):
+        entries = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith(".part"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                with self._lock:
+                    self.stats["evicted"] += 1
+            except OSError:
+                pass
+
+
+blob_cache = BlobCache()
+
+
+# Decoded and inflated in chunks; never more than max_bytes of output, so a
+# small zlib bomb cannot fill the disk or memory
+def _inline_chunks(payload, max_bytes=None):
+    max_bytes = PAYLOAD_MAX_BYTES if max_bytes is None else max_bytes
+    try:
+        raw = base64.b64decode(payload["data"], validate=True)
+    except (KeyError, ValueError, TypeError) as e:
+        raise PayloadError(f"invalid inline payload: {e}") from e
+    compression = payload.get("compression")
+    if compression not in (None, "zlib"):
+        raise PayloadError(f"unknown compression: {str(compression)[:20]}")
+    if compression is None:
+        if len(raw) > max_bytes:
+            raise PayloadError(f"inline payload larger than {max_bytes} bytes")
+        yield raw
+        return
+    decompressor = zlib.decompressobj()
+    remaining = max_bytes
+    try:
+        for start in range(0, len(raw), CHUNK_SIZE):
+            # max_length=0 would mean no limit: ask for one byte more than allowed to detect the overflow
+            chunk = decompressor.decompress(raw[start:start + CHUNK_SIZE], remaining + 1)
+            remaining -= len(chunk)
+            if remaining < 0:
+                raise PayloadError(f"inline payload inflates to more than {max_bytes} bytes")
+            yield chunk
+        chunk = decompressor.flush()
+        if len(chunk) > remaining:
+            raise PayloadError(f"inline payload inflates to more than {max_bytes} bytes")
+        yield chunk
+    except zlib.error as e:
+        raise PayloadError(f"invalid inline payload: {e}") from e
+
+
+def _stream_chunks(stream):
+    try:
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+            yield chunk
+    finally:
+        stream.close()
+
+
+# (file_path, local_path) of a task: file_path names the label in logs and
+# results, local_path is a readable file on this node
+def task_file(message, cache=blob_cache):
+    if not isinstance(message, dict):
+        raise PayloadError(f"task is not a JSON object: {str(message)[:100]}")
+    file_path = message.get("file_path")
+    if file_path is not None and not isinstance(file_path, str):
+        raise PayloadError(f"invalid file_path: {str(file_path)[:100]}")
+    payload = message.get("payload")
+    if not payload:
+        if not file_path:
+            raise PayloadError("task without file_path or payload")
+        return file_path, file_path
+    if not isinstance(payload, dict) or payload.get("kind") not in (KIND_INLINE, KIND_REF):
+        raise PayloadError(f"unknown payload: {str(payload)[:100]}")
+    sha256 = payload.get("sha256")
+    if not isinstance(sha256, str) or len(sha256) != 64 or not all(c in "0123456789abcdef" for c in sha256):
+        raise PayloadError(f"payload without a valid sha256: {str(sha256)[:100]}")
+    if payload["kind"] == KIND_REF and not isinstance(payload.get("url"), str):
+        raise PayloadError("blob reference without url")
+    extension = os.path.splitext(file_path or payload.get("url", ""))[1].lower() or ".pdf"
+    file_path = file_path or payload.get("url") or sha256
+    cached = cache.get(sha256, extension)
+    if cached:
+        return file_path, cached
+    if payload["kind"] == KIND_INLINE:
+        return file_path, cache.put_stream(sha256, _inline_chunks(payload), extension)
+    store, key = parse_blob_url(payload["url"])
+    logger.info(f"⬇️ Fetching {payload['url']} ({payload.get('size', '?')} bytes) for {file_path}")
+    return file_path, cache.put_stream(sha256, _stream_chunks(store.open(key)), extension)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Task payloads: inline PDFs and blob-store references")
+    sub = parser.add_subparsers(dest="command", required=True)
+    put = sub.add_parser("put", help="build the payload for a PDF (uploading it if needed)")
+    put.add_argument("file_path")
+    put.add_argument("--mode", default=PAYLOAD_MODE, choices=["auto", "inline", "ref", "path"])
+    get = sub.add_parser("get", help="resolve a task message (JSON file) to a local file")
+    get.add_argument("message")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+
+    if args.command == "put":
+        message = attach_payload({"file_path": args.file_path}, args.mode, open_store())
+        if message.get("payload", {}).get("kind") == KIND_INLINE:
+            message["payload"]["data"] = message["payload"]["data"][:40] + "..."
+        print(json.dumps(message, indent=2, ensure_ascii=False))
+    else:
+        with open(args.message, encoding="utf-8") as f:
+            print(task_file(json.load(f))[1])
+
+
+if __name__ == "__main__":
+    main()
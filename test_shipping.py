@@ -1,7 +1,6 @@
 import os
 import pika  # type: ignore
 import json
-import google.generativeai as genai
 from pypdf import PdfReader
 from pdf2image import convert_from_path  # type: ignore
 import pytesseract  # type: ignore
@@ -9,13 +8,16 @@ import logging
 from dotenv import load_dotenv  # type: ignore
 import sys
 import time
+from model_pool import model_pool
+from response_parser import parse_response
+from task_payload import task_file
+from fair_scheduler import declare_work_queue
 
 # Load environment variables
 load_dotenv()
 
 # --- Config ---
 MESSAGE_QUEUE_HOST = os.getenv("MESSAGE_QUEUE_HOST", "localhost")
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL_NAME", "gemini-1.5-flash-latest")
 TESSERACT_CMD_PATH = os.getenv("TESSERACT_CMD_PATH", r"D:\\Tesseract-OCR\\tesseract.exe")
 GHOSTSCRIPT_PATH = os.getenv("GHOSTSCRIPT_PATH", r"D:\\gs\\gs10.02.1\\bin\\gswin64c.exe")
@@ -36,10 +38,10 @@ if POPPLER_PATH:
     os.environ["PATH"] += os.pathsep + POPPLER_PATH
 
 # --- Gemini Model Initialization ---
+# Built once per process (model_pool.py) instead of on every label
 def get_gemini_model():
     try:
-        genai.configure(api_key=GEMINI_API_KEY)
-        return genai.GenerativeModel(GEMINI_MODEL_NAME)
+        return model_pool.get(GEMINI_MODEL_NAME)
     except Exception as e:
         logger.critical(f"Error initializing Gemini model: {e}", exc_info=True)
         return None
@@ -101,12 +103,7 @@ def process_shipping_label(pdf_content):
         raw_text = response.text.strip()
         logger.debug(f"Gemini output preview: {raw_text[:500]}")
 
-        if raw_text.startswith("```json"):
-            raw_text = raw_text.removeprefix("```json").removesuffix("```").strip()
-        elif raw_text.startswith("```"):
-            raw_text = raw_text.removeprefix("```").removesuffix("```").strip()
-
-        return json.loads(raw_text)
+        return parse_response(raw_text)
     except Exception as e:
         logger.error(f"Gemini processing error: {e}", exc_info=True)
         return None
@@ -116,6 +113,7 @@ def callback(ch, method, properties, body):
     message = json.loads(body.decode())
     file_path = message.get("file_path")
     logger.info(f"Received task: {file_path}")
+    _, file_path = task_file(message)  # local copy when the PDF came inline or from the blob store
 
     text = extract_text_from_pdf(file_path)
     if not text.strip():
@@ -140,7 +138,7 @@ def main():
     try:
         connection = pika.BlockingConnection(pika.ConnectionParameters(host=MESSAGE_QUEUE_HOST))
         channel = connection.channel()
-        channel.queue_declare(queue='shipping_queue', durable=True)
+        channel = declare_work_queue(connection, channel, 'shipping_queue')
         channel.basic_qos(prefetch_count=1)
         channel.basic_consume(queue='shipping_queue', on_message_callback=callback)
         logger.info("Waiting for tasks. Press CTRL+C to exit.")
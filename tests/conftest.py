@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The modules live at the repository root and are run as scripts, not installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Metrics become no-ops: no multiprocess directory is created for the test run
+os.environ.setdefault("METRICS_ENABLED", "false")
@@ -0,0 +1,54 @@
+import pytest
+
+from supervisor import Autoscaler, parse_bounds
+
+
+def autoscaler(**kwargs):
+    options = dict(min_workers=1, max_workers=8, concurrency=4, target_drain=60, scale_down_delay=120)
+    options.update(kwargs)
+    return Autoscaler(**options)
+
+
+# --- Workers needed ---
+@pytest.mark.parametrize("backlog, seconds_per_label, arrival_rate, workers", [
+    (0, 2.0, 0.0, 1),      # idle: min_workers
+    (240, 2.0, 0.0, 2),    # 2 labels/s per worker, 240 labels in 60 s
+    (0, 2.0, 5.0, 3),      # keeping up with 5 labels/s
+    (240, 2.0, 5.0, 5),    # both
+    (100000, 2.0, 0.0, 8),  # max_workers
+    (241, 2.0, 0.0, 3),    # rounded up
+])
+def test_needed(backlog, seconds_per_label, arrival_rate, workers):
+    assert autoscaler().needed(backlog, seconds_per_label, arrival_rate) == workers
+
+
+def test_needed_with_zero_minimum_and_instant_labels():
+    scaler = autoscaler(min_workers=0)
+    assert scaler.needed(0, 2.0) == 0
+    assert scaler.needed(1, 0.0) == 1
+
+
+# --- Decisions ---
+def test_scales_up_at_once_and_down_one_worker_per_delay():
+    scaler = autoscaler()
+    assert scaler.decide(0, 100000, 2.0) == 8
+    assert scaler.decide(10, 0, 2.0) == 8      # lull starts
+    assert scaler.decide(100, 0, 2.0) == 8
+    assert scaler.decide(130, 0, 2.0) == 7     # 120 s later
+    assert scaler.decide(200, 0, 2.0) == 7
+    assert scaler.decide(250, 0, 2.0) == 6
+
+
+def test_short_lull_does_not_scale_down():
+    scaler = autoscaler()
+    assert scaler.decide(0, 480, 2.0) == 4
+    assert scaler.decide(10, 0, 2.0) == 4
+    assert scaler.decide(100, 480, 2.0) == 4   # needed again: the lull timer restarts
+    assert scaler.decide(200, 0, 2.0) == 4
+    assert scaler.decide(310, 0, 2.0) == 4
+    assert scaler.decide(320, 0, 2.0) == 3
+
+
+def test_parse_bounds():
+    assert parse_bounds("shipping=2:10, return=:3 bogus", default=(1, 8)) == {"shipping": (2, 10),
+                                                                             "return": (1, 3)}
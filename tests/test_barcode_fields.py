@@ -0,0 +1,62 @@
+import re
+
+import pytest
+
+from barcode_stage import barcode_fields, parse_payload, reconcile
+
+PATTERNS = {"tracking_number": re.compile(r"SPXVN\d{10}"), "order_id": re.compile(r"\d{6}[A-Z0-9]{4}")}
+
+
+def symbols(*texts):
+    return [{"type": "CODE128", "text": text, "page": 1} for text in texts]
+
+
+# --- Payloads ---
+@pytest.mark.parametrize("text, expected", [
+    ('{"tracking": "SPXVN0123456789", "shop": "A"}', {"tracking": "SPXVN0123456789", "shop": "A"}),
+    ("https://track.example/t?awb=SPXVN0123456789&lang=vi", {"awb": "SPXVN0123456789", "lang": "vi"}),
+    ("Order No: 240101ABCD|Tracking-No = SPXVN0123456789",
+     {"Order No": "240101ABCD", "Tracking-No": "SPXVN0123456789"}),
+    ("Mã vận đơn|MVD:SPXVN0123456789", {"MVD": "SPXVN0123456789"}),
+])
+def test_structured_payloads(text, expected):
+    assert parse_payload(text) == expected
+
+
+@pytest.mark.parametrize("text", ["SPXVN0123456789", '{"shop": "A"}', "[1, 2]", "color=red", "{not json"])
+def test_plain_values_and_payloads_without_a_known_field(text):
+    assert parse_payload(text) is None
+
+
+# --- Fields ---
+def test_plain_values_match_the_handler_patterns():
+    fields = barcode_fields(symbols("spxvn 0123-456789", "240101ABCD", "8935049501234"), PATTERNS)
+    assert fields == {"tracking_number": "SPXVN0123456789", "order_id": "240101ABCD"}
+
+
+def test_payload_keys_name_the_fields():
+    fields = barcode_fields(symbols('{"ordersn": "240101ABCD", "waybill_no": "SPXVN0123456789"}'), PATTERNS)
+    assert fields == {"tracking_number": "SPXVN0123456789", "order_id": "240101ABCD"}
+
+
+def test_several_values_are_resolved_by_the_label_text():
+    found = symbols("SPXVN0123456789", "SPXVN9999999999")
+    assert barcode_fields(found, PATTERNS, text="Mã vận đơn: SPXVN 0123 456 789") == {
+        "tracking_number": "SPXVN0123456789"}
+    assert barcode_fields(found, PATTERNS) == {}
+    assert barcode_fields(found, PATTERNS, text="SPXVN0123456789 SPXVN9999999999") == {}
+
+
+def test_repeated_symbols_are_one_value():
+    assert barcode_fields(symbols("SPXVN0123456789", "SPXVN0123456789"), PATTERNS) == {
+        "tracking_number": "SPXVN0123456789"}
+
+
+# --- Reconcile ---
+def test_reconcile_fills_missing_fields_and_overrides_mismatches():
+    data = {"tracking_number": "SPXVN0123456780", "order_id": "Not found", "recipient": "A"}
+    barcodes = {"tracking_number": "SPXVN0123456789", "order_id": "240101ABCD"}
+    assert reconcile("shipping", data, barcodes, override=True) == {
+        "tracking_number": "SPXVN0123456789", "order_id": "240101ABCD", "recipient": "A"}
+    assert reconcile("shipping", data, barcodes, override=False)["tracking_number"] == "SPXVN0123456780"
+    assert data["order_id"] == "Not found"  # the caller's dict is left alone
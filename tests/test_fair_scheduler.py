@@ -0,0 +1,91 @@
+from fair_scheduler import FairScheduler
+
+
+# --- Failed submits ---
+def test_failed_submit_frees_the_slot_and_returns_the_item():
+    started = []
+
+    def submit(item):
+        if item == "bad":
+            raise RuntimeError("cannot schedule new futures after shutdown")
+        started.append(item)
+
+    scheduler = FairScheduler(1, submit)
+    assert scheduler.add("a", 0, "bad") == ["bad"]
+    assert scheduler.stats()["running"] == 0
+    assert scheduler.stats()["started"] == {"a": 0}
+    assert scheduler.add("a", 0, "good") == []
+    assert started == ["good"]
+
+
+def test_failed_submit_on_done_returns_the_waiting_items():
+    scheduler = FairScheduler(1, lambda item: None)
+    scheduler.add("a", 0, 1)
+    scheduler.add("a", 0, 2)
+    scheduler.add("b", 0, 3)
+
+    def submit(item):
+        raise RuntimeError("shut down")
+    scheduler.submit = submit
+    assert sorted(scheduler.done()) == [2, 3]
+    assert scheduler.stats()["running"] == 0
+    assert scheduler.pending() == 0
+
+
+# --- Virtual time ---
+def run(scheduler, started):
+    while scheduler.pending():
+        scheduler.done()
+    return started
+
+
+def scheduler_with(weights=None, slots=1):
+    started = []
+    return FairScheduler(slots, started.append, weights=weights or {}), started
+
+
+def test_busy_tenants_get_slots_in_proportion_to_their_weight():
+    scheduler, started = scheduler_with({"big": 2.0, "small": 1.0})
+    for n in range(30):
+        scheduler.add("big", 0, ("big", n))
+        scheduler.add("small", 0, ("small", n))
+    run(scheduler, started)
+    first = [tenant for tenant, _ in started[:30]]
+    assert first.count("big") == 20
+    assert first.count("small") == 10
+
+
+def test_priority_goes_first_then_the_tenant_behind_in_virtual_time():
+    scheduler, started = scheduler_with()
+    scheduler.add("a", 0, "first")  # takes the only slot
+    scheduler.add("a", 0, "low 1")
+    scheduler.add("a", 0, "low 2")
+    scheduler.add("b", 0, "other")
+    scheduler.add("a", 5, "urgent")
+    # urgent is a's second start; b, still at virtual time 0, then goes before a's older tasks
+    assert run(scheduler, started) == ["first", "urgent", "other", "low 1", "low 2"]
+
+
+def test_idle_tenant_earns_no_credit_for_a_later_burst():
+    scheduler, started = scheduler_with()
+    for n in range(5):
+        scheduler.add("a", 0, ("a", n))
+    run(scheduler, started)
+    scheduler.done()  # the last of a's tasks finishes, nothing is running
+    del started[:]
+    for n in range(4):
+        scheduler.add("b", 0, ("b", n))
+        scheduler.add("a", 0, ("a", n + 5))
+    run(scheduler, started)
+    # b starts at a's virtual time, not at 0: it does not get four slots in a row
+    assert [tenant for tenant, _ in started[:4]].count("b") == 2
+
+
+def test_close_returns_the_waiting_items_in_run_order():
+    scheduler, started = scheduler_with()
+    scheduler.add("a", 0, "running")
+    scheduler.add("a", 0, "later")
+    scheduler.add("a", 9, "sooner")
+    assert scheduler.close() == ["sooner", "later"]
+    scheduler.done()
+    assert started == ["running"]
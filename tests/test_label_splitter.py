@@ -0,0 +1,69 @@
+import re
+
+from label_splitter import split_segments, page_regions, aggregate, split_children, LabelSegment
+
+KEY = re.compile(r"SPXVN\d{10}")
+
+
+def split_key(line):
+    match = KEY.search(line)
+    return match.group(0) if match else None
+
+
+def label(tracking, recipient):
+    return f"Shopee Express\nMã vận đơn: {tracking}\nNgười nhận: {recipient}"
+
+
+def segments(pages, lookback=1):
+    return [(s.index, s.pages, s.key, s.text) for s in split_segments(pages, split_key, lookback)]
+
+
+# --- Segments ---
+def test_one_label_per_page():
+    pages = [(1, label("SPXVN0000000001", "A")), (2, label("SPXVN0000000002", "B"))]
+    assert [(i, p, k) for i, p, k, _ in segments(pages)] == [(0, [1], "SPXVN0000000001"),
+                                                             (1, [2], "SPXVN0000000002")]
+
+
+def test_pages_without_a_key_continue_the_label():
+    pages = [(1, label("SPXVN0000000001", "A")), (2, "Danh sách sản phẩm\n2 x Áo thun"),
+             (3, label("SPXVN0000000002", "B"))]
+    found = segments(pages)
+    assert [(p, k) for _, p, k, _ in found] == [([1, 2], "SPXVN0000000001"), ([3], "SPXVN0000000002")]
+    assert "Áo thun" in found[0][3]
+
+
+def test_repeated_key_on_the_next_page_is_the_same_label():
+    pages = [(1, label("SPXVN0000000001", "A")), (2, "Trang 2\nMã vận đơn: SPXVN0000000001")]
+    assert [(p, k) for _, p, k, _ in segments(pages)] == [([1, 2], "SPXVN0000000001")]
+
+
+def test_several_labels_on_one_page_keep_their_header_line():
+    page = label("SPXVN0000000001", "A") + "\n" + label("SPXVN0000000002", "B")
+    found = segments([(1, page)])
+    assert [(p, k) for _, p, k, _ in found] == [([1], "SPXVN0000000001"), ([1], "SPXVN0000000002")]
+    assert found[1][3] == label("SPXVN0000000002", "B")  # the courier line above the key moved with it
+    assert found[0][3] == label("SPXVN0000000001", "A")
+
+
+def test_file_without_keys_is_one_label_and_blank_pages_are_dropped():
+    assert segments([(1, "Phiếu giao hàng"), (2, "Người nhận: A")]) == [(0, [1, 2], None,
+                                                                          "Phiếu giao hàng\nNgười nhận: A")]
+    assert segments([(1, ""), (2, "   ")]) == []
+
+
+def test_page_regions_without_lookback():
+    page = "SPXVN0000000001\nA\nheader\nSPXVN0000000002\nB"
+    assert page_regions(page, split_key, lookback=0) == [(["SPXVN0000000001", "A", "header"], "SPXVN0000000001"),
+                                                         (["SPXVN0000000002", "B"], "SPXVN0000000002")]
+
+
+# --- Aggregation ---
+def test_aggregate_and_children():
+    first, second = LabelSegment(0, [1], "K1", ""), LabelSegment(1, [2, 3], "K2", "")
+    data = aggregate("many.pdf", "m-1", [(first, {"tracking_number": "K1"}), (second, None)])
+    assert data["label_count"] == 2
+    assert data["labels"] == [{"tracking_number": "K1", "parent_id": "m-1", "label_index": 0, "pages": [1]}]
+    assert data["failed_labels"] == [{"label_index": 1, "pages": [2, 3], "key": "K2"}]
+    assert split_children("many.pdf", data) == [("many.pdf#label=0", data["labels"][0])]
+    assert split_children("one.pdf", {"tracking_number": "K1"}) == []
@@ -0,0 +1,43 @@
+import pytest
+
+import ocr_stage
+from page_router import extract_routed_text
+from label_splitter import iter_page_texts
+from synthetic_labels import write_text_pdf
+
+TEXT_PAGE = ["Ma van don: SPXVN012345678901", "Nguoi nhan: Nguyen Van A, 12 Le Loi, Quan 1, TP HCM",
+             "Ma don hang: 240101ABCDEF12"]
+
+
+@pytest.fixture
+def mixed_pdf(tmp_path):
+    # Page 1 has a text layer, page 2 is blank and routed to OCR
+    path = tmp_path / "mixed.pdf"
+    write_text_pdf(str(path), [TEXT_PAGE, []])
+    return str(path)
+
+
+@pytest.fixture
+def failing_ocr(monkeypatch):
+    def ocr_page(*args, **kwargs):
+        raise RuntimeError("pdftoppm: cannot render page")
+    monkeypatch.setattr(ocr_stage, "ocr_page", ocr_page)
+
+
+def test_failed_ocr_keeps_text_layer_pages(mixed_pdf, failing_ocr):
+    text, report = extract_routed_text(mixed_pdf)
+    assert "SPXVN012345678901" in text
+    assert [entry["route"] for entry in report] == ["text", "skipped"]
+
+
+def test_ocr_text_is_merged_in_page_order(mixed_pdf, monkeypatch):
+    monkeypatch.setattr(ocr_stage, "ocr_page", lambda pdf_path, n, *args, **kwargs: f"ocr page {n}")
+    text, report = extract_routed_text(mixed_pdf)
+    assert text.index("SPXVN012345678901") < text.index("ocr page 2")
+    assert [entry["route"] for entry in report] == ["text", "ocr"]
+
+
+def test_splitter_pages_survive_failed_ocr(mixed_pdf, failing_ocr):
+    pages = dict(iter_page_texts(mixed_pdf))
+    assert "SPXVN012345678901" in pages[1]
+    assert pages[2] == ""
@@ -0,0 +1,114 @@
+import sqlite3
+import time
+
+import pytest
+
+from rate_limiter import (_SharedState, RateLimiter, CircuitBreaker, GeminiGuard, GeminiUnavailable,
+                          is_retryable, retry_hint_seconds)
+
+
+@pytest.fixture
+def state(tmp_path):
+    return _SharedState(str(tmp_path / "limiter.sqlite3"))
+
+
+class ResourceExhausted(Exception):
+    pass
+
+
+# --- Token buckets ---
+def test_acquire_takes_a_request_and_tokens(state):
+    limiter = RateLimiter(state, rpm=60, tpm=1000)
+    limiter.acquire(100)
+    levels = dict(state.connection().execute("SELECT name, level FROM buckets").fetchall())
+    assert levels["requests"] == pytest.approx(59, abs=0.01)
+    assert levels["tokens"] == pytest.approx(900, abs=1)
+
+
+def test_settle_returns_unused_tokens_up_to_capacity(state):
+    limiter = RateLimiter(state, rpm=60, tpm=1000)
+    limiter.acquire(500)
+    limiter.settle(500, 200)
+    level = state.connection().execute("SELECT level FROM buckets WHERE name = 'tokens'").fetchone()[0]
+    assert level == pytest.approx(800, abs=1)
+    limiter.settle(500, 0)
+    level = state.connection().execute("SELECT level FROM buckets WHERE name = 'tokens'").fetchone()[0]
+    assert level == 1000
+
+
+def test_failed_settle_does_not_leave_a_transaction_open(state):
+    limiter = RateLimiter(state, rpm=60, tpm=1000)
+    limiter.acquire(10)
+    limiter.limits["tokens"] = object()  # cannot be bound: fails between BEGIN and COMMIT
+    with pytest.raises(sqlite3.Error):
+        limiter.settle(10, 5)
+    assert not state.connection().in_transaction
+    limiter.limits["tokens"] = 1000
+    limiter.acquire(10)
+    CircuitBreaker(state).record_failure()
+
+
+# --- Circuit breaker ---
+def test_breaker_opens_at_threshold_and_closes_on_success(state):
+    breaker = CircuitBreaker(state, threshold=2, cooldown=60)
+    breaker.record_failure()
+    assert not breaker.is_open()
+    breaker.record_failure()
+    assert breaker.is_open()
+    breaker.record_success()
+    assert not breaker.is_open()
+
+
+def test_breaker_honours_a_longer_retry_hint(state):
+    breaker = CircuitBreaker(state, threshold=1, cooldown=1)
+    breaker.record_failure(retry_after=120)
+    opened_until = state.connection().execute("SELECT opened_until FROM breaker").fetchone()[0]
+    assert opened_until - time.time() > 100
+
+
+def test_half_open_breaker_reopens_after_one_failure(state):
+    breaker = CircuitBreaker(state, threshold=2, cooldown=0)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert not breaker.is_open()  # cooldown over: half-open
+    breaker.cooldown = 60
+    breaker.record_failure()
+    assert breaker.is_open()
+
+
+def test_breaker_state_is_shared_between_processes(tmp_path):
+    path = str(tmp_path / "limiter.sqlite3")
+    first = CircuitBreaker(_SharedState(path), threshold=1, cooldown=60)
+    second = CircuitBreaker(_SharedState(path), threshold=1, cooldown=60)
+    first.record_failure()
+    assert second.is_open()
+    second.record_success()
+    assert not first.is_open()
+
+
+def test_guard_retries_then_reports_unavailable(tmp_path, monkeypatch):
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+    guard = GeminiGuard(str(tmp_path / "limiter.sqlite3"), max_retries=2)
+    guard.breaker.threshold = 10
+    calls = []
+
+    def fail():
+        calls.append(1)
+        raise ResourceExhausted("quota, retry in 0.5s")
+    with pytest.raises(GeminiUnavailable):
+        guard.call(fail, 10)
+    assert len(calls) == 3
+
+
+def test_guard_passes_non_retryable_errors_through(tmp_path):
+    guard = GeminiGuard(str(tmp_path / "limiter.sqlite3"))
+    with pytest.raises(ValueError):
+        guard.call(lambda: (_ for _ in ()).throw(ValueError("bad request")), 10)
+    assert not guard.breaker.is_open()
+
+
+def test_retry_classification_and_hints():
+    assert is_retryable(ResourceExhausted())
+    assert not is_retryable(ValueError())
+    assert retry_hint_seconds(ResourceExhausted("Please retry in 7.5s")) == 7.5
+    assert retry_hint_seconds(ValueError("nothing")) is None
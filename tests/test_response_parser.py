@@ -0,0 +1,47 @@
+import pytest
+
+from response_parser import parse_response, ResponseParseError
+
+FIELDS = ("tracking_number", "order_id")
+LABEL = {"tracking_number": "SPXVN0123456789", "order_id": "240101ABCD"}
+
+
+# --- Objects ---
+@pytest.mark.parametrize("text", [
+    '{"tracking_number": "SPXVN0123456789", "order_id": "240101ABCD"}',
+    '```json\n{"tracking_number": "SPXVN0123456789", "order_id": "240101ABCD"}\n```',
+    'Here is the data:\n{"tracking_number": "SPXVN0123456789", "order_id": "240101ABCD"}\nHope this helps!',
+    '{"tracking_number": "SPXVN0123456789", "order_id": "240101ABCD",}',
+    '{“tracking_number”: “SPXVN0123456789”, “order_id”: “240101ABCD”}',
+    "{'tracking_number': 'SPXVN0123456789', 'order_id': '240101ABCD'}",
+    '{"shipping_label": {"tracking_number": "SPXVN0123456789", "order_id": "240101ABCD"}}',
+    '[{"tracking_number": "SPXVN0123456789", "order_id": "240101ABCD"}]',
+])
+def test_object_answers_are_recovered(text):
+    assert parse_response(text, fields=FIELDS) == LABEL
+
+
+def test_truncated_answer_is_closed():
+    text = '```json\n{"tracking_number": "SPXVN0123456789", "order_id": "2401'
+    assert parse_response(text, fields=FIELDS) == {"tracking_number": "SPXVN0123456789", "order_id": "2401"}
+    assert parse_response('{"tracking_number": "SPXVN0123456789", "order_id":') == {
+        "tracking_number": "SPXVN0123456789", "order_id": None}
+
+
+def test_single_key_object_is_not_unwrapped_without_the_fields():
+    text = '{"label": {"tracking_number": "SPXVN0123456789"}}'
+    assert parse_response(text) == {"label": {"tracking_number": "SPXVN0123456789"}}
+
+
+@pytest.mark.parametrize("text", ["", "I could not read this label.", '"just a string"', "[1, 2, 3]"])
+def test_answers_without_an_object_fail(text):
+    with pytest.raises(ResponseParseError):
+        parse_response(text, fields=FIELDS)
+
+
+# --- Arrays (batches) ---
+def test_array_answers():
+    assert parse_response('[{"a": 1}, {"a": 2}]', array=True) == [{"a": 1}, {"a": 2}]
+    assert parse_response('{"labels": [{"a": 1}, {"a": 2}]}', array=True) == [{"a": 1}, {"a": 2}]
+    assert parse_response('{"a": 1}', array=True) == [{"a": 1}]
+    assert parse_response('[{"a": 1}, {"a": 2', array=True) == [{"a": 1}, {"a": 2}]
@@ -0,0 +1,70 @@
+import threading
+
+import pytest
+
+from results_sink import ResultsSink, connect, find_results
+
+LABEL = {"tracking_number": "SPXVN0123456789", "order_id": "240101ABCD", "recipient": "Nguyen Van A"}
+
+
+@pytest.fixture
+def sink(tmp_path):
+    sink = ResultsSink(str(tmp_path / "results.sqlite3"), batch_size=10, flush_seconds=0.01)
+    yield sink
+    sink.close()
+
+
+def submit(sink, *args, **kwargs):
+    done = threading.Event()
+    outcome = []
+    sink.submit(*args, on_done=lambda ok: (outcome.append(ok), done.set()), **kwargs)
+    assert done.wait(5)
+    return outcome[0]
+
+
+# --- Idempotency ledger ---
+def test_stored_result_is_found_by_message_id(sink):
+    assert submit(sink, "shipping", "a.pdf", LABEL, message_id="m-1", file_hash="h1")
+    assert sink.lookup("shipping", message_id="m-1") == LABEL
+    assert sink.lookup("shipping", message_id="m-2") is None
+
+
+def test_same_file_is_found_by_hash_for_the_same_label_type_only(sink):
+    assert submit(sink, "shipping", "a.pdf", LABEL, file_hash="h1")
+    assert sink.lookup("shipping", message_id="republished", file_hash="h1") == LABEL
+    assert sink.lookup("return", file_hash="h1") is None
+
+
+def test_failed_extractions_are_stored_but_not_in_the_ledger(sink):
+    assert submit(sink, "shipping", "a.pdf", None, message_id="m-1", file_hash="h1")
+    assert sink.lookup("shipping", message_id="m-1", file_hash="h1") is None
+
+
+def test_latest_result_wins_for_a_file(sink):
+    newer = dict(LABEL, recipient="Tran Thi B")
+    assert submit(sink, "shipping", "a.pdf", LABEL, message_id="m-1", file_hash="h1")
+    assert submit(sink, "shipping", "a.pdf", newer, message_id="m-2", file_hash="h1")
+    assert sink.lookup("shipping", file_hash="h1") == newer
+
+
+def test_lookup_without_keys_or_with_idempotency_off(sink, monkeypatch):
+    assert submit(sink, "shipping", "a.pdf", LABEL, message_id="m-1")
+    assert sink.lookup("shipping") is None
+    monkeypatch.setattr("results_sink.IDEMPOTENCY_ENABLED", False)
+    assert sink.lookup("shipping", message_id="m-1") is None
+
+
+def test_split_file_stores_its_labels_and_points_the_ledger_at_the_aggregate(sink):
+    aggregate = {"parent_id": "m-1", "labels": [LABEL]}
+    assert submit(sink, "shipping", "many.pdf", aggregate, message_id="m-1",
+                  children=[("many.pdf#label=0", LABEL)])
+    assert sink.lookup("shipping", message_id="m-1") == aggregate
+    conn = connect(sink.path)
+    rows = find_results(conn, tracking_number=LABEL["tracking_number"])
+    conn.close()
+    assert [row["file_path"] for row in rows] == ["many.pdf#label=0"]
+
+
+def test_failed_batch_reports_false(sink):
+    sink._conn.execute("DROP TABLE label_ledger")
+    assert submit(sink, "shipping", "a.pdf", LABEL, message_id="m-1") is False
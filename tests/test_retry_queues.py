@@ -0,0 +1,89 @@
+import json
+
+import pika  # type: ignore
+import pytest
+
+from retry_queues import (LabelFailure, classify, next_destination, last_attempt, failure_headers, route_failure,
+                          retry_topology, RETRIED, DEAD_LETTERED, ATTEMPT_HEADER, REASON_HEADER)
+from task_payload import PayloadError
+
+DELAYS = [30, 300]
+
+
+def properties(attempt=None, **kwargs):
+    return pika.BasicProperties(headers={ATTEMPT_HEADER: attempt} if attempt is not None else None, **kwargs)
+
+
+class ResourceExhausted(Exception):
+    pass
+
+
+# --- Classification ---
+@pytest.mark.parametrize("exc, reason, retryable", [
+    (LabelFailure("extraction_failed", True), "extraction_failed", True),
+    (json.JSONDecodeError("Expecting value", "", 0), "bad_message", False),
+    (UnicodeDecodeError("utf-8", b"\xff", 0, 1, "invalid start byte"), "bad_message", False),
+    (PayloadError("checksum mismatch"), "bad_payload", False),
+    (FileNotFoundError("label.pdf"), "file_not_found", False),
+    (ConnectionResetError("reset"), "transient_error", True),
+    (TimeoutError(), "transient_error", True),
+    (ResourceExhausted("429 quota"), "transient_error", True),
+    (KeyError("file_path"), "error", False),
+])
+def test_classify(exc, reason, retryable):
+    failure = classify(exc)
+    assert (failure.reason, failure.retryable) == (reason, retryable)
+
+
+# --- Routing ---
+def test_retryable_failures_climb_the_tiers_then_go_to_the_dead_letter_queue():
+    failure = LabelFailure("extraction_failed", True)
+    assert next_destination("q", properties(), failure, DELAYS) == ("q.retry.1", RETRIED)
+    assert next_destination("q", properties(1), failure, DELAYS) == ("q.retry.2", RETRIED)
+    assert next_destination("q", properties(2), failure, DELAYS) == ("q.dead", DEAD_LETTERED)
+    assert not last_attempt(properties(1), DELAYS)
+    assert last_attempt(properties(2), DELAYS)
+
+
+def test_permanent_failures_are_dead_lettered_at_once():
+    assert next_destination("q", properties(), LabelFailure("unreadable", False), DELAYS) == ("q.dead", DEAD_LETTERED)
+    assert next_destination("q", properties(), LabelFailure("extraction_failed", True), []) == ("q.dead",
+                                                                                               DEAD_LETTERED)
+
+
+def test_bad_attempt_header_counts_as_the_first_attempt():
+    failure = LabelFailure("extraction_failed", True)
+    assert next_destination("q", properties("x"), failure, DELAYS) == ("q.retry.1", RETRIED)
+
+
+def test_retry_tiers_dead_letter_back_to_the_work_queue():
+    topology = dict(retry_topology("q", DELAYS))
+    assert topology["q.retry.2"] == {"x-message-ttl": 300000, "x-dead-letter-exchange": "",
+                                     "x-dead-letter-routing-key": "q"}
+    assert topology["q.dead"] is None
+
+
+class Channel:
+    def __init__(self):
+        self.published = []
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        self.published.append((routing_key, body, properties))
+
+
+def test_route_failure_publishes_with_the_reason_and_keeps_the_message_id():
+    channel = Channel()
+    props = pika.BasicProperties(headers={ATTEMPT_HEADER: 1, "tenant": "shop-1"}, message_id="m-1", priority=5)
+    outcome = route_failure(channel, "q", b"{}", props, LabelFailure("extraction_failed", True, "empty"), DELAYS)
+    assert outcome == RETRIED
+    routing_key, body, published = channel.published[0]
+    assert (routing_key, body) == ("q.retry.2", b"{}")
+    assert (published.message_id, published.priority, published.delivery_mode) == ("m-1", 5, 2)
+    assert published.headers[ATTEMPT_HEADER] == 2
+    assert published.headers[REASON_HEADER] == "extraction_failed"
+    assert published.headers["tenant"] == "shop-1"
+
+
+def test_failure_detail_is_truncated():
+    headers = failure_headers(properties(), LabelFailure("error", False, "x" * 2000))
+    assert len(headers["failure_detail"]) == 500
@@ -0,0 +1,117 @@
+import base64
+import hashlib
+import zlib
+
+import pytest
+
+from retry_queues import classify
+from task_payload import BlobCache, LocalBlobStore, PayloadError, build_payload, parse_blob_url, task_file
+
+PDF = b"%PDF-1.4\n" + b"0" * 5000 + b"\n%%EOF\n"
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return BlobCache(str(tmp_path / "cache"))
+
+
+@pytest.fixture
+def store(tmp_path):
+    root = tmp_path / "blobs"
+    root.mkdir()
+    return LocalBlobStore(str(root))
+
+
+@pytest.fixture
+def store_root(monkeypatch, store):
+    monkeypatch.setattr("task_payload.BLOB_STORE_URL", store.root)
+    return store.root
+
+
+def inline(raw, compressed=None):
+    compressed = zlib.compress(raw) if compressed is None else compressed
+    return {"kind": "inline", "compression": "zlib", "sha256": hashlib.sha256(raw).hexdigest(),
+            "size": len(raw), "data": base64.b64encode(compressed).decode("ascii")}
+
+
+def assert_bad_payload(excinfo):
+    failure = classify(excinfo.value)
+    assert (failure.reason, failure.retryable) == ("bad_payload", False)
+
+
+# --- Inline payloads ---
+def test_inline_payload_round_trip(tmp_path, cache):
+    pdf = tmp_path / "label.pdf"
+    pdf.write_bytes(PDF)
+    message = {"file_path": str(pdf), "payload": build_payload(str(pdf), mode="inline")}
+    file_path, local_path = task_file(message, cache)
+    assert file_path == str(pdf)
+    assert open(local_path, "rb").read() == PDF
+
+
+def test_inline_payload_larger_than_the_cap_is_rejected(cache, monkeypatch):
+    monkeypatch.setattr("task_payload.PAYLOAD_MAX_BYTES", 1024)
+    raw = b"\0" * (10 * 1024 * 1024)  # inflates 1000x: a small message, a large file
+    with pytest.raises(PayloadError) as excinfo:
+        task_file({"file_path": "bomb.pdf", "payload": inline(raw)}, cache)
+    assert_bad_payload(excinfo)
+    assert cache.get(hashlib.sha256(raw).hexdigest()) is None
+
+
+@pytest.mark.parametrize("payload", [
+    {"kind": "inline", "compression": "zlib", "sha256": "0" * 64, "data": "not base64!"},
+    {"kind": "inline", "compression": "zlib", "sha256": "0" * 64,
+     "data": base64.b64encode(b"not zlib").decode("ascii")},
+    {"kind": "inline", "compression": "lzma", "sha256": "0" * 64, "data": ""},
+    {"kind": "inline", "sha256": "../../etc/passwd", "data": ""},
+    {"kind": "ref", "sha256": "0" * 64},
+    {"kind": "mail"},
+    "inline",
+])
+def test_malformed_payload_is_a_permanent_bad_payload(cache, payload):
+    with pytest.raises(PayloadError) as excinfo:
+        task_file({"file_path": "label.pdf", "payload": payload}, cache)
+    assert_bad_payload(excinfo)
+
+
+def test_checksum_mismatch_is_rejected(cache):
+    payload = dict(inline(PDF), sha256="f" * 64)
+    with pytest.raises(PayloadError):
+        task_file({"file_path": "label.pdf", "payload": payload}, cache)
+
+
+def test_message_without_payload_names_a_local_file(cache):
+    assert task_file({"file_path": "/shared/label.pdf"}, cache) == ("/shared/label.pdf", "/shared/label.pdf")
+    with pytest.raises(PayloadError):
+        task_file({}, cache)
+
+
+# --- Blob references ---
+def test_reference_inside_the_store_is_fetched(tmp_path, cache, store, store_root):
+    pdf = tmp_path / "label.pdf"
+    pdf.write_bytes(PDF)
+    payload = build_payload(str(pdf), mode="ref", store=store)
+    _, local_path = task_file({"file_path": "label.pdf", "payload": payload}, cache)
+    assert open(local_path, "rb").read() == PDF
+
+
+@pytest.mark.parametrize("url", ["file:///etc/passwd", "/etc/passwd", "{root}/../secret.pdf", "{root}",
+                                 "http://example.com/label.pdf"])
+def test_reference_outside_the_store_is_rejected(store_root, url):
+    with pytest.raises(PayloadError) as excinfo:
+        parse_blob_url(url.format(root=store_root), store_root)
+    assert_bad_payload(excinfo)
+
+
+def test_file_reference_without_a_local_store_is_rejected(store):
+    with pytest.raises(PayloadError):
+        parse_blob_url(store.url("ab/ab.pdf"), "")
+    with pytest.raises(PayloadError):
+        parse_blob_url(store.url("ab/ab.pdf"), "s3://labels")
+
+
+def test_symlink_out_of_the_store_is_rejected(tmp_path, store):
+    (tmp_path / "outside.pdf").write_bytes(PDF)
+    (tmp_path / "blobs" / "link.pdf").symlink_to(tmp_path / "outside.pdf")
+    with pytest.raises(PayloadError):
+        parse_blob_url(store.url("link.pdf"), store.root)
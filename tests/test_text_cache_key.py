@@ -0,0 +1,63 @@
+import pytest
+
+import label_pipeline
+from label_pipeline import read_label_text, text_cache_key
+
+
+def fields_found(text):
+    return "Order" in text
+
+
+class DictCache:
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, kind, key):
+        return self.entries.get((kind, key)) if key is not None else None
+
+    def put(self, kind, key, value):
+        if key is not None:
+            self.entries[(kind, key)] = value
+
+
+# --- Keys ---
+def test_key_depends_on_ocr_fallback_and_stop_when():
+    keys = {text_cache_key("f" * 64, True), text_cache_key("f" * 64, False),
+            text_cache_key("f" * 64, True, fields_found)}
+    assert len(keys) == 3
+    assert text_cache_key("f" * 64, True, fields_found) == text_cache_key("f" * 64, True, fields_found)
+
+
+def test_key_depends_on_ocr_settings(monkeypatch):
+    key = text_cache_key("f" * 64)
+    monkeypatch.setattr(label_pipeline, "OCR_SETTINGS", label_pipeline.OCR_SETTINGS + ";OCR_DPI=300")
+    assert text_cache_key("f" * 64) != key
+
+
+def test_unnamed_stop_when_or_missing_hash_is_not_cached():
+    assert text_cache_key("f" * 64, True, lambda text: True) is None
+    assert text_cache_key(None) is None
+
+
+# --- read_label_text ---
+@pytest.fixture
+def routed(tmp_path, monkeypatch):
+    pdf = tmp_path / "label.pdf"
+    pdf.write_bytes(b"%PDF-1.4\n")
+    calls = []
+
+    def extract(file_path, ocr_fallback=True, stop_when=None):
+        calls.append(ocr_fallback)
+        return "pypdf and OCR text" if ocr_fallback else "pypdf text"
+    monkeypatch.setattr(label_pipeline, "PAGE_ROUTING_ENABLED", True)
+    monkeypatch.setattr(label_pipeline, "extraction_cache", DictCache())
+    monkeypatch.setattr(label_pipeline, "extract_text_per_page", extract)
+    return str(pdf), calls
+
+
+def test_text_without_ocr_does_not_answer_a_read_with_ocr(routed):
+    pdf, calls = routed
+    assert read_label_text(pdf, ocr_fallback=False) == "pypdf text"
+    assert read_label_text(pdf, ocr_fallback=True) == "pypdf and OCR text"
+    assert read_label_text(pdf, ocr_fallback=True) == "pypdf and OCR text"
+    assert calls == [False, True]
@@ -0,0 +1,254 @@
+import os
+import json
+import time
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from dotenv import load_dotenv  # type: ignore
+
+from rate_limiter import GeminiUnavailable
+from retry_queues import LabelFailure, classify, next_destination, route_failure, last_attempt
+from label_splitter import should_split, extract_split_file, split_children
+from label_cache import file_digest
+from results_sink import IDEMPOTENCY_ENABLED
+from task_payload import task_file
+from fair_scheduler import FairScheduler, FAIR_SCHEDULING, delivery_info, record_queue_latency
+from ocr_stage import OCR_PROCESSES, OCR_THREADS
+from metrics import IN_FLIGHT, MESSAGES, LABEL_SECONDS
+
+load_dotenv()
+
+# --- Config ---
+# WORKER_CONCURRENCY=1 keeps the original one-label-at-a-time behaviour.
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "1"))
+PREFETCH_COUNT = int(os.getenv("PREFETCH_COUNT", str(WORKER_CONCURRENCY)))
+# Processes for the CPU-bound steps (pypdf, Tesseract): OCR_PROCESSES, see ocr_stage.py for how it
+# shares the cores with OCR_THREADS. 0 runs them in the worker thread.
+# Threads for the Gemini calls (network-bound).
+LLM_THREADS = int(os.getenv("LLM_THREADS", str(WORKER_CONCURRENCY)))
+
+logger = logging.getLogger(__name__)
+
+
+# --- Thread-safe acks ---
+# pika channels are not thread-safe: acks are run on the connection thread.
+def ack_threadsafe(ch, delivery_tag):
+    ch.connection.add_callback_threadsafe(functools.partial(ch.basic_ack, delivery_tag=delivery_tag))
+
+
+# Ack once the result is stored, requeue if storing it failed
+def settle_threadsafe(ch, delivery_tag, ok):
+    if ok:
+        ack_threadsafe(ch, delivery_tag)
+    else:
+        ch.connection.add_callback_threadsafe(
+            functools.partial(ch.basic_nack, delivery_tag=delivery_tag, requeue=True))
+
+
+# Move a failed message to its retry tier or dead-letter queue, then ack it (see retry_queues.py)
+def fail_threadsafe(ch, delivery_tag, queue, body, properties, failure):
+    def route():
+        route_failure(ch, queue, body, properties, failure)
+        ch.basic_ack(delivery_tag=delivery_tag)
+    ch.connection.add_callback_threadsafe(route)
+
+
+# Stored result of an earlier delivery of this message or of the same file, and the file's hash
+# (None without a sink or with IDEMPOTENCY_ENABLED=false: nothing would look it up)
+def ledger_lookup(sink, label_name, properties, file_path):
+    if sink is None or not IDEMPOTENCY_ENABLED:
+        return None, None
+    file_hash = file_digest(file_path)  # FileNotFoundError: permanent failure, see retry_queues.classify
+    return sink.lookup(label_name, getattr(properties, "message_id", None), file_hash), file_hash
+
+
+# --- Worker pool ---
+# Runs up to `concurrency` labels at once for one or more pika consumers.
+# pika channels are not thread-safe, so every ack is handed back to the
+# connection thread with add_callback_threadsafe, keyed by its own delivery tag.
+# Labels without a result go to a retry tier or the dead-letter queue of the
+# queue they came from; labels already in the sink's ledger are acked at once.
+# With a split handler, multi-page files are split into their labels in the
+# worker thread and the labels' Gemini calls fan out over the LLM threads.
+# With FAIR_SCHEDULING each consumer starts its deliveries through a
+# FairScheduler (priority, then weighted fair across tenants, see
+# fair_scheduler.py) instead of in arrival order.
+class LabelWorkerPool:
+    def __init__(self, extract_fn=None, llm_fn=None, result_fn=None,
+                 concurrency=WORKER_CONCURRENCY, ocr_processes=OCR_PROCESSES, llm_threads=LLM_THREADS, sink=None,
+                 split_handler=None, barcode_fn=None):
+        self.extract_fn = extract_fn  # file_path -> text (runs in the process pool, must be picklable)
+        self.llm_fn = llm_fn          # (text, file_path, pages=None) -> dict | None (runs in the LLM thread pool)
+        self.result_fn = result_fn    # (file_path, data) -> None (runs in the worker thread)
+        self.sink = sink              # ResultsSink: when set, acks wait until the result is on disk
+        self.split_handler = split_handler  # LabelHandler for on_message; see label_splitter.py
+        self.barcode_fn = barcode_fn  # file_path -> dict | None, before extract_fn (LabelExtractor.barcode_answer)
+        self.concurrency = max(1, concurrency)
+        self._workers = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="label-worker")
+        self._llm_pool = ThreadPoolExecutor(max_workers=max(1, llm_threads), thread_name_prefix="label-llm")
+        self._cpu_pool = ProcessPoolExecutor(max_workers=ocr_processes) if ocr_processes > 0 else None
+        self._schedulers = []  # one FairScheduler per consumer
+        self._default_consumer = None
+        logger.info(f"Worker pool started: concurrency={self.concurrency}, "
+                    f"ocr_processes={ocr_processes} x {OCR_THREADS} OCR threads, llm_threads={llm_threads}")
+
+    # pika on_message_callback: must return quickly, the work happens in the pool
+    def on_message(self, ch, method, properties, body):
+        if self._default_consumer is None:
+            self._default_consumer = self.consumer(self.extract_fn, self.llm_fn, self.result_fn, "shipping",
+                                                   "shipping_queue", self.split_handler, barcode_fn=self.barcode_fn)
+        self._default_consumer(ch, method, properties, body)
+
+    # on_message_callback for another label type sharing the same pools. slots:
+    # labels of this queue run at once (default: the whole pool); the channel's
+    # prefetch should be fair_scheduler.prefetch_for(slots) so the scheduler
+    # has deliveries of several tenants to choose from.
+    def consumer(self, extract_fn, llm_fn, result_fn, label_name, queue, split_handler=None, slots=None,
+                 barcode_fn=None):
+        args = (extract_fn, llm_fn, result_fn, label_name, queue, split_handler, barcode_fn)
+        if not FAIR_SCHEDULING:
+            def on_message(ch, method, properties, body):
+                self._workers.submit(self._run, ch, method.delivery_tag, properties, body, *args)
+            return on_message
+
+        scheduler = FairScheduler(slots or self.concurrency,
+                                  lambda item: self._workers.submit(self._run_scheduled, scheduler, *item, *args),
+                                  label_name)
+        self._schedulers.append(scheduler)
+
+        def on_message(ch, method, properties, body):
+            tenant, priority, _ = delivery_info(properties, body)
+            self._requeue(scheduler.add(tenant, priority, (ch, method.delivery_tag, properties, body)))
+        return on_message
+
+    def _run_scheduled(self, scheduler, *args):
+        try:
+            self._run(*args)
+        finally:
+            self._requeue(scheduler.done())
+
+    # Scheduler items (deliveries) go back to the broker
+    def _requeue(self, items):
+        for ch, delivery_tag, _, _ in items:
+            ch.connection.add_callback_threadsafe(
+                functools.partial(ch.basic_nack, delivery_tag=delivery_tag, requeue=True))
+
+    def _run(self, ch, delivery_tag, properties, body, extract_fn, llm_fn, result_fn, label_name, queue,
+             split_handler=None, barcode_fn=None):
+        file_path = None
+        deferred = False
+        requeue = False
+        failure = None
+        outcome = "error"
+        started = time.perf_counter()
+        IN_FLIGHT.labels(label_name).inc()
+        try:
+            message = json.loads(body.decode())
+            file_path = message.get("file_path")
+            logger.info(f"📄 Received task for {label_name} label: {file_path}")
+            record_queue_latency(label_name, properties, message)
+            # The PDF on this node: inline payload, blob-store reference or shared path (see task_payload.py)
+            file_path, local_path = task_file(message)
+
+            stored, file_hash = ledger_lookup(self.sink, label_name, properties, local_path)
+            if stored is not None:
+                logger.info(f"♻️ {file_path} was already processed; acking with the stored result.")
+                result_fn(file_path, stored)
+                outcome = "duplicate"
+                return
+
+            if split_handler is not None and should_split(local_path, split_handler):
+                # Multi-label file: one Gemini call per label, aggregated per file
+                data = extract_split_file(local_path, split_handler, llm_fn,
+                                          getattr(properties, "message_id", None) or file_hash or file_path,
+                                          submit=self._llm_pool.submit, final=last_attempt(properties),
+                                          source=file_path)
+            else:
+                # Barcodes first: when they answer the label, no text is extracted at all
+                data = barcode_fn(local_path) if barcode_fn is not None else None
+                if data is None:
+                    if self._cpu_pool is not None:
+                        text = self._cpu_pool.submit(extract_fn, local_path).result() or ""
+                    else:
+                        text = extract_fn(local_path) or ""
+                    # Without text, llm_fn answers from the barcodes alone or returns None
+                    data = self._llm_pool.submit(llm_fn, text, local_path).result()
+                    if not data and not text.strip():
+                        raise LabelFailure("unreadable", retryable=False,
+                                           detail="no text after pypdf and OCR, no barcodes")
+            result_fn(file_path, data)
+            if not data:
+                # Gemini error, empty answer or invalid JSON: worth another try later
+                raise LabelFailure("extraction_failed", retryable=True)
+            if self.sink is not None:
+                self.sink.submit(label_name, file_path, data,
+                                 on_done=functools.partial(settle_threadsafe, ch, delivery_tag),
+                                 message_id=getattr(properties, "message_id", None), file_hash=file_hash,
+                                 children=split_children(file_path, data))
+                deferred = True
+            outcome = "processed"
+        except GeminiUnavailable as e:
+            logger.warning(f"Requeueing {file_path}: {e}")
+            requeue = True
+            outcome = "requeued"
+        except Exception as e:
+            failure = classify(e)
+            if failure.reason == "error":
+                logger.error(f"Unhandled error while processing {file_path}: {e}", exc_info=True)
+            else:
+                logger.warning(f"No result for {file_path}: {failure}")
+            _, outcome = next_destination(queue, properties, failure)
+        finally:
+            IN_FLIGHT.labels(label_name).dec()
+            MESSAGES.labels(label_name, outcome).inc()
+            LABEL_SECONDS.labels(label_name).observe(time.perf_counter() - started)
+            if failure is not None:
+                fail_threadsafe(ch, delivery_tag, queue, body, properties, failure)
+            elif not deferred:
+                settle_threadsafe(ch, delivery_tag, not requeue)
+
+    # Scheduler stats per label type
+    def scheduler_stats(self):
+        return {s.label_name: s.stats() for s in self._schedulers}
+
+    def shutdown(self, wait=True):
+        # Deliveries still waiting for a worker go back to the broker, in the order they would have run
+        for scheduler in self._schedulers:
+            self._requeue(scheduler.close())
+        self._workers.shutdown(wait=wait)
+        self._llm_pool.shutdown(wait=wait)
+        if self._cpu_pool is not None:
+            self._cpu_pool.shutdown(wait=wait)
+        logger.info("Worker pool stopped.")
+
+
+# --- Pause consuming while Gemini is unhealthy ---
+# Cancels every consumer registered through consume() while the circuit
+# breaker is open, so the broker keeps the messages instead of handing them
+# to workers that could only requeue them, and consumes again once the
+# cooldown is over. check() must run on the connection thread, from a loop
+# around process_data_events(): start_consuming() returns once no consumer is left.
+class ConsumerGate:
+    def __init__(self, breaker):
+        self.breaker = breaker
+        self.paused = False
+        self._consumers = []  # [channel, queue, on_message_callback, consumer_tag]
+
+    def consume(self, channel, queue, on_message_callback):
+        tag = channel.basic_consume(queue=queue, on_message_callback=on_message_callback)
+        self._consumers.append([channel, queue, on_message_callback, tag])
+
+    def check(self):
+        unhealthy = self.breaker.is_open()
+        if unhealthy and not self.paused:
+            for channel, _, _, tag in self._consumers:
+                if channel.is_open:
+                    channel.basic_cancel(tag)
+            self.paused = True
+            logger.warning("Gemini circuit breaker open: stopped consuming.")
+        elif not unhealthy and self.paused:
+            for entry in self._consumers:
+                channel, queue, on_message_callback, _ = entry
+                entry[3] = channel.basic_consume(queue=queue, on_message_callback=on_message_callback)
+            self.paused = False
+            logger.info("Gemini circuit breaker closed: consuming again.")